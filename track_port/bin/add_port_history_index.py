@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""One-time migration: add the (fileportname_id, date) index on
+port_history that put_totals uses to read each port's previous row
+(PortHistory.get_latest_rows) in one query. Run it once, outside market
+hours, as a database user allowed to alter port_history:
+
+    add_port_history_index.py --dry_run   # print the SQL only
+    add_port_history_index.py
+
+The SQL is
+
+    CREATE INDEX port_history_fileportname_id_date ON port_history (fileportname_id, date);
+
+Nothing is done if port_history already has an index leading with those
+columns.
+"""
+
+import os
+import argparse
+
+from sqlalchemy import create_engine, inspect, text
+
+try:
+    host = os.uname()[1]
+except:
+    host = None
+
+if host and host in ('skx-linux',):
+    engine = create_engine('mysql://blreams@localhost/track_port')
+else:
+    engine = create_engine('sqlite:///track_port.db')
+
+arguments = argparse.Namespace
+index_name = 'port_history_fileportname_id_date'
+create_index_sql = f"CREATE INDEX {index_name} ON port_history (fileportname_id, date)"
+
+
+def has_index():
+    indexes = inspect(engine).get_indexes('port_history')
+    return any(index['column_names'][:2] == ['fileportname_id', 'date'] for index in indexes)
+
+def parse_arguments():
+    global arguments
+    parser = argparse.ArgumentParser(
+            prog="add_port_history_index",
+            description="Add the port_history (fileportname_id, date) index put_totals uses"
+            )
+    parser.add_argument('--dry_run', action='store_true', default=False, help="Print the SQL instead of running it")
+    arguments = parser.parse_args()
+
+def main():
+    if has_index():
+        print("port_history already has a (fileportname_id, date) index")
+        return
+    if arguments.dry_run:
+        print(f"{create_index_sql};")
+        return
+    with engine.begin() as connection:
+        connection.execute(text(create_index_sql))
+    print(f"Created {index_name}")
+
+
+if __name__ == '__main__':
+    parse_arguments()
+    main()
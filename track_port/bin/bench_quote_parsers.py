@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Compare quote_parsers backends on saved yahoo quote pages.
+
+Pages are read from --pages, named <kind>_<symbol>.html where kind is one
+of index, mf, option or stock. A quote_archive day directory works too;
+its compressed pages are read the same way and chain pages are skipped.
+Each backend must return the same details dict as the soup backend for
+every page; the timings are per page parse.
+"""
+
+import sys
+import os
+import glob
+import argparse
+import timeit
+
+import quote_parsers
+from quote_archive import read_page, split_page_name
+
+thisdir = os.path.dirname(__file__)
+
+def load_pages(pages_dir):
+    pages = []
+    for filename in sorted(glob.glob(os.path.join(pages_dir, '*.html*'))):
+        if filename.endswith('.tmp'):
+            continue
+        kind, symbol = split_page_name(filename)
+        if kind in quote_parsers.parsers:
+            pages.append((kind, symbol, read_page(filename)))
+    return pages
+
+def details_for(kind, symbol, content, backend):
+    page = quote_parsers.backends[backend](content)
+    return quote_parsers.parsers[kind](symbol, page)
+
+def check_backends(pages, backends):
+    """Return a list of (backend, symbol) pairs whose details differ from soup."""
+    mismatches = []
+    for kind, symbol, content in pages:
+        expected = details_for(kind, symbol, content, 'soup')
+        for backend in backends:
+            if details_for(kind, symbol, content, backend) != expected:
+                mismatches.append((backend, symbol))
+    return mismatches
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(
+            prog='bench_quote_parsers',
+            description='Time quote_parsers backends on saved yahoo quote pages'
+            )
+    parser.add_argument('--pages', default=os.path.join(thisdir, '..', 'test', 'quote_pages'), help="Directory of saved <kind>_<symbol>.html pages")
+    parser.add_argument('--backends', action='append', default=[], help="Backends to compare, default is all")
+    parser.add_argument('--number', type=int, default=20, help="Parses of each page per backend, default=20")
+    return parser.parse_args(args)
+
+def main(args=None):
+    arguments = parse_arguments(args)
+    backends = arguments.backends or list(quote_parsers.backends.keys())
+    pages = load_pages(arguments.pages)
+    if not pages:
+        print(f"No pages found in {arguments.pages}")
+        return 1
+
+    mismatches = check_backends(pages, backends)
+    for backend, symbol in mismatches:
+        print(f"MISMATCH: {backend} details differ from soup for {symbol}")
+
+    print(f"{len(pages)} pages, {arguments.number} parses each")
+    baseline = None
+    for backend in backends:
+        seconds = timeit.timeit(lambda: [details_for(kind, symbol, content, backend) for kind, symbol, content in pages], number=arguments.number)
+        per_page = seconds / (arguments.number * len(pages))
+        baseline = baseline or per_page
+        print(f"{backend:10s} {per_page * 1000.0:8.3f} ms/page  {baseline / per_page:5.2f}x")
+
+    return 1 if mismatches else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
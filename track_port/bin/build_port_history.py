@@ -17,6 +17,9 @@ from datetime import datetime, timedelta
 from dateutil import parser
 import dateparser
 import get_a_quote
+from trading_calendar import TradingCalendar, default_cache_path
+from rate_limiter import RateLimiter, add_rate_arguments
+import http_client
 
 from sqlalchemy import create_engine, Table, MetaData
 from sqlalchemy.ext.declarative import declarative_base
@@ -43,6 +46,8 @@ session = Session()
 
 logging.config.fileConfig('build_port_history_logging.conf')
 logger = logging.getLogger('main')
+trading_calendar = None # defined in main
+rate_limiter = None # defined in main, yahoo requests shared with quote_query and get_a_quote
 ##############################################################################
 
 
@@ -54,6 +59,10 @@ class TransactionLists(Base):
     __tablename__ = 'transaction_list'
     __table_args__ = {'autoload': True}
 
+class MarketHolidays(Base):
+    __tablename__ = 'market_holiday'
+    __table_args__ = {'autoload': True}
+
 class Transaction(object):
     """Effectively a row of the transaction_list table."""
     def __repr__(self):
@@ -177,16 +186,15 @@ class TransactionList(object):
         self.cash_date[current_date] = self.cash_accum
 
         for date_of_change, negative, change in self.cash_changes:
-            while current_date < date_of_change:
-                current_date += timedelta(days=1)
-                self.cash_date[current_date] = self.cash_accum
+            for trading_day in trading_calendar.trading_days_between(current_date + timedelta(days=1), date_of_change):
+                self.cash_date[trading_day] = self.cash_accum
+            current_date = max(current_date, date_of_change)
             self.cash_accum += change
             self.cash_date[date_of_change] = self.cash_accum
             self.log.debug(f"Cash change on date {date_of_change} to {self.cash_accum}")
 
-        while current_date < datetime.date(datetime.now()):
-            current_date += timedelta(days=1)
-            self.cash_date[current_date] = self.cash_accum
+        for trading_day in trading_calendar.trading_days_between(current_date + timedelta(days=1), datetime.date(datetime.now())):
+            self.cash_date[trading_day] = self.cash_accum
 
         self.log.info(f"Initial Date = {list(self.cash_date.keys())[0]}")
         self.log.info(f"Initial Cash = {self.cash_initial}")
@@ -250,9 +258,9 @@ class TransactionList(object):
                 current_date = half_transaction[0]
                 self.log.info(f"Initializing current_date as {current_date}")
                 self.log.info(f"Initial position_accum = {position_accum}")
-            while current_date < half_transaction[0]:
-                self.position_date[current_date] = copy.copy(position_accum)
-                current_date += timedelta(days=1)
+            for trading_day in trading_calendar.trading_days_between(current_date, half_transaction[0] - timedelta(days=1)):
+                self.position_date[trading_day] = copy.copy(position_accum)
+            current_date = max(current_date, half_transaction[0])
 
             # Build trait
             symbol = half_transaction[2]
@@ -275,9 +283,8 @@ class TransactionList(object):
 
         current_date = sorted(list(self.position_date.keys()))[-1]
         self.log.info(f"Current Date = {current_date}")
-        while current_date < datetime.date(datetime.now()):
-            current_date += timedelta(days=1)
-            self.position_date[current_date] = copy.copy(position_accum)
+        for trading_day in trading_calendar.trading_days_between(current_date + timedelta(days=1), datetime.date(datetime.now())):
+            self.position_date[trading_day] = copy.copy(position_accum)
 
         with open('position_date.csv', 'w') as PD:
             for date, positions in self.position_date.items():
@@ -326,7 +333,7 @@ class TransactionList(object):
             expiration = trait[3]
             if expiration is None:
                 symbol = trait[0]
-                get_a_quote_out = get_a_quote.main(args=f'--symbol={symbol} --call')
+                get_a_quote_out = get_a_quote.main(args=f'--symbol={symbol} --call', limiter=rate_limiter)
                 self.symbol_ranges[symbol]['end'] = self.final_date
                 self.symbol_ranges[symbol]['end_price'] = decimal.Decimal(get_a_quote_out.split()[0])
                 self.log.info(f"Updating range end for {symbol} to {self.symbol_ranges[symbol]['end']}, {self.symbol_ranges[symbol]['end_price']}")
@@ -338,7 +345,8 @@ class TransactionList(object):
         self.symbol_prices = {}
         for symbol, symbol_range in self.symbol_ranges.items():
             try:
-                self.symbol_prices[symbol] = pdr_data.DataReader(symbol, start=symbol_range['start'], end=symbol_range['end'], data_source='yahoo')['Adj Close']
+                rate_limiter.acquire('yahoo')
+                self.symbol_prices[symbol] = pdr_data.DataReader(symbol, start=symbol_range['start'], end=symbol_range['end'], data_source='yahoo', session=http_client.get_client().session('finance.yahoo.com'))['Adj Close']
                 self.log.info(f"Got Adj Close for {symbol}")
             except:
                 self.symbol_prices[symbol] = None
@@ -355,19 +363,30 @@ def get_arguments():
     parser.add_argument('-d', '--debug', action='store_true', default=False, help="Show debug messages")
     parser.add_argument('-r', '--report_date', help="Report date")
     parser.add_argument('-f', '--fileportname', default='port:fluffgazer', help="fileportname (ie. port:fluffgazer)")
+    add_rate_arguments(parser)
     arguments = parser.parse_args()
     pass
 
 def main():
+    global trading_calendar
+    global rate_limiter
     log = logging.getLogger('main')
     log.debug('='*150)
 
     get_arguments()
 
+    # Outbound request rates, shared with other processes
+    rate_limiter = RateLimiter.from_arguments(arguments)
+
+    # Trading days from market_holiday, used to fill in the daily cash and position history
+    trading_calendar = TradingCalendar.from_session(session, MarketHolidays, cache_path=default_cache_path)
+
     tl = TransactionList(arguments.fileportname)
     tl.cash_analysis()
     #tl.query()
     tl.position_analysis()
+    for line in rate_limiter.report() + http_client.get_client().report():
+        log.info(line)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,56 @@
+"""Portfolio valuation in Decimal, one transaction at a time.
+
+This is the arithmetic put_totals.Port values a port with. port_valuation
+does the same over NumPy arrays in float64, and its tests check it
+against this module to the cent.
+
+    valuation = value_transactions(transactions, finance_quotes)
+    valuation['invested_total']
+"""
+
+import logging
+from decimal import Decimal
+
+valuation_fields = ('cash', 'basis', 'gain', 'daygain', 'invested_total')
+
+
+def quote_symbol(transaction):
+    """The finance_quote symbol of a transaction, ie. AAPL230616C00150000 for an option."""
+    symbol = transaction.symbol
+    if transaction.descriptor != 'stock':
+        expiration = transaction.expiration.strftime("%y%m%d")
+        option = transaction.descriptor[0].upper()
+        strike = f"{int(transaction.strike * 1000):08d}"
+        symbol += expiration + option + strike
+    return symbol
+
+def add_transaction(valuation, transaction, finance_quotes):
+    """Add one transaction to valuation, {field: Decimal} for each of the
+    valuation_fields. finance_quotes maps quote symbols to rows with last
+    and net.
+    """
+    logger = logging.getLogger(__name__ + '.' + 'add_transaction')
+    if transaction.closed:
+        valuation['cash'] += transaction.shares * (transaction.close_price - transaction.open_price)
+    elif transaction.position.lower() == 'cash':
+        valuation['cash'] += transaction.open_price
+    elif transaction.position.lower() == 'long':
+        valuation['cash'] -= transaction.shares * transaction.open_price
+        valuation['basis'] += transaction.shares * transaction.open_price
+        symbol = quote_symbol(transaction)
+        fq = finance_quotes.get(symbol, None)
+        if hasattr(fq, 'last'):
+            valuation['gain'] += transaction.shares * (fq.last - transaction.open_price)
+            valuation['daygain'] += transaction.shares * fq.net
+            valuation['invested_total'] += transaction.shares * fq.last
+        else:
+            logger.warning(f"Unable to find quote matching {symbol}")
+    else:
+        logger.warning(f"Unhandled transaction id={transaction.id}")
+
+def value_transactions(transactions, finance_quotes):
+    """Return {field: Decimal} for one port's transactions."""
+    valuation = dict.fromkeys(valuation_fields, Decimal(0))
+    for transaction in transactions:
+        add_transaction(valuation, transaction, finance_quotes)
+    return valuation
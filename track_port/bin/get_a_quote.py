@@ -4,9 +4,13 @@ import os
 import argparse
 import six
 from decimal import Decimal
+from rate_limiter import RateLimiter, add_rate_arguments
+
+rate_limiter = None # defined in main
 
 def finviz_lookup():
     import finviz
+    rate_limiter.acquire('finviz')
     results = finviz.get_stock(arguments.symbol)
     last = results['Price']
     close = results['Prev Close']
@@ -35,16 +39,20 @@ def parse_arguments(args):
     parser.add_argument('--service', choices=('finviz',), default='finviz', help="Specify service to use")
     parser.add_argument('--symbol', help="Specify ticker to lookup")
     parser.add_argument('--call', action='store_true', default=False, help="Return list of values")
+    add_rate_arguments(parser)
 
     arguments = parser.parse_args(args)
 
-def main(args=''):
+def main(args='', limiter=None):
+    """limiter is the caller's RateLimiter, otherwise one is made from --rate."""
     global arguments
+    global rate_limiter
     if not args:
         args = ['--help']
     if isinstance(args, six.string_types):
         args = args.split()
     parse_arguments(args)
+    rate_limiter = limiter or RateLimiter.from_arguments(arguments)
     func = globals()["{}_lookup".format(arguments.service)]
     legacy = False
     try:
@@ -55,6 +63,7 @@ def main(args=''):
         legacy = True
     if legacy:
         import subprocess
+        rate_limiter.acquire('yahoo')
         cmd = ['get_a_quote', '--symbol', arguments.symbol]
         pipe = subprocess.run(cmd, stdout=subprocess.PIPE)
         #print(pipe.stdout.decode().strip())
@@ -0,0 +1,179 @@
+"""Shared HTTP client for quote fetching.
+
+One requests.Session per host keeps connections alive and pooled across
+requests. Responses are asked for compressed (br too when brotli is
+installed). A page that came back with an ETag or Last-Modified is
+requested conditionally the next time, and a 304 is answered from the
+cached body. Cached bodies are bounded by their total size, least
+recently used first out. Connection errors, timeouts, 429 and 5xx responses are
+retried with jittered exponential backoff, honouring Retry-After.
+Each request's size and time is logged at DEBUG and totalled per host
+for report().
+
+    client = get_client()
+    response = client.get('https://in.finance.yahoo.com/quote/AAPL?p=AAPL', timeout=30)
+    response.status_code, response.content
+"""
+
+import time
+import random
+import logging
+import threading
+import urllib.parse
+from collections import OrderedDict, namedtuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+user_agent = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0 Safari/537.36'
+retry_statuses = (429, 500, 502, 503, 504)
+
+HttpResponse = namedtuple('HttpResponse', ['status_code', 'content', 'headers', 'url', 'not_modified'])
+
+client = None # shared HttpClient, see get_client
+client_lock = threading.Lock()
+
+
+class HostStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.wire_bytes = 0
+        self.content_bytes = 0
+        self.seconds = 0.0
+        self.not_modified = 0
+        self.retries = 0
+        self.errors = 0
+
+
+class HttpClient(object):
+    def __init__(self, retries=2, backoff=0.5, max_backoff=10.0, pool_size=8, cache_bytes=32 * 1024 * 1024):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self.cache_bytes = cache_bytes
+        self.sessions = {}
+        self.cache = OrderedDict() # url: (etag, last_modified, content)
+        self.cached_bytes = 0 # total len(content) in cache
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def session(self, host):
+        """The keep-alive session for host, created on first use."""
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update({
+                        'User-Agent': user_agent,
+                        'Accept-Encoding': 'gzip, deflate, br' if brotli else 'gzip, deflate',
+                        })
+                self.sessions[host] = session
+                self.stats[host] = HostStats()
+            return self.sessions[host]
+
+    def backoff_delay(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+        return min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def get(self, url, timeout=30, conditional=True):
+        """GET url and return an HttpResponse. A 304 comes back as a 200
+        with the cached content and not_modified set. The last exception is
+        raised if every attempt fails to connect.
+        """
+        logger = logging.getLogger(__name__ + '.' + 'HttpClient.get')
+        host = urllib.parse.urlsplit(url).netloc
+        session = self.session(host)
+        stats = self.stats[host]
+
+        headers = {}
+        with self.lock:
+            cached = self.cache.get(url) if conditional else None
+        if cached:
+            etag, last_modified, _ = cached
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        for attempt in range(self.retries + 1):
+            start = time.time()
+            try:
+                response = session.get(url, headers=headers, timeout=timeout)
+                content = response.content
+            except (requests.ConnectionError, requests.Timeout) as e:
+                with self.lock:
+                    stats.errors += 1
+                    stats.retries += attempt < self.retries
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff_delay(attempt)
+                logger.debug(f"GET {url} {type(e).__name__}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            elapsed = time.time() - start
+            # Content-Length is the compressed size when the body was compressed
+            wire_bytes = int(response.headers.get('Content-Length') or len(content))
+            with self.lock:
+                stats.requests += 1
+                stats.wire_bytes += wire_bytes
+                stats.content_bytes += len(content)
+                stats.seconds += elapsed
+            logger.debug(f"GET {url} {response.status_code} {wire_bytes}B ({len(content)}B decoded) {elapsed:.2f}s")
+            if response.status_code in retry_statuses and attempt < self.retries:
+                with self.lock:
+                    stats.retries += 1
+                delay = self.backoff_delay(attempt, response)
+                time.sleep(delay)
+                continue
+            break
+
+        if response.status_code == 304 and cached:
+            with self.lock:
+                stats.not_modified += 1
+            return HttpResponse(200, cached[2], response.headers, url, True)
+        if response.status_code == 200 and conditional:
+            self.remember(url, response.headers, content)
+        return HttpResponse(response.status_code, content, response.headers, url, False)
+
+    def remember(self, url, headers, content):
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        with self.lock:
+            old = self.cache.pop(url, None)
+            if old is not None:
+                self.cached_bytes -= len(old[2])
+            if (etag or last_modified) and len(content) <= self.cache_bytes:
+                self.cache[url] = (etag, last_modified, content)
+                self.cached_bytes += len(content)
+                while self.cached_bytes > self.cache_bytes:
+                    _, (_, _, evicted) = self.cache.popitem(last=False)
+                    self.cached_bytes -= len(evicted)
+
+    def report(self):
+        """Lines with the requests, bytes and time spent per host."""
+        with self.lock:
+            stats = sorted(self.stats.items())
+        return [
+                f"{host}: {host_stats.requests} requests, {host_stats.wire_bytes / 1e6:.2f}MB ({host_stats.content_bytes / 1e6:.2f}MB decoded), "
+                f"{host_stats.seconds:.1f}s, {host_stats.not_modified} not modified, {host_stats.retries} retries, {host_stats.errors} errors"
+                for host, host_stats in stats if host_stats.requests or host_stats.errors
+                ]
+
+
+def get_client():
+    """The process wide HttpClient."""
+    global client
+    with client_lock:
+        if client is None:
+            client = HttpClient()
+        return client
@@ -0,0 +1,252 @@
+"""Portfolio valuation over NumPy arrays.
+
+A port's transactions reduce to its lots (see port_lots): the cash put
+in, the gains realized by closed transactions, and the open positions as
+(quote symbol, shares, open price). Positions packs the lots of every
+port into flat arrays, and value() looks the symbols up once in a vector
+of quotes and totals cash, basis, gain, daygain and invested_total for
+all ports with grouped sums.
+
+    positions = Positions.from_transactions(transactions_by_port)
+    valuations = positions.value(finance_quotes)
+    valuations[fileportname_id]['invested_total']
+
+The arithmetic is decimal_valuation's (what put_totals.Port uses), in
+float64 rather than Decimal, and results are returned as Decimals rounded
+to the 4 places of the port_param columns.
+
+Lots only change when transactions do, so PositionSnapshot keeps them in
+a JSON file, each port tagged with the version it was built from (counts
+and sums the database computes, see put_totals.get_transaction_versions)
+and the digest of its transactions (see transactions_digest). Only ports
+whose version changed need their transactions read again. Now and then
+the digests are compared too, for edits a version misses. The same lots
+answer which ports hold a symbol (ports_holding), so a quote refresh can
+recompute just the ports it touched:
+
+    {"built": "2023-06-14T09:35:12", "checked": "2023-06-14T10:35:40",
+        "ports": {"12": {"version": "12|50|...", "digest": "9f2c...", "cash": "1000.0000",
+        "realized": "25.0000", "lots": [["AAPL", "10.0000", "150.0000"]]}}}
+"""
+
+import os
+import json
+import hashlib
+import logging
+from decimal import Decimal
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from decimal_valuation import valuation_fields, quote_symbol
+
+thisdir = os.path.dirname(__file__)
+default_snapshot_path = os.path.abspath(os.path.join(thisdir, 'port_positions.json'))
+
+# The transaction_list columns port_lots reads, all covered by the digest
+digest_columns = ('id', 'symbol', 'position', 'descriptor', 'closed', 'shares', 'open_price', 'close_price', 'expiration', 'strike')
+
+
+def to_decimal(value):
+    return Decimal(f"{value:.4f}")
+
+def port_lots(transactions):
+    """Reduce one port's transactions to {'cash': Decimal, 'realized':
+    Decimal, 'lots': [(quote symbol, shares, open_price)]}.
+    """
+    logger = logging.getLogger(__name__ + '.' + 'port_lots')
+    lots = {'cash': Decimal(0), 'realized': Decimal(0), 'lots': []}
+    for transaction in transactions:
+        if transaction.closed:
+            lots['realized'] += transaction.shares * (transaction.close_price - transaction.open_price)
+        elif transaction.position.lower() == 'cash':
+            lots['cash'] += transaction.open_price
+        elif transaction.position.lower() == 'long':
+            lots['lots'].append((quote_symbol(transaction), transaction.shares, transaction.open_price))
+        else:
+            logger.warning(f"Unhandled transaction id={transaction.id}")
+    return lots
+
+def transactions_digest(rows):
+    """sha1 hex digest of one port's rows, tuples of the digest_columns in id order."""
+    digest = hashlib.sha1()
+    for row in rows:
+        digest.update(repr(tuple(row)).encode())
+    return digest.hexdigest()
+
+
+class Positions(object):
+    """The lots of every port, packed for value()."""
+    def __init__(self, lots_by_port):
+        logger = logging.getLogger(__name__ + '.' + 'Positions')
+        self.port_ids = sorted(lots_by_port)
+        symbol_index = {}
+        position_ports, shares, open_prices, position_symbols = [], [], [], []
+        cash_in = []
+        for index, port_id in enumerate(self.port_ids):
+            lots = lots_by_port[port_id]
+            cash_in.append(float(lots['cash'] + lots['realized']))
+            for symbol, lot_shares, open_price in lots['lots']:
+                position_ports.append(index)
+                shares.append(float(lot_shares))
+                open_prices.append(float(open_price))
+                position_symbols.append(symbol_index.setdefault(symbol, len(symbol_index)))
+        self.symbols = list(symbol_index)
+        self.position_ports = np.array(position_ports, dtype=np.int64)
+        self.shares = np.array(shares, dtype=np.float64)
+        self.open_prices = np.array(open_prices, dtype=np.float64)
+        self.position_symbols = np.array(position_symbols, dtype=np.int64)
+        self.cash_in = np.array(cash_in, dtype=np.float64)
+        logger.debug(f"{len(self.port_ids)} ports, {len(self.shares)} open positions in {len(self.symbols)} symbols")
+
+    @classmethod
+    def from_transactions(cls, transactions_by_port):
+        return cls({port_id: port_lots(transactions) for port_id, transactions in transactions_by_port.items()})
+
+    def quote_vectors(self, finance_quotes):
+        """Arrays of last and net for self.symbols, and a mask of the
+        symbols that have a quote.
+        """
+        logger = logging.getLogger(__name__ + '.' + 'Positions.quote_vectors')
+        last = np.zeros(len(self.symbols))
+        net = np.zeros(len(self.symbols))
+        quoted = np.zeros(len(self.symbols), dtype=bool)
+        for index, symbol in enumerate(self.symbols):
+            finance_quote = finance_quotes.get(symbol)
+            if finance_quote is None or finance_quote.last is None or finance_quote.net is None:
+                logger.warning(f"Unable to find quote matching {symbol}")
+                continue
+            last[index] = finance_quote.last
+            net[index] = finance_quote.net
+            quoted[index] = True
+        return last, net, quoted
+
+    def value(self, finance_quotes):
+        """Return {fileportname_id: {field: Decimal}} for the valuation_fields."""
+        ports = len(self.port_ids)
+        last, net, quoted = self.quote_vectors(finance_quotes)
+        position_last = last[self.position_symbols]
+        position_net = net[self.position_symbols]
+        position_quoted = quoted[self.position_symbols]
+        cost = self.shares * self.open_prices
+
+        basis = np.bincount(self.position_ports, weights=cost, minlength=ports)
+        cash = self.cash_in - basis
+        # Positions without a quote count towards cash and basis only
+        quoted_ports = self.position_ports[position_quoted]
+        quoted_shares = self.shares[position_quoted]
+        gain = np.bincount(quoted_ports, weights=quoted_shares * (position_last - self.open_prices)[position_quoted], minlength=ports)
+        daygain = np.bincount(quoted_ports, weights=quoted_shares * position_net[position_quoted], minlength=ports)
+        invested_total = np.bincount(quoted_ports, weights=quoted_shares * position_last[position_quoted], minlength=ports)
+
+        totals = dict(zip(valuation_fields, (cash, basis, gain, daygain, invested_total)))
+        return {port_id: {field: to_decimal(totals[field][index]) for field in valuation_fields} for index, port_id in enumerate(self.port_ids)}
+
+
+class PositionSnapshot(object):
+    """Lots of every port, persisted with the transaction version and
+    digest each was built from. checked is when the digests were last
+    compared (see check_due). The whole snapshot is also rebuilt once it is
+    older than max_age, so it never outlives a change to port_lots itself.
+    """
+    def __init__(self, path=default_snapshot_path, max_age=timedelta(days=1)):
+        self.path = path
+        self.max_age = max_age
+        self.built = None
+        self.checked = None
+        self.ports = {}
+        self.symbol_ports = None  # {quote symbol: {fileportname_id}}, built by ports_holding
+        self.load()
+
+    def load(self):
+        logger = logging.getLogger(__name__ + '.' + 'PositionSnapshot.load')
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            self.built = datetime.fromisoformat(state['built'])
+            self.checked = datetime.fromisoformat(state['checked'])
+            self.ports = {
+                    int(port_id): {
+                        'version': port['version'],
+                        'digest': port['digest'],
+                        'cash': Decimal(port['cash']),
+                        'realized': Decimal(port['realized']),
+                        'lots': [(symbol, Decimal(shares), Decimal(open_price)) for symbol, shares, open_price in port['lots']],
+                        }
+                    for port_id, port in state['ports'].items()
+                    }
+        except FileNotFoundError:
+            self.built, self.checked, self.ports = None, None, {}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Unable to read {self.path}, starting empty: {e}")
+            self.built, self.checked, self.ports = None, None, {}
+        if self.expired():
+            logger.info(f"{self.path} was built {self.built}, rebuilding every port")
+            self.built, self.checked, self.ports = None, None, {}
+        self.symbol_ports = None
+
+    def expired(self):
+        return self.built is not None and datetime.now() - self.built > self.max_age
+
+    def check_due(self, check_age):
+        """True once the digests were last compared more than check_age ago."""
+        return self.checked is not None and datetime.now() - self.checked > check_age
+
+    def save(self):
+        logger = logging.getLogger(__name__ + '.' + 'PositionSnapshot.save')
+        state = {
+                'built': self.built.isoformat(timespec='seconds'),
+                'checked': self.checked.isoformat(timespec='seconds'),
+                'ports': {
+                    str(port_id): {
+                        'version': port['version'],
+                        'digest': port['digest'],
+                        'cash': str(port['cash']),
+                        'realized': str(port['realized']),
+                        'lots': [[symbol, str(shares), str(open_price)] for symbol, shares, open_price in port['lots']],
+                        }
+                    for port_id, port in sorted(self.ports.items())
+                    },
+                }
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(state, f, sort_keys=True)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            logger.warning(f"Unable to write {self.path}: {e}")
+
+    def stale_ports(self, versions, key='version'):
+        """Ports in versions ({fileportname_id: version}) whose snapshot is
+        missing or was built from another version. With key='digest',
+        versions holds digests.
+        """
+        return {port_id for port_id, version in versions.items() if port_id not in self.ports or self.ports[port_id][key] != version}
+
+    def update(self, versions, transactions_by_port):
+        """Rebuild the lots of the ports in transactions_by_port and drop
+        ports that are no longer in versions.
+        """
+        if self.built is None:
+            self.built = self.checked = datetime.now()
+        for port_id, transactions in transactions_by_port.items():
+            rows = (tuple(getattr(transaction, column) for column in digest_columns) for transaction in sorted(transactions, key=lambda transaction: transaction.id))
+            self.ports[port_id] = dict(port_lots(transactions), version=versions[port_id], digest=transactions_digest(rows))
+        for port_id in set(self.ports) - set(versions):
+            del self.ports[port_id]
+        self.symbol_ports = None
+
+    def ports_holding(self, symbols):
+        """fileportname_ids of the ports with an open lot in any of symbols."""
+        if self.symbol_ports is None:
+            self.symbol_ports = {}
+            for port_id, port in self.ports.items():
+                for symbol, _, _ in port['lots']:
+                    self.symbol_ports.setdefault(symbol, set()).add(port_id)
+        return set().union(*(self.symbol_ports.get(symbol, ()) for symbol in symbols))
+
+    def symbols(self, port_ids):
+        """Quote symbols of the open lots of port_ids."""
+        return {symbol for port_id in port_ids if port_id in self.ports for symbol, _, _ in self.ports[port_id]['lots']}
+
+    def lots_by_port(self):
+        return dict(self.ports)
@@ -6,13 +6,20 @@ import time as _time
 import logging
 import logging.handlers
 import argparse
+import itertools
 from decimal import Decimal
 from datetime import datetime, date, time, timedelta
 
-from sqlalchemy import create_engine, Table, MetaData, desc
+from sqlalchemy import create_engine, Table, MetaData, and_, func, case
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from finviz.screener import Screener
+from trading_calendar import TradingCalendar, default_cache_path
+import decimal_valuation
+try:
+    import port_valuation
+except ImportError:
+    port_valuation = None
 
 #############################################################################
 # This stuff needs to be done as globals
@@ -39,6 +46,8 @@ file_port_names = None  # TODO get rid of this global
 thisdir = os.path.dirname(__file__)
 arguments = argparse.Namespace
 logger = None
+trading_calendar = None # defined in main
+position_snapshot = None # port_valuation.PositionSnapshot, loaded by get_position_snapshot
 
 
 #############################################################################
@@ -126,30 +135,49 @@ class FilePortName(object):
         self.id_fpn_map = {fpn.id: f"{fpn.filename}:{fpn.portname}" for fpn in file_port_names}
 
 class PortHistory(object):
+    """port_history lookups shared by every Port. The latest rows as of a
+    date are read for all ports in one query, the first time any port asks
+    for that date. The query wants the (fileportname_id, date) index that
+    add_port_history_index.py creates.
+    """
     def __init__(self):
         logger = logging.getLogger(__name__ + '.' + 'PortHistory')
-        self.query = session.query(PortHistories)
+        self.latest_rows = {} # {latest_date: {fileportname_id: PortHistories}}
+
+    def get_latest_rows(self, latest_date):
+        """Return {fileportname_id: row} with each port's newest port_history
+        row dated latest_date or earlier.
+        """
+        logger = logging.getLogger(__name__ + '.' + 'PortHistory.get_latest_rows')
+        if latest_date not in self.latest_rows:
+            latest_dates = session.query(PortHistories.fileportname_id, func.max(PortHistories.date).label('date')).filter(PortHistories.date<=latest_date).group_by(PortHistories.fileportname_id).subquery()
+            query = session.query(PortHistories).join(latest_dates, and_(PortHistories.fileportname_id==latest_dates.c.fileportname_id, PortHistories.date==latest_dates.c.date))
+            self.latest_rows[latest_date] = {row.fileportname_id: row for row in query}
+            logger.debug(f"read {len(self.latest_rows[latest_date])} port_history rows for {latest_date}")
+        return self.latest_rows[latest_date]
 
     def get_total_cash(self, portname, days, data_date):
         """Return total and cash given a portname, days, data_date.
-        We use data_date as the starting point and subtract days from it.
-        Then we query port_history for dates less equal and return
-        the first entry in the list.
+        We use data_date as the starting point and step back days trading
+        days from it. Then we return the port's latest port_history row
+        dated on or before that day.
         """
         logger = logging.getLogger(__name__ + '.' + 'PortHistory.get_total_cash')
-        latest_date = data_date - timedelta(days=days)
-        port_histories = self.query.filter_by(fileportname_id=file_port_names.fpn_id_map[portname]).filter(PortHistories.date<=latest_date).order_by(desc(PortHistories.date)).all()
-        if len(port_histories) == 0:
+        latest_date = trading_calendar.trading_day_offset(data_date.date(), days)
+        port_history = self.get_latest_rows(latest_date).get(file_port_names.fpn_id_map[portname])
+        if port_history is None:
             logger.warning(f"called with portname={portname},days={days}, unable to match port_history")
             return Decimal(0)
-        logger.debug(f"called with portname={portname},days={days}, returning port_history for date={port_histories[0].date},total={port_histories[0].total},cash={port_histories[0].cash}")
-        return port_histories[0].total, port_histories[0].cash
+        logger.debug(f"called with portname={portname},days={days}, returning port_history for date={port_history.date},total={port_history.total},cash={port_history.cash}")
+        return port_history.total, port_history.cash
 
 class Port(object):
-    def __init__(self, portname, finance_quotes):
+    def __init__(self, portname, finance_quotes, port_history=None, transactions=None, valuation=None):
         logger = logging.getLogger(__name__ + '.' + 'Port')
         self.portname = portname
         self.fqs = finance_quotes
+        self.transactions = transactions
+        self.valuation = valuation
         self.cash = Decimal(0)
         self.basis = Decimal(0)
         self.invested_total = Decimal(0)
@@ -159,7 +187,7 @@ class Port(object):
             self.data_datetime = datetime.combine(self.fqs.get('^GSPC').date, self.fqs.get('^GSPC').time)
         except:
             self.data_datetime = datetime.now() + timedelta(days=1)
-        self.port_history = PortHistory()
+        self.port_history = port_history or PortHistory()
         self.initialize()
         logger.debug(str(self))
 
@@ -179,10 +207,20 @@ class Port(object):
                 )
 
     def initialize(self):
-        self.get_transactions()
-        self.parse_transactions()
+        if self.valuation is not None:
+            self.apply_valuation()
+        else:
+            self.get_transactions()
+            self.parse_transactions()
         self.calculate()
 
+    def apply_valuation(self):
+        """Take cash, basis, gain, daygain and invested_total from a
+        port_valuation result instead of parsing transactions.
+        """
+        for field, value in self.valuation.items():
+            setattr(self, field, value)
+
     def calculate(self):
         logger = logging.getLogger(__name__ + '.' + 'Port.calculate')
         # Init these attributes, then put calcs in try/except, bail if exception thrown.
@@ -201,57 +239,24 @@ class Port(object):
             logger.debug(f"Exception thrown in calculations for {self}")
 
     def get_transactions(self):
-        self.query = session.query(TransactionLists).filter_by(fileportname_id=file_port_names.fpn_id_map[self.portname]).all()
-
-    def parse_transactions(self):
-        logger = logging.getLogger(__name__ + '.' + 'Port.parse_transactions')
-        for transaction in self.query:
-            if transaction.closed:
-                self.handle_closed_transaction(transaction)
-            elif transaction.position.lower() == 'cash':
-                self.handle_cash_transaction(transaction)
-            elif transaction.position.lower() == 'long':
-                self.handle_open_position(transaction)
-            else:
-                logger.warning(f"Unhandled transaction id={transaction.id}")
-
-    def handle_closed_transaction(self, transaction):
-        self.cash += transaction.shares * (transaction.close_price - transaction.open_price)
-        if transaction.close_date == self.data_datetime.date:
-            fq = self.get_quote(transaction)
-            self.daygain += transaction.shares * (transaction.close_price - fq.close)
-
-    def handle_cash_transaction(self, transaction):
-        self.cash += transaction.open_price
-
-    def handle_open_position(self, transaction):
-        logger = logging.getLogger(__name__ + '.' + 'Port.handle_open_position')
-        self.cash -= transaction.shares * transaction.open_price
-        self.basis += transaction.shares * transaction.open_price
-        fq = self.get_quote(transaction)
-        if hasattr(fq, 'last'):
-            self.gain += transaction.shares * (fq.last - transaction.open_price)
-            self.daygain += transaction.shares * fq.net
-            self.invested_total += transaction.shares * fq.last
+        """Use the transactions given to the constructor, or query them."""
+        if self.transactions is not None:
+            self.query = self.transactions
         else:
-            logger.warning(f"Unable to find quote matching {fq}")
+            self.query = session.query(TransactionLists).filter_by(fileportname_id=file_port_names.fpn_id_map[self.portname]).all()
 
-
-    def get_quote(self, transaction):
-        symbol = transaction.symbol
-        if transaction.descriptor !=  'stock':
-            expiration = transaction.expiration.strftime("%y%m%d")
-            option = transaction.descriptor[0].upper()
-            strike = f"{int(transaction.strike * 1000):08d}"
-            symbol += expiration + option + strike
-        return self.fqs.get(symbol, symbol)
+    def parse_transactions(self):
+        """Value the transactions one at a time in Decimal, see decimal_valuation."""
+        self.valuation = decimal_valuation.value_transactions(self.query, self.fqs)
+        self.apply_valuation()
 
 
 
 class PortParamTable(object):
-    def __init__(self, ports):
+    def __init__(self, ports, port_count=None):
         logger = logging.getLogger(__name__ + '.' + 'PortParamTable')
         self.ports = ports
+        self.port_count = port_count or len(ports)
         self.port_params = self.query_port_param()
         self.handle_ports()
 
@@ -295,7 +300,7 @@ class PortParamTable(object):
                 gain=port.gain,
                 pct_invested=port.pct_invested,
                 basis=port.basis,
-                portnum=len(self.ports),
+                portnum=self.port_count,
                 )
         session.add(pp)
 
@@ -386,15 +391,117 @@ def get_option_symbols(query):
 
 def get_portnames():
     logger = logging.getLogger(__name__ + '.' + 'get_portnames')
-    query = session.query(TransactionLists).all()
-    #portname_set = set([row.fileportname for row in query])
     portname_set = set([fpn for fpn in file_port_names.fpn_id_map.keys() if not fpn.endswith('_combined')])
     return portname_set
 
-def get_finance_quotes():
+def date_number(column):
+    """A date column as a number the database can sum."""
+    if engine.dialect.name == 'mysql':
+        return func.to_days(column)
+    return func.julianday(column)
+
+def get_transaction_versions():
+    """Return {fileportname_id: version}, where version joins counts and
+    sums the database computes over the port's transaction_list rows: the
+    row count, the highest id, and sums weighted by id of closed, shares,
+    prices, strike, expiration and text lengths. Adding, removing or
+    closing a row, or changing a number in it, changes the version without
+    reading any rows here. Edits it can miss (ie. a symbol renamed to one
+    of the same length) are caught by the digests, see
+    get_transaction_digests.
+    """
+    id = TransactionLists.id
+    query = session.query(
+            TransactionLists.fileportname_id,
+            func.count(id),
+            func.max(id),
+            func.sum(case([(TransactionLists.closed == True, id)], else_=0)),
+            func.sum(id * TransactionLists.shares),
+            func.sum(id * TransactionLists.open_price),
+            func.sum(id * TransactionLists.close_price),
+            func.sum(id * TransactionLists.strike),
+            func.sum(id * date_number(TransactionLists.expiration)),
+            func.sum(id * (func.length(TransactionLists.symbol) + func.length(TransactionLists.position) + func.length(TransactionLists.descriptor))),
+            ).group_by(TransactionLists.fileportname_id)
+    return {row[0]: '|'.join(str(value) for value in row[1:]) for row in query}
+
+def get_transaction_digests():
+    """Return {fileportname_id: digest}, port_valuation.transactions_digest
+    of every column port_lots reads from the port's rows. It reads the
+    whole table, so it is only for the periodic check in
+    get_position_snapshot.
+    """
+    columns = [getattr(TransactionLists, column) for column in port_valuation.digest_columns]
+    query = session.query(TransactionLists.fileportname_id, *columns).order_by(TransactionLists.fileportname_id, TransactionLists.id)
+    return {fileportname_id: port_valuation.transactions_digest(row[1:] for row in rows)
+            for fileportname_id, rows in itertools.groupby(query.yield_per(1000), key=lambda row: row[0])}
+
+def get_transactions_by_port(fileportname_ids=None):
+    """Read transaction_list (limited to fileportname_ids if given) in one
+    streamed query and return {fileportname_id: [TransactionLists]}.
+    """
+    logger = logging.getLogger(__name__ + '.' + 'get_transactions_by_port')
+    transactions_by_port = {}
+    count = 0
+    query = session.query(TransactionLists)
+    if fileportname_ids is not None:
+        query = query.filter(TransactionLists.fileportname_id.in_(fileportname_ids))
+    for row in query.yield_per(1000):
+        transactions_by_port.setdefault(row.fileportname_id, []).append(row)
+        count += 1
+    logger.debug(f"read {count} transactions for {len(transactions_by_port)} ports")
+    return transactions_by_port
+
+def get_position_snapshot():
+    """Return the PositionSnapshot of --snapshot_file, with the ports whose
+    transaction version changed since it was saved rebuilt. Every
+    --snapshot_check_age hours the transaction digests are compared as
+    well. It is read from the file once and kept, until it is older than
+    --snapshot_max_age.
+    """
+    global position_snapshot
+    logger = logging.getLogger(__name__ + '.' + 'get_position_snapshot')
+    if position_snapshot is None or position_snapshot.expired():
+        position_snapshot = port_valuation.PositionSnapshot(arguments.snapshot_file, max_age=timedelta(hours=arguments.snapshot_max_age))
+    versions = get_transaction_versions()
+    stale_port_ids = position_snapshot.stale_ports(versions)
+    checking = position_snapshot.check_due(timedelta(hours=arguments.snapshot_check_age))
+    if checking:
+        digest_port_ids = position_snapshot.stale_ports(get_transaction_digests(), key='digest') - stale_port_ids
+        if digest_port_ids:
+            logger.warning(f"Transactions of {len(digest_port_ids)} ports changed without changing their version: {sorted(digest_port_ids)}")
+        stale_port_ids |= digest_port_ids
+        position_snapshot.checked = datetime.now()
+    logger.info(f"Rebuilding positions for {len(stale_port_ids)} of {len(versions)} ports")
+    if checking or stale_port_ids or set(position_snapshot.ports) - set(versions):
+        transactions_by_port = get_transactions_by_port(stale_port_ids) if stale_port_ids else {}
+        position_snapshot.update(versions, {port_id: transactions_by_port.get(port_id, []) for port_id in stale_port_ids})
+        position_snapshot.save()
+    return position_snapshot
+
+def get_valuations(finance_quotes, snapshot, fileportname_ids=None):
+    """Return {fileportname_id: valuation} for every port with transactions,
+    or only for fileportname_ids, from the lots of snapshot (the
+    PositionSnapshot get_position_snapshot returned).
+    """
+    lots_by_port = snapshot.lots_by_port()
+    if fileportname_ids is not None:
+        lots_by_port = {port_id: lots_by_port[port_id] for port_id in fileportname_ids if port_id in lots_by_port}
+    return port_valuation.Positions(lots_by_port).value(finance_quotes)
+
+def get_finance_quotes(symbols=None):
+    """Return {symbol: FinanceQuotes} for every quote, or only for symbols."""
     logger = logging.getLogger(__name__ + '.' + 'get_finance_quotes')
-    query = session.query(FinanceQuotes).all()
-    return {row.symbol: row for row in query}
+    if symbols is None:
+        query = session.query(FinanceQuotes).all()
+        return {row.symbol: row for row in query}
+    symbols = sorted(symbols)
+    finance_quotes = {}
+    for index in range(0, len(symbols), 500):
+        query = session.query(FinanceQuotes).filter(FinanceQuotes.symbol.in_(symbols[index:index + 500]))
+        finance_quotes.update({row.symbol: row for row in query})
+    logger.debug(f"read {len(finance_quotes)} of {len(symbols)} quotes")
+    return finance_quotes
 
 def get_symbols(fileportnames):
     logger = logging.getLogger(__name__ + '.' + 'get_symbols')
@@ -422,7 +529,7 @@ def get_symbols(fileportnames):
 #############################################################################
 # Argument processing
 #############################################################################
-def parse_arguments():
+def parse_arguments(args=None):
     global arguments
     logger = logging.getLogger(__name__ + '.' + 'parse_arguments')
     parser = argparse.ArgumentParser(
@@ -433,7 +540,11 @@ def parse_arguments():
     parser.add_argument('-d', '--debug', action='store_true', default=False, help="Run in debug mode")
     parser.add_argument('--skip_commit', action='store_true', default=False, help="Skip commit to databases")
     parser.add_argument('--delay', type=int, default=0, help="Seconds to delay before starting")
-    arguments = parser.parse_args()
+    parser.add_argument('--valuation', choices=('numpy', 'decimal'), default='numpy', help="Value all ports at once over numpy arrays, or each port transaction by transaction with Decimal, default=numpy")
+    parser.add_argument('--snapshot_file', default=os.path.join(thisdir, 'port_positions.json'), help="File keeping each port's cash and open lots between runs, for --valuation numpy")
+    parser.add_argument('--snapshot_check_age', type=float, default=1.0, help="Hours between comparisons of every port's transaction digest, for edits the cheap per-run version misses, default=1.0")
+    parser.add_argument('--snapshot_max_age', type=float, default=24.0, help="Hours before every port's lots are rebuilt from transaction_list regardless, default=24.0")
+    arguments = parser.parse_args(args)
     logger.debug("Arguments:")
     for arg, val in arguments.__dict__.items():
         logger.debug(f"{arg}={val}")
@@ -441,32 +552,68 @@ def parse_arguments():
 def process_arguments():
     global arguments
     logger = logging.getLogger(__name__ + '.' + 'process_arguments')
+    if arguments.valuation == 'numpy' and port_valuation is None:
+        logger.warning("numpy is not installed, valuing ports transaction by transaction")
+        arguments.valuation = 'decimal'
     logger.debug("Arguments:")
     for arg, val in arguments.__dict__.items():
         logger.debug(f"{arg}={val}")
 
 
-#############################################################################
-# Main
-#############################################################################
-def main():
+def update_totals(symbols=None):
+    """Recompute port_param and port_history from finance_quote. Given
+    symbols (ie. the quotes quote_query just changed), only the ports
+    holding one of them are recomputed, reading just the quotes they hold.
+    With --valuation decimal every port is recomputed regardless.
+    """
     global file_port_names  # TODO at some point get rid of this global
+    global trading_calendar
 
-    logger = logging.getLogger(__name__)
+    logger = logging.getLogger(__name__ + '.' + 'update_totals')
 
-    # Delay
-    delay_start()
+    # End the last read transaction, so quotes committed since are seen
+    session.rollback()
 
     # Get port_fileportname data
     file_port_names = FilePortName()
-
-    # Get finance_quote data
-    finance_quotes = get_finance_quotes()
-
-    # Get ports and create a dict of FilePortName objects
-    ports = {portname: Port(portname, finance_quotes) for portname in get_portnames()}
-
-    port_param_table = PortParamTable(ports)
+    portnames = get_portnames()
+    port_count = len(portnames)
+
+    # Trading days from market_holiday
+    if trading_calendar is None:
+        trading_calendar = TradingCalendar.from_session(session, MarketHolidays, cache_path=default_cache_path)
+
+    # Value the ports against finance_quote, from the saved lots of ports
+    # whose transactions haven't changed. With --valuation decimal each
+    # port parses its own transactions, read here all at once.
+    if arguments.valuation == 'numpy':
+        transactions_by_port = {}
+        snapshot = get_position_snapshot()
+        if symbols is None:
+            finance_quotes = get_finance_quotes()
+            valuations = get_valuations(finance_quotes, snapshot)
+        else:
+            port_ids = snapshot.ports_holding(symbols)
+            portnames = {file_port_names.id_fpn_map[port_id] for port_id in port_ids if port_id in file_port_names.id_fpn_map} & portnames
+            logger.info(f"{len(portnames)} of {port_count} ports hold one of {len(symbols)} changed quotes")
+            if not portnames:
+                return
+            port_ids = {file_port_names.fpn_id_map[portname] for portname in portnames}
+            finance_quotes = get_finance_quotes(snapshot.symbols(port_ids) | {'^GSPC'})
+            valuations = get_valuations(finance_quotes, snapshot, port_ids)
+    else:
+        finance_quotes = get_finance_quotes()
+        transactions_by_port = get_transactions_by_port()
+        valuations = {}
+
+    # Create a dict of Port objects, sharing one set of port_history lookups
+    port_history = PortHistory()
+    ports = {}
+    for portname in portnames:
+        fileportname_id = file_port_names.fpn_id_map[portname]
+        ports[portname] = Port(portname, finance_quotes, port_history, transactions_by_port.get(fileportname_id, []), valuations.get(fileportname_id))
+
+    port_param_table = PortParamTable(ports, port_count)
     port_param_table.commit()
 
     if arguments.debug:
@@ -475,6 +622,18 @@ def main():
     port_history_table.commit()
 
 
+#############################################################################
+# Main
+#############################################################################
+def main():
+    logger = logging.getLogger(__name__)
+
+    # Delay
+    delay_start()
+
+    update_totals()
+
+
 if __name__ == '__main__':
     configure_logging()
     parse_arguments()
@@ -0,0 +1,104 @@
+"""Compressed archive of raw quote pages.
+
+Pages are saved as <root>/<YYYY-MM-DD>/<kind>_<name>.html.gz (or .zst),
+the same <kind>_<name> naming bench_quote_parsers uses for saved pages.
+kind is index, mf, option or stock for yahoo quote pages, and chain for
+yahoo options pages, where name is <underlying>_<expiration>. A later
+fetch of the same page on the same day replaces the earlier one, so a
+day's directory holds the latest response for each page.
+
+    archive = QuoteArchive(default_archive_path)
+    archive.save('stock', 'AAPL', response.content)
+    for kind, name, path in archive.pages(date.today()):
+        content = read_page(path)
+
+zstd needs the zstandard package; without it pages are gzipped.
+"""
+
+import os
+import glob
+import gzip
+import logging
+from datetime import date
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+thisdir = os.path.dirname(__file__)
+default_archive_path = os.path.abspath(os.path.join(thisdir, 'quote_archive'))
+
+suffixes = {
+        'gzip': '.html.gz',
+        'zstd': '.html.zst',
+        'none': '.html',
+        }
+
+
+def compress(content, compression):
+    if compression == 'gzip':
+        return gzip.compress(content, compresslevel=6)
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor(level=10).compress(content)
+    return content
+
+def read_page(path):
+    """Return the decompressed content of an archived (or plain) page."""
+    with open(path, 'rb') as f:
+        content = f.read()
+    if path.endswith(suffixes['gzip']):
+        return gzip.decompress(content)
+    if path.endswith(suffixes['zstd']):
+        if zstandard is None:
+            raise RuntimeError(f"zstandard is needed to read {path}")
+        return zstandard.ZstdDecompressor().decompress(content)
+    return content
+
+def split_page_name(path):
+    """Return (kind, name) for a <kind>_<name>.html[.gz|.zst] path."""
+    filename = os.path.basename(path)
+    for suffix in suffixes.values():
+        if filename.endswith(suffix):
+            filename = filename[:-len(suffix)]
+            break
+    kind, name = filename.split('_', 1)
+    return kind, name
+
+
+class QuoteArchive(object):
+    def __init__(self, root=default_archive_path, compression='gzip'):
+        logger = logging.getLogger(__name__ + '.' + 'QuoteArchive')
+        if compression == 'zstd' and zstandard is None:
+            logger.warning("zstandard is not installed, archiving with gzip")
+            compression = 'gzip'
+        self.root = root
+        self.compression = compression
+
+    def day_path(self, day=None):
+        return os.path.join(self.root, (day or date.today()).isoformat())
+
+    def save(self, kind, name, content, day=None):
+        logger = logging.getLogger(__name__ + '.' + 'QuoteArchive.save')
+        day_path = self.day_path(day)
+        path = os.path.join(day_path, f"{kind}_{name}{suffixes[self.compression]}")
+        try:
+            os.makedirs(day_path, exist_ok=True)
+            with open(f"{path}.{os.getpid()}.tmp", 'wb') as f:
+                f.write(compress(content, self.compression))
+            os.replace(f"{path}.{os.getpid()}.tmp", path)
+        except OSError as e:
+            logger.warning(f"Unable to archive {path}: {e}")
+
+    def pages(self, day=None):
+        """List of (kind, name, path) for every page archived on day. If a
+        page was saved with more than one compression the newest wins.
+        """
+        newest = {}
+        for path in glob.glob(os.path.join(self.day_path(day), '*.html*')):
+            if path.endswith('.tmp'):
+                continue
+            kind, name = split_page_name(path)
+            if (kind, name) not in newest or os.path.getmtime(path) > os.path.getmtime(newest[(kind, name)]):
+                newest[(kind, name)] = path
+        return [(kind, name, path) for (kind, name), path in sorted(newest.items())]
@@ -0,0 +1,350 @@
+"""Extract quote fields from yahoo quote pages.
+
+The lookup_* functions in quote_query only need the company name (first
+h1), the last price span and the quote summary table cells. Each backend
+here returns those as a QuotePage, and the parse_* functions turn a
+QuotePage into the details dict FinanceQuoteTable expects.
+
+Backends:
+    soup     - full BeautifulSoup html.parser tree (the original path)
+    strainer - BeautifulSoup restricted with a SoupStrainer to the tags we read
+    lxml     - lxml.html tree queried with XPath (needs lxml installed)
+"""
+
+import re
+import logging
+from datetime import datetime
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+#############################################################################
+# Yahoo page descriptors
+#############################################################################
+company_descriptor = { 'tag': 'h1', }
+last_descriptor = { 'tag': 'span', 'attrs': {'class': "Trsdu(0.3s) Fw(b) Fz(36px) Mb(-4px) D(ib)"}, }
+table_descriptor = { 'tag': 'td', 'attrs': {"class": "Ta(end) Fw(600) Lh(14px)"}, }
+
+default_backend = 'soup'
+
+# OCC style contract symbols, ie. AAPL230616C00150000
+option_symbol_pattern = re.compile(r'^(?P<underlying>\D+)(?P<expiration>\d{6})(?P<option_char>[CP])(?P<strike>\d{8})$')
+
+# Columns of the calls/puts tables on a yahoo options page
+option_chain_columns = [
+        'contract', 'last_trade_date', 'strike', 'last', 'bid', 'ask',
+        'change', 'p_change', 'volume', 'open_interest', 'implied_volatility',
+        ]
+
+#############################################################################
+# Classes
+#############################################################################
+class QuotePage(object):
+    """The parts of a yahoo quote page the lookups use.
+    company and last are the text of the first h1 and the last price span
+    (None if missing). cells is a list of (cell_text, span_text) tuples for
+    the summary table, where span_text is the text of the first span in
+    the cell (None if it has none).
+    """
+    def __init__(self, company, last, cells):
+        self.company = company
+        self.last = last
+        self.cells = cells
+
+    def __eq__(self, other):
+        return (self.company, self.last, self.cells) == (other.company, other.last, other.cells)
+
+    def __repr__(self):
+        return f"QuotePage(company={self.company!r},last={self.last!r},cells={len(self.cells)})"
+
+    def required(self, value, what):
+        if value is None:
+            raise ValueError(f"quote page has no {what}")
+        return value
+
+    def company_text(self):
+        return self.required(self.company, 'company')
+
+    def last_float(self):
+        return float(self.required(self.last, 'last price').replace(',', ''))
+
+    def cell_text(self, index):
+        return self.cells[index][0]
+
+    def span_text(self, index):
+        return self.required(self.cells[index][1], f"span in cell {index}")
+
+    def span_float(self, index):
+        return float(self.span_text(index).replace(',', ''))
+
+#############################################################################
+# Backends
+#############################################################################
+def soup_page(page_content):
+    """Build a QuotePage from a BeautifulSoup tree."""
+    elem = page_content.find(company_descriptor['tag'])
+    company = elem.text if elem is not None else None
+    elem = page_content.find(last_descriptor['tag'], attrs=last_descriptor['attrs'])
+    last = elem.text if elem is not None else None
+    cells = []
+    for elem in page_content.find_all(table_descriptor['tag'], attrs=table_descriptor['attrs']):
+        span = elem.find('span')
+        cells.append((elem.text, span.text if span is not None else None))
+    return QuotePage(company, last, cells)
+
+def parse_soup(content):
+    return soup_page(BeautifulSoup(content, "html.parser"))
+
+# Only the tags soup_page reads are built; everything else is skipped.
+strainer_tags = [company_descriptor['tag'], last_descriptor['tag'], table_descriptor['tag']]
+
+def parse_strainer(content):
+    return soup_page(BeautifulSoup(content, "html.parser", parse_only=SoupStrainer(strainer_tags)))
+
+def parse_lxml(content):
+    import lxml.html
+    tree = lxml.html.fromstring(content)
+    elems = tree.xpath(f"//{company_descriptor['tag']}")
+    company = elems[0].text_content() if elems else None
+    elems = tree.xpath(f"//{last_descriptor['tag']}[@class=$cls]", cls=last_descriptor['attrs']['class'])
+    last = elems[0].text_content() if elems else None
+    cells = []
+    for elem in tree.xpath(f"//{table_descriptor['tag']}[@class=$cls]", cls=table_descriptor['attrs']['class']):
+        span = elem.find('.//span')
+        cells.append((elem.text_content(), span.text_content() if span is not None else None))
+    return QuotePage(company, last, cells)
+
+backends = {
+        'soup': parse_soup,
+        'strainer': parse_strainer,
+        'lxml': parse_lxml,
+        }
+
+def parse_quote_page(content, backend=None):
+    """Return a QuotePage for content using backend.
+    If a fast backend raises or can't find the last price, the page is
+    parsed again with the full BeautifulSoup backend.
+    """
+    logger = logging.getLogger(__name__ + '.' + 'parse_quote_page')
+    backend = backend or default_backend
+    if backend != 'soup':
+        try:
+            page = backends[backend](content)
+            if page.last is not None:
+                return page
+            logger.debug(f"{backend} backend found no last price, falling back to soup")
+        except Exception as e:
+            logger.debug(f"{backend} backend raised {type(e).__name__}: {e}, falling back to soup")
+    return parse_soup(content)
+
+def chain_rows_soup(content):
+    page_content = BeautifulSoup(content, "html.parser", parse_only=SoupStrainer('tr'))
+    return [[elem.text for elem in row.find_all('td')] for row in page_content.find_all('tr')]
+
+def chain_rows_lxml(content):
+    import lxml.html
+    tree = lxml.html.fromstring(content)
+    return [[elem.text_content() for elem in row.xpath('./td')] for row in tree.xpath('//tr')]
+
+def parse_option_chain(content, backend=None):
+    """Return {contract symbol: {column: text}} for every contract row in
+    the calls and puts tables of a yahoo options page.
+    """
+    logger = logging.getLogger(__name__ + '.' + 'parse_option_chain')
+    rows = None
+    if (backend or default_backend) == 'lxml':
+        try:
+            rows = chain_rows_lxml(content)
+        except Exception as e:
+            logger.debug(f"lxml backend raised {type(e).__name__}: {e}, falling back to soup")
+    if rows is None:
+        rows = chain_rows_soup(content)
+
+    option_chain = {}
+    for cells in rows:
+        cells = [cell.strip() for cell in cells]
+        if len(cells) >= len(option_chain_columns) and option_symbol_pattern.match(cells[0]):
+            option_chain[cells[0]] = dict(zip(option_chain_columns, cells))
+    return option_chain
+
+def split_option_symbol(symbol):
+    """Return (underlying, expiration date, 'call'|'put', strike) for a contract symbol."""
+    match = option_symbol_pattern.match(symbol)
+    if match is None:
+        raise ValueError(f"{symbol} is not an option contract symbol")
+    expiration = datetime.strptime(match.group('expiration'), "%y%m%d").date()
+    descriptor = 'call' if match.group('option_char') == 'C' else 'put'
+    strike = int(match.group('strike')) / 1000.0
+    return match.group('underlying'), expiration, descriptor, strike
+
+def chain_float(text):
+    """Options tables show '-' for no value."""
+    try:
+        return float(text.replace(',', '').replace('%', ''))
+    except ValueError:
+        return 0.0
+
+#############################################################################
+# Details dicts
+#############################################################################
+def parse_index(symbol, page):
+    l_company = page.company_text()
+    l_last = page.last_float()
+    l_previous_close = page.span_float(0)
+    l_open = page.span_float(1)
+    l_volume = page.span_text(2)
+    l_day_range = page.cell_text(3)
+    l_year_range = page.cell_text(4)
+    l_avg_volume = page.span_text(5)
+
+    l_change = l_last - l_previous_close
+
+    return_dict = {
+            'Ticker': symbol,
+            'Company': l_company,
+            'Price': l_last,
+            'Prev Close': l_previous_close,
+            'Change': f"{(l_change / l_previous_close) * 100.0:.2f}",
+            'Volume': l_volume,
+            'Avg Volume': l_avg_volume,
+            '52W Range': l_year_range,
+            'Day Range': l_day_range,
+            'EPS (ttm)': 0.0,
+            'P/E': 0.0,
+            'Dividend': 0.0,
+            'Dividend %': "0.0%",
+            'Market Cap': "0",
+            }
+
+    return return_dict
+
+def parse_mf(symbol, page):
+    l_company = page.company_text()
+    l_last = page.last_float()
+    l_previous_close = page.span_float(0)
+    l_change = l_last - l_previous_close
+    return_dict = {
+            'Ticker': symbol,
+            'Company': l_company,
+            'Price': l_last,
+            'Prev Close': l_previous_close,
+            'Change': f"{(l_change / l_previous_close) * 100.0:.2f}",
+            'Volume': "0",
+            'Avg Volume': "0",
+            '52W Range': "'0.00 - 0.00'",
+            'Day Range': "'0.00 - 0.00'",
+            'EPS (ttm)': 0.0,
+            'P/E': 0.0,
+            'Dividend': 0.0,
+            'Dividend %': "0.0%",
+            'Market Cap': "0",
+            }
+
+    return return_dict
+
+def parse_option(symbol, page):
+    l_company = page.company_text()
+    l_last = page.last_float()
+    l_previous_close = page.span_float(0)
+    l_bid = page.span_float(2)
+    l_ask = page.span_float(3)
+    l_day_range = page.cell_text(6)
+    l_volume = page.span_text(8)
+    l_change = l_last - l_previous_close
+    return_dict = {
+            'Ticker': symbol,
+            'Company': l_company,
+            'Price': l_last,
+            'Prev Close': l_previous_close,
+            'Change': f"{(l_change / l_previous_close) * 100.0:.2f}",
+            'Volume': f"{l_volume}",
+            'Avg Volume': "0",
+            '52W Range': "'0.00 - 0.00'",
+            'Day Range': f"'{l_day_range}'",
+            'EPS (ttm)': 0.0,
+            'P/E': 0.0,
+            'Dividend': 0.0,
+            'Dividend %': "0.0%",
+            'Market Cap': "0",
+            'Bid': l_bid,
+            'Ask': l_ask,
+            }
+    return return_dict
+
+def parse_option_chain_row(symbol, row):
+    """Details dict for one contract row from parse_option_chain, with the
+    same keys parse_option returns. Previous close is worked back from last
+    and change. The chain has no day range, so 'Day Range' is left out and
+    FinanceQuoteTable tracks high/low from last as it does for finviz rows.
+    """
+    underlying, expiration, descriptor, strike = split_option_symbol(symbol)
+    l_company = f"{underlying} {expiration.strftime('%b %Y')} {strike:.3f} {descriptor} ({symbol})"
+    l_last = chain_float(row['last'])
+    l_change = chain_float(row['change'])
+    l_previous_close = l_last - l_change
+    l_bid = chain_float(row['bid'])
+    l_ask = chain_float(row['ask'])
+    l_volume = row['volume'] if row['volume'] not in ('', '-') else "0"
+    l_p_change = (l_change / l_previous_close) * 100.0 if l_previous_close else 0.0
+    return_dict = {
+            'Ticker': symbol,
+            'Company': l_company,
+            'Price': l_last,
+            'Prev Close': l_previous_close,
+            'Change': f"{l_p_change:.2f}",
+            'Volume': f"{l_volume}",
+            'Avg Volume': "0",
+            '52W Range': "'0.00 - 0.00'",
+            'EPS (ttm)': 0.0,
+            'P/E': 0.0,
+            'Dividend': 0.0,
+            'Dividend %': "0.0%",
+            'Market Cap': "0",
+            'Bid': l_bid,
+            'Ask': l_ask,
+            }
+    return return_dict
+
+def parse_stock(symbol, page):
+    logger = logging.getLogger(__name__ + '.' + 'parse_stock')
+    try:
+        l_last = page.last_float()
+        l_previous_close = page.span_float(0)
+    except:
+        logger.warning(f"Unable to get good yahoo fetch for {symbol}")
+        return {}
+
+    l_company = page.company_text()
+    l_open = page.span_float(1)
+    l_day_range = page.cell_text(4)
+    l_year_range = page.cell_text(5)
+    l_volume = page.span_text(6)
+    l_avg_volume = page.span_text(7)
+
+    l_change = l_last - l_previous_close
+
+    return_dict = {
+            'Ticker': symbol,
+            'Company': l_company,
+            'Price': l_last,
+            'Prev Close': l_previous_close,
+            'Change': f"{(l_change / l_previous_close) * 100.0:.2f}",
+            'Volume': l_volume,
+            'Avg Volume': l_avg_volume,
+            '52W Range': l_year_range,
+            'Day Range': l_day_range,
+            'EPS (ttm)': 0.0,
+            'P/E': 0.0,
+            'Dividend': 0.0,
+            'Dividend %': "0.0%",
+            'Market Cap': "0",
+            }
+
+    return return_dict
+
+parsers = {
+        'index': parse_index,
+        'mf': parse_mf,
+        'option': parse_option,
+        'stock': parse_stock,
+        }
+
@@ -0,0 +1,291 @@
+"""Quote providers with latency tracking and hedged requests.
+
+A provider turns (kind, symbol) into a details dict, where kind is one of
+index, mf, option or stock (see quote_parsers.parsers). Every lookup is
+timed, and each provider keeps a window of recent latencies and its
+success rate.
+
+HedgedFetcher tries the providers for a kind in order. If the first one
+hasn't answered by its p95 latency, the next one is started too and the
+first good answer wins. A provider that fails outright is followed by the
+next one immediately.
+
+    fetcher = HedgedFetcher([YahooProvider('in.finance.yahoo.com'), FinvizProvider()])
+    details = fetcher.fetch('stock', 'AAPL', timeout=30)
+"""
+
+import os
+import time
+import logging
+import threading
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import quote_parsers
+from http_client import get_client
+from rate_limiter import RateLimitTimeout
+
+# finance_quote columns read from a details dict that finviz may leave out
+finviz_defaults = {
+        'Company': None,
+        'Prev Close': None,
+        'Change': '0.00%',
+        'Volume': '0',
+        'Avg Volume': '0',
+        '52W Range': '- - -',
+        'EPS (ttm)': '-',
+        'P/E': '-',
+        'Dividend': '-',
+        'Dividend %': '-',
+        'Market Cap': '-',
+        }
+
+
+class LatencyStats(object):
+    """Latencies of the last window successful lookups plus success and
+    failure counts.
+    """
+    def __init__(self, window=200):
+        self.latencies = deque(maxlen=window)
+        self.successes = 0
+        self.failures = 0
+        self.hedges = 0
+        self.lock = threading.Lock()
+
+    def record(self, seconds, success):
+        with self.lock:
+            if success:
+                self.successes += 1
+                self.latencies.append(seconds)
+            else:
+                self.failures += 1
+
+    def percentile(self, fraction):
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(round(fraction * (len(latencies) - 1))))]
+
+    @property
+    def p50(self):
+        return self.percentile(0.50)
+
+    @property
+    def p95(self):
+        return self.percentile(0.95)
+
+    @property
+    def samples(self):
+        return len(self.latencies)
+
+    @property
+    def success_rate(self):
+        total = self.successes + self.failures
+        return self.successes / total if total else None
+
+
+class Provider(object):
+    """Base of the quote providers. A provider sets name (for reports and
+    the rate limiter), kinds (the kinds it can look up) and host, and
+    defines get_details(kind, symbol, timeout), which returns a details
+    dict, or {} or raises if there is no quote. Callers go through
+    lookup(), which times get_details.
+    """
+    name = None
+    kinds = ()
+    host = None
+    rate_limiter = None  # a rate_limiter.RateLimiter, set by the caller
+    metrics = None  # a run_metrics.RunMetrics, set by the caller
+
+    def __init__(self):
+        self.stats = LatencyStats()
+
+    def lookup(self, kind, symbol, timeout=30):
+        """Timed get_details. Returns {} if the lookup fails. The rate
+        limiter wait comes out of timeout.
+        """
+        logger = logging.getLogger(__name__ + '.' + 'Provider.lookup')
+        # Time spent waiting on the rate limiter isn't provider latency.
+        if self.rate_limiter is not None:
+            try:
+                timeout -= self.rate_limiter.acquire(self.name, timeout=timeout)
+            except RateLimitTimeout as e:
+                logger.debug(f"{self.name} not tried for {kind} {symbol}: {e}")
+                return {}
+        start = time.time()
+        try:
+            details = self.get_details(kind, symbol, timeout)
+        except Exception as e:
+            logger.debug(f"{self.name} raised {type(e).__name__} for {kind} {symbol}: {e}")
+            details = {}
+        self.stats.record(time.time() - start, bool(details))
+        return details
+
+    def summary(self):
+        stats = self.stats
+        if stats.success_rate is None:
+            return f"{self.name}: no requests"
+        latency = f"p50={stats.p50:.2f}s p95={stats.p95:.2f}s" if stats.samples else "p50=- p95=-"
+        return f"{self.name}: {stats.successes + stats.failures} requests, {stats.success_rate:.0%} ok, {latency}, {stats.hedges} hedged"
+
+    def parse(self, kind, symbol, content):
+        """Parse a yahoo quote page, timed separately from the fetch."""
+        start = time.time()
+        page = quote_parsers.parse_quote_page(content, self.backend)
+        details = quote_parsers.parsers[kind](symbol, page)
+        if self.metrics is not None:
+            self.metrics.observe('parse_seconds', time.time() - start, kind=kind)
+        return details
+
+
+class YahooProvider(Provider):
+    """Scrape the yahoo quote page for a symbol. If archive (a
+    quote_archive.QuoteArchive) is given, every page fetched is saved to it.
+    """
+    name = 'yahoo'
+    kinds = ('index', 'mf', 'option', 'stock')
+
+    def __init__(self, host, backend=None, archive=None):
+        super().__init__()
+        self.host = host
+        self.backend = backend
+        self.archive = archive
+
+    def get_details(self, kind, symbol, timeout):
+        logger = logging.getLogger(__name__ + '.' + 'YahooProvider.get_details')
+        request = f"//{self.host}/quote/{symbol}?p={symbol}"
+        url = urllib.parse.quote(request)
+        response = get_client().get("https:" + url, timeout=timeout)
+        if response.status_code != 200:
+            logger.warning(f"yahoo fetch bad response for {symbol}")
+            return {}
+        if self.archive is not None:
+            self.archive.save(kind, symbol, response.content)
+        return self.parse(kind, symbol, response.content)
+
+
+class FinvizProvider(Provider):
+    """finviz.get_stock for a single stock symbol."""
+    name = 'finviz'
+    kinds = ('stock',)
+    host = 'finviz.com'
+
+    def get_details(self, kind, symbol, timeout):
+        import finviz
+        details = dict(finviz.get_stock(symbol))
+        for key, value in finviz_defaults.items():
+            details.setdefault(key, value)
+        details['Ticker'] = symbol
+        details['Company'] = details['Company'] or symbol
+        details['Prev Close'] = details['Prev Close'] or details['Price']
+        return details
+
+
+class LocalProvider(Provider):
+    """Saved yahoo quote pages named <kind>_<symbol>.html, read from a
+    directory or from under an http(s) URL. Stands in for yahoo in tests
+    and offline runs.
+    """
+    name = 'local'
+    kinds = ('index', 'mf', 'option', 'stock')
+
+    def __init__(self, source, backend=None):
+        super().__init__()
+        self.source = source
+        self.backend = backend
+        self.host = urllib.parse.urlsplit(source).netloc or 'localhost'
+
+    def get_details(self, kind, symbol, timeout):
+        filename = f"{kind}_{symbol}.html"
+        if self.source.startswith(('http://', 'https://')):
+            response = get_client().get(f"{self.source.rstrip('/')}/{urllib.parse.quote(filename)}", timeout=timeout)
+            if response.status_code != 200:
+                return {}
+            content = response.content
+        else:
+            path = os.path.join(self.source, filename)
+            if not os.path.exists(path):
+                return {}
+            with open(path, 'rb') as f:
+                content = f.read()
+        return self.parse(kind, symbol, content)
+
+
+class HedgedFetcher(object):
+    """Fetch from the first provider that handles a kind, hedging with the
+    next one once the current one is slower than its p95.
+    Until a provider has min_samples latencies, hedge_after seconds is used
+    in place of its p95.
+    """
+    def __init__(self, providers, hedge_after=5.0, min_samples=20, max_workers=16):
+        logger = logging.getLogger(__name__ + '.' + 'HedgedFetcher')
+        self.providers = providers
+        self.hedge_after = hedge_after
+        self.min_samples = min_samples
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = set()
+        logger.debug(f"providers={[provider.name for provider in providers]},hedge_after={hedge_after},min_samples={min_samples}")
+
+    def providers_for(self, kind):
+        return [provider for provider in self.providers if kind in provider.kinds]
+
+    def hedge_delay(self, provider):
+        if provider.stats.samples < self.min_samples:
+            return self.hedge_after
+        return provider.stats.p95
+
+    def fetch(self, kind, symbol, timeout=30):
+        """Return the first non-empty details dict, or {} if every provider
+        failed or timeout seconds passed. Each lookup is given what is left
+        of timeout, so a hedge doesn't outlast it.
+        """
+        logger = logging.getLogger(__name__ + '.' + 'HedgedFetcher.fetch')
+        providers = self.providers_for(kind)
+        if not providers:
+            raise ValueError(f"No quote provider handles {kind}")
+        deadline = time.time() + timeout
+        pending = {}
+        next_provider = 0
+        while pending or next_provider < len(providers):
+            if not pending:
+                # Nothing in flight (or everything failed), go to the next provider now.
+                provider = providers[next_provider]
+                pending[self.submit(provider, kind, symbol, max(0.0, deadline - time.time()))] = provider
+                next_provider += 1
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if next_provider < len(providers):
+                remaining = min(remaining, self.hedge_delay(providers[next_provider - 1]))
+            done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.pop(future)
+                details = future.result()
+                if details:
+                    return details
+            if not done and next_provider < len(providers) and time.time() < deadline:
+                slow_provider = providers[next_provider - 1]
+                provider = providers[next_provider]
+                slow_provider.stats.hedges += 1
+                logger.debug(f"{slow_provider.name} slow for {symbol}, hedging with {provider.name}")
+                pending[self.submit(provider, kind, symbol, deadline - time.time())] = provider
+                next_provider += 1
+        return {}
+
+    def report(self):
+        return [provider.summary() for provider in self.providers]
+
+    def submit(self, provider, kind, symbol, timeout):
+        future = self.executor.submit(provider.lookup, kind, symbol, timeout)
+        self.futures.add(future)
+        future.add_done_callback(self.futures.discard)
+        return future
+
+    def running(self):
+        """Lookups still in flight, ie. abandoned past their timeout."""
+        return [future for future in list(self.futures) if not future.done()]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -6,17 +6,31 @@ import time as _time
 import logging
 import logging.handlers
 import argparse
+import threading
+import queue
+import calendar
+import fcntl
+from collections import deque
 from datetime import datetime, date, time, timedelta
+from decimal import Decimal
+import dateparser
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeoutError
 
-from sqlalchemy import create_engine, Table, MetaData
+from sqlalchemy import create_engine, Table, MetaData, func, select, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from finviz.screener import Screener
 
 import urllib.parse
-import requests
-from bs4 import BeautifulSoup
 import get_a_quote
+import http_client
+import quote_parsers
+import quote_providers
+from quote_archive import QuoteArchive, default_archive_path, read_page
+from trading_calendar import TradingCalendar, default_cache_path
+from symbol_quarantine import SymbolQuarantine, default_quarantine_path
+from rate_limiter import RateLimiter, RateLimitTimeout, add_rate_arguments
+from run_metrics import RunMetrics
 
 #############################################################################
 # This stuff needs to be done as globals
@@ -43,6 +57,26 @@ file_port_names = None  # TODO get rid of this global
 thisdir = os.path.dirname(__file__)
 arguments = argparse.Namespace
 logger = None
+fetch_engine = None # defined in main
+trading_calendar = None # defined in main
+quarantine = None # defined in main
+hedged_fetcher = None # defined in main
+quote_archive = None # defined in main when --archive or --reparse
+symbol_priorities = {} # {symbol: market value at risk}, see get_symbol_priorities
+rate_limiter = None # defined in main
+chunk_sizer = None # defined in main
+totals_updater = None # defined in main with --update_totals
+screener_futures = set() # Screener chunks left running at the deadline
+run_deadline = None # time.time() by which the run must finish, set in main from --deadline
+run_lock = None # held for the life of the process, see acquire_run_lock
+metrics = RunMetrics('quote_query') # phase timings, latencies and counters, see export_metrics
+yahoo_host = 'in.finance.yahoo.com'
+staging_table_name = 'finance_quote_staging'
+# pull_transaction_report checks these before anything else, so they are always fetched first
+priority_symbols = ('^GSPC',)
+# finance_quote columns compared to decide whether a refreshed quote changed
+# anything. date and time are left out, they change on every fetch.
+fingerprint_columns = ('symbol', 'name', 'last', 'high', 'low', 'net', 'p_change', 'volume', 'avg_vol', 'bid', 'ask', 'close', 'day_range', 'year_range', 'eps', 'pe', 'dividend', 'div_yield', 'cap')
 
 #############################################################################
 # Logging Configuration
@@ -115,117 +149,506 @@ class FilePortName(object):
 
 
 class FinanceQuoteTable(object):
-    def __init__(self, data_datetime, market_closed, details_list, details_type):
+    def __init__(self, data_datetime, market_closed, details_list, details_type, db_session=None):
         logger = logging.getLogger(__name__ + '.' + 'FinanceQuoteTable')
         self.data_datetime = data_datetime
         self.market_closed = market_closed
         logger.debug(f"details_list for {len(details_list)} {details_type} symbols")
         self.details_list = details_list
         self.details_type = details_type
+        self.session = db_session or session
+        self.changed_symbols = []
+        self.unchanged_symbols = []
+        self.skipped = 0
 
     def __str__(self):
         return f"FinanceQuoteTable() with {len(details_list)} stock symbols"
 
     def delete_table_rows(self):
         logger = logging.getLogger(__name__ + '.' + 'FinanceQuoteTable.delete_table_rows')
-        deleted_rows = session.query(FinanceQuotes).delete()
+        deleted_rows = self.session.query(FinanceQuotes).delete()
         logger.debug(f"Deleting {deleted_rows} rows from finance_quote table.")
-        session.commit()
+        self.session.commit()
+
+    def finance_quote_row(self, details):
+        """Return a dict of finance_quote columns for one details dict.
+        The high, low and day_range columns depend on any existing row, so
+        they are filled in by apply_day_range.
+        """
+        last = try_float(details['Price'])
+        close = try_float(details['Prev Close'])
+        if self.market_closed:
+            pass
+
+        bid=0.0
+        if 'Bid' in details:
+            bid = try_float(details['Bid'], except_value=0.0)
+        ask=0.0
+        if 'Ask' in details:
+            ask = try_float(details['Ask'], except_value=0.0)
+
+        return {
+                'symbol': details['Ticker'],
+                'name': details['Company'][:32],
+                'last': last,
+                'date': self.data_datetime.date(),
+                'time': self.data_datetime.time(),
+                'net': last - close,
+                'p_change': try_float(details['Change'][:-1]),
+                'volume': int(details['Volume'].replace(',', '')),
+                'avg_vol': try_float(details['Avg Volume'], method='magnitude'),
+                'close': close,
+                'year_range': f"'{details['52W Range']}'",
+                'eps': try_float(details['EPS (ttm)']),
+                'pe': try_float(details['P/E'], except_value=0.0),
+                'dividend': try_float(details['Dividend'], except_value=0.0),
+                'div_yield': try_float(details['Dividend %'], method='pct', except_value=0.0),
+                'cap': try_float(details['Market Cap'], method='magnitude', except_value=0.0),
+                'bid': bid,
+                'ask': ask,
+                }
+
+    def apply_day_range(self, row, details, high=None, low=None):
+        """Fill in day_range (and high/low for new rows) on row.
+        Pass high/low from the existing finance_quote row when there is one.
+        Without a 'Day Range' in details, the existing high/low are widened
+        to include last and day_range is built from them.
+        """
+        last = row['last']
+        if high is None and low is None:
+            row['high'] = last
+            row['low'] = last
+            if 'Day Range' in details:
+                row['day_range'] = f"'{details['Day Range']}'"
+            else:
+                row['day_range'] = f"'{last:.2f} - {last:.2f}'"
+        elif 'Day Range' in details:
+            row['day_range'] = f"'{details['Day Range']}'"
+        else:
+            if high < last:
+                high = last
+                row['high'] = high
+            if low > last:
+                low = last
+                row['low'] = low
+            row['day_range'] = f"'{low:.2f} - {high:.2f}'"
+        return row
 
     def update_finance_quote_table(self):
         logger = logging.getLogger(__name__ + '.' + 'FinanceQuoteTable.update_finance_quote_table')
+        if arguments.bulk:
+            return self.bulk_update_finance_quote_table()
+
         for details in self.details_list:
             symbol = details['Ticker']
-            last = try_float(details['Price'])
-            close = try_float(details['Prev Close'])
-            if self.market_closed:
-                pass
-            net = last - close
-            p_change = try_float(details['Change'][:-1])
-            volume = int(details['Volume'].replace(',', ''))
-            eps = try_float(details['EPS (ttm)'])
-            pe = try_float(details['P/E'], except_value=0.0)
-            dividend = try_float(details['Dividend'], except_value=0.0)
-            div_yield = try_float(details['Dividend %'], method='pct', except_value=0.0)
-            cap = try_float(details['Market Cap'], method='magnitude', except_value=0.0)
-
-            bid=0.0
-            if 'Bid' in details:
-                bid = try_float(details['Bid'], except_value=0.0)
-            ask=0.0
-            if 'Ask' in details:
-                ask = try_float(details['Ask'], except_value=0.0)
-        
+            row = self.finance_quote_row(details)
+
             # we have to check for existing row
-            query = session.query(FinanceQuotes).filter_by(symbol=symbol).all()
+            query = self.session.query(FinanceQuotes).filter_by(symbol=symbol).all()
             if query:
                 # We have an existing row, let's update it
-                logger.debug(f"updating finance_quote row for {symbol}")
                 fq = query[0]
-                fq.symbol=symbol
-                fq.name=details['Company'][:32]
-                fq.last=last
-                fq.date=self.data_datetime.date()
-                fq.time=self.data_datetime.time()
-                fq.net=net
-                fq.p_change=p_change
-                fq.volume=volume
-                fq.avg_vol=try_float(details['Avg Volume'], method='magnitude')
-                fq.close=close
-                fq.year_range=f"'{details['52W Range']}'"
-                fq.eps=eps
-                fq.pe=pe
-                fq.dividend=dividend
-                fq.div_yield=div_yield
-                fq.cap=cap
-                fq.bid=bid
-                fq.ask=ask
-        
-                if 'Day Range' in details:
-                    fq.day_range=f"'{details['Day Range']}'"
-                else:
-                    if fq.high < last:
-                        fq.high = last
-                    
-                    if fq.low > last:
-                        fq.low = last
-                    
-                    fq.day_range=f"'{fq.low:.2f} - {fq.high:.2f}'"
+                self.apply_day_range(row, details, high=fq.high, low=fq.low)
+                existing = {column: getattr(fq, column) for column in fingerprint_columns}
+                if not quote_changed(existing, row):
+                    logger.debug(f"finance_quote row for {symbol} unchanged")
+                    self.unchanged_symbols.append(symbol)
+                    self.skipped += 1
+                    continue
+                logger.debug(f"updating finance_quote row for {symbol}")
+                for column, value in row.items():
+                    setattr(fq, column, value)
 
             else:
                 # We are creating a new row
                 logger.debug(f"creating finance_quote row for {symbol}")
-                if 'Day Range' in details:
-                    day_range = f"'{details['Day Range']}'"
+                self.apply_day_range(row, details)
+                fq = FinanceQuotes(**row)
+                self.session.add(fq)
+            self.changed_symbols.append(symbol)
+
+        self.touch_unchanged_rows()
+        self.session.commit()
+
+    def bulk_update_finance_quote_table(self):
+        """Same result as update_finance_quote_table, but existing rows for
+        the whole batch are read in one query and written back with
+        bulk_update_mappings/bulk_insert_mappings.
+        """
+        logger = logging.getLogger(__name__ + '.' + 'FinanceQuoteTable.bulk_update_finance_quote_table')
+        # Later details for the same symbol win, as they would with the ORM path.
+        details_by_symbol = {details['Ticker']: details for details in self.details_list}
+        existing_quotes = get_existing_quotes(details_by_symbol.keys(), db_session=self.session)
+
+        update_rows = []
+        insert_rows = []
+        for symbol, details in details_by_symbol.items():
+            row = self.finance_quote_row(details)
+            if symbol in existing_quotes:
+                existing = existing_quotes[symbol]
+                self.apply_day_range(row, details, high=existing['high'], low=existing['low'])
+                if not quote_changed(existing, row):
+                    self.unchanged_symbols.append(symbol)
+                    self.skipped += 1
+                    continue
+                update_rows.append(row)
+            else:
+                insert_rows.append(self.apply_day_range(row, details))
+            self.changed_symbols.append(symbol)
+
+        logger.debug(f"updating {len(update_rows)}, creating {len(insert_rows)}, skipping {self.skipped} unchanged finance_quote rows for {self.details_type}")
+        self.session.bulk_update_mappings(FinanceQuotes, update_rows)
+        self.session.bulk_insert_mappings(FinanceQuotes, insert_rows)
+        self.touch_unchanged_rows()
+        self.session.commit()
+
+    def touch_unchanged_rows(self):
+        """Set date/time on the rows skipped as unchanged, so their age
+        (see get_stale_symbols) counts from this fetch. One UPDATE per 500
+        symbols rather than a full row write each.
+        """
+        for index in range(0, len(self.unchanged_symbols), 500):
+            query = self.session.query(FinanceQuotes).filter(FinanceQuotes.symbol.in_(self.unchanged_symbols[index:index + 500]))
+            query.update({FinanceQuotes.date: self.data_datetime.date(), FinanceQuotes.time: self.data_datetime.time()}, synchronize_session=False)
+
+    def insert_staging_rows(self, staging_table):
+        """Insert the batch into staging_table as new rows (one executemany).
+        Symbols already staged by an earlier batch are replaced.
+        """
+        logger = logging.getLogger(__name__ + '.' + 'FinanceQuoteTable.insert_staging_rows')
+        details_by_symbol = {details['Ticker']: details for details in self.details_list}
+        rows = [self.apply_day_range(self.finance_quote_row(details), details) for details in details_by_symbol.values()]
+        logger.debug(f"staging {len(rows)} finance_quote rows for {self.details_type}")
+        self.session.execute(staging_table.delete().where(staging_table.c.symbol.in_(list(details_by_symbol.keys()))))
+        self.session.execute(staging_table.insert(), rows)
+        self.session.commit()
+        self.changed_symbols.extend(details_by_symbol.keys())
+
+
+class FetchEngine(object):
+    """Runs lookup_* functions on a thread pool.
+    Concurrency is capped per host with a semaphore, and each request is
+    given a deadline. Symbols that fail or miss their deadline are logged
+    and left out of the results.
+    """
+    def __init__(self, max_workers, max_per_host, deadline):
+        logger = logging.getLogger(__name__ + '.' + 'FetchEngine')
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.deadline = deadline
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = set()
+        self.host_semaphores = {}
+        self.lock = threading.Lock()
+        logger.debug(f"max_workers={max_workers},max_per_host={max_per_host},deadline={deadline}")
+
+    def host_semaphore(self, host):
+        with self.lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self.host_semaphores[host]
+
+    def run_lookup(self, lookup, symbol, host):
+        with self.host_semaphore(host):
+            start = _time.time()
+            result = lookup(symbol, timeout=limit_timeout(self.deadline))
+            key = symbol if isinstance(symbol, str) else ' '.join(str(part) for part in symbol)
+            metrics.observe('fetch_seconds', _time.time() - start, key=key, kind=lookup_kind(lookup))
+            return result
+
+    def fetch_results(self, lookup, symbols, host=yahoo_host, on_result=None):
+        """Return {symbol: result} for every symbol whose lookup returned
+        something. symbols can be any hashable keys lookup accepts.
+        If on_result is given it is called with (symbol, result) as each
+        lookup finishes, and results are not kept.
+        """
+        logger = logging.getLogger(__name__ + '.' + 'FetchEngine.fetch_results')
+        futures = {self.executor.submit(self.run_lookup, lookup, symbol, host): symbol for symbol in symbols}
+        for future in futures:
+            self.futures.add(future)
+            future.add_done_callback(self.futures.discard)
+        # Requests to one host run in waves of max_per_host, each wave bounded by the deadline.
+        waves = -(-len(futures) // min(self.max_per_host, self.max_workers))
+        results = {}
+        try:
+            for future in as_completed(futures, timeout=limit_timeout(waves * self.deadline)):
+                symbol = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.warning(f"{lookup.__name__} raised {type(e).__name__} for {symbol}: {e}")
+                    metrics.count('fetch_failures', kind=lookup_kind(lookup))
+                    continue
+                if result and on_result is not None:
+                    on_result(symbol, result)
+                elif result:
+                    results[symbol] = result
                 else:
-                    day_range = f"'{last:.2f} - {last:.2f}'"
-
-                fq = FinanceQuotes(
-                    symbol=symbol,
-                    name=details['Company'][:32],
-                    last=last,
-                    high=last,
-                    low=last,
-                    date=self.data_datetime.date(),
-                    time=self.data_datetime.time(),
-                    net=net,
-                    p_change=p_change,
-                    volume=volume,
-                    avg_vol=try_float(details['Avg Volume'], method='magnitude'),
-                    close=close,
-                    year_range=f"'{details['52W Range']}'",
-                    eps=eps,
-                    pe=pe,
-                    dividend=dividend,
-                    div_yield=div_yield,
-                    cap=cap,
-                    day_range=day_range,
-                    bid=bid,
-                    ask=ask,
-                    )
-                session.add(fq)
-
-        session.commit()
+                    logger.warning(f"Unable to fetch details for {symbol}")
+                    metrics.count('fetch_failures', kind=lookup_kind(lookup))
+        except FuturesTimeoutError:
+            for future, symbol in futures.items():
+                if not future.done():
+                    future.cancel()
+                    logger.warning(f"Deadline exceeded fetching details for {symbol}")
+                    metrics.count('fetch_deadline_exceeded', kind=lookup_kind(lookup))
+        return results
+
+    def fetch(self, lookup, symbols, host=yahoo_host, writer=None, details_type=None):
+        """Return a list of details dicts, one per symbol that was fetched.
+        With a writer, each details dict is put on it as it arrives instead.
+        """
+        if writer is not None:
+            self.fetch_results(lookup, symbols, host=host, on_result=lambda symbol, details: writer.put(details_type, [details]))
+            return []
+        return list(self.fetch_results(lookup, symbols, host=host).values())
+
+    def running(self):
+        """Lookups still in flight, ie. abandoned past their deadline."""
+        return [future for future in list(self.futures) if not future.done()]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ChunkSizer(object):
+    """Additive increase, multiplicative decrease of the Screener chunk
+    size. A chunk that comes back within target_seconds grows the size by
+    step, a chunk that fails or is slower than that sets it to half that
+    chunk's size, so chunks started together and failing together only
+    halve it once. Only fresh chunks are recorded; the halves of a failed
+    chunk say where the bad symbol is, not how big chunks should be. The
+    size stays between min_size and max_size, and carries over from one
+    update_stocks call (and cycle) to the next.
+    """
+    def __init__(self, max_size, min_size=5, step=10, target_seconds=30.0):
+        logger = logging.getLogger(__name__ + '.' + 'ChunkSizer')
+        self.max_size = max_size
+        self.min_size = min(min_size, max_size)
+        self.step = step
+        self.target_seconds = target_seconds
+        self.size = max_size
+        self.lock = threading.Lock()
+        logger.debug(f"max_size={max_size},min_size={min_size},step={step},target_seconds={target_seconds}")
+
+    def record(self, chunk_size, seconds, success):
+        logger = logging.getLogger(__name__ + '.' + 'ChunkSizer.record')
+        with self.lock:
+            if success and seconds <= self.target_seconds:
+                self.size = min(self.max_size, self.size + self.step)
+            else:
+                self.size = max(self.min_size, min(self.size, chunk_size // 2))
+            logger.debug(f"{chunk_size} symbols {'ok' if success else 'failed'} in {seconds:.1f}s, chunk size now {self.size}")
+
+
+class QuoteWriter(object):
+    """Write-behind stage between the fetchers and finance_quote.
+    Fetchers put details dicts on a bounded queue; one thread with its own
+    session takes them off and commits them in batches of up to batch_size,
+    or whatever has arrived after batch_wait seconds. A full queue blocks
+    the fetchers until the writer catches up.
+    With staging=True (--clean) batches go to a staging table instead, and
+    close() swaps it in for finance_quote in one step.
+    If the thread fails outside a batch (ie. creating or swapping in the
+    staging table) it discards the rest of the queue, and close() logs and
+    counts the error rather than raising it into the caller's finally.
+    written_symbols holds only symbols whose batch committed.
+    """
+    def __init__(self, data_datetime, market_closed, max_queued, batch_size, batch_wait, staging=False):
+        logger = logging.getLogger(__name__ + '.' + 'QuoteWriter')
+        self.data_datetime = data_datetime
+        self.market_closed = market_closed
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.staging = staging
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.written_symbols = set()
+        self.tracked_symbols = set()
+        self.written = 0
+        self.batches = 0
+        self.skipped = 0
+        self.changed_symbols = set()
+        self.start_time = None
+        self.first_commit = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='QuoteWriter', daemon=True)
+        logger.debug(f"max_queued={max_queued},batch_size={batch_size},batch_wait={batch_wait},staging={staging}")
+
+    def start(self):
+        self.start_time = _time.time()
+        self.thread.start()
+        return self
+
+    def put(self, details_type, details_list):
+        for details in details_list:
+            self.queue.put((details_type, details))
+
+    def run(self):
+        logger = logging.getLogger(__name__ + '.' + 'QuoteWriter.run')
+        db_session = Session()
+        staging_table = None
+        item = ()
+        try:
+            if self.staging:
+                staging_table = create_staging_table(db_session)
+            batch = []
+            batch_start = None
+            while True:
+                timeout = None if not batch else max(0.0, batch_start + self.batch_wait - _time.time())
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = ()
+                if item:
+                    if not batch:
+                        batch_start = _time.time()
+                    batch.append(item)
+                if batch and (item is None or len(batch) >= self.batch_size or _time.time() >= batch_start + self.batch_wait):
+                    self.write_batch(db_session, batch, staging_table)
+                    batch = []
+                if item is None:
+                    break
+            if staging_table is not None and self.written:
+                swap_staging_table(db_session, staging_table, self.tracked_symbols - self.written_symbols)
+                if totals_updater is not None:
+                    totals_updater.put(self.changed_symbols)
+        except Exception as e:
+            logger.exception(f"Writer failed: {e}")
+            self.error = e
+            db_session.rollback()
+            if self.staging:
+                # Nothing staged reaches finance_quote
+                self.written_symbols.clear()
+            # Keep taking items off the queue so the fetchers never block on it
+            while item is not None:
+                item = self.queue.get()
+        finally:
+            if staging_table is not None:
+                try:
+                    staging_table.drop(bind=db_session.connection(), checkfirst=True)
+                    db_session.commit()
+                except Exception as e:
+                    logger.exception(f"Unable to drop {staging_table_name}: {e}")
+                    self.error = self.error or e
+            db_session.close()
+
+    def write_batch(self, db_session, batch, staging_table=None):
+        logger = logging.getLogger(__name__ + '.' + 'QuoteWriter.write_batch')
+        details_lists = {}
+        for details_type, details in batch:
+            details_lists.setdefault(details_type, []).append(details)
+        batch_start = _time.time()
+        for details_type, details_list in details_lists.items():
+            try:
+                finance_quote_table = FinanceQuoteTable(self.data_datetime, self.market_closed, details_list, details_type, db_session=db_session)
+                if staging_table is None:
+                    finance_quote_table.update_finance_quote_table()
+                else:
+                    finance_quote_table.insert_staging_rows(staging_table)
+            except Exception as e:
+                logger.exception(f"Unable to write {len(details_list)} {details_type} rows: {e}")
+                db_session.rollback()
+                metrics.count('write_failures', len(details_list), kind=details_type)
+                continue
+            self.written += len(details_list)
+            self.written_symbols.update(details['Ticker'] for details in details_list)
+            self.skipped += finance_quote_table.skipped
+            self.changed_symbols.update(finance_quote_table.changed_symbols)
+            if staging_table is None and totals_updater is not None:
+                totals_updater.put(finance_quote_table.changed_symbols)
+            metrics.count('rows_changed', len(finance_quote_table.changed_symbols), kind=details_type)
+            metrics.count('rows_skipped', finance_quote_table.skipped, kind=details_type)
+        metrics.observe('write_batch_seconds', _time.time() - batch_start)
+        self.batches += 1
+        if self.first_commit is None:
+            self.first_commit = _time.time()
+
+    def close(self, tracked_symbols=()):
+        """Write whatever is still queued and stop the writer thread.
+        With staging, existing finance_quote rows for tracked_symbols that
+        weren't written are carried over into the new table.
+        """
+        logger = logging.getLogger(__name__ + '.' + 'QuoteWriter.close')
+        self.tracked_symbols = set(tracked_symbols)
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            # Already logged by run(), the next cycle starts over with a new writer
+            logger.error(f"Writer failed, finance_quote not fully updated: {type(self.error).__name__} {self.error}")
+            metrics.count('writer_failures')
+        if self.first_commit is not None:
+            logger.info(f"Wrote {self.written} finance_quote rows in {self.batches} batches, first commit after {self.first_commit - self.start_time:.1f}s")
+            logger.info(f"{len(self.changed_symbols)} rows changed, {self.skipped} unchanged rows skipped")
+
+class TotalsUpdater(object):
+    """Recomputes port_param and port_history (put_totals.update_totals)
+    for the ports holding the symbols whose quotes changed. QuoteWriter
+    puts the changed symbols of each committed batch; one thread folds
+    everything queued since its last update into the next one, so totals
+    trail quotes by an update rather than by a put_totals cron interval.
+    Which ports hold a symbol comes from put_totals' position snapshot,
+    kept in --snapshot_file between runs and in memory between updates.
+    """
+    def __init__(self):
+        logger = logging.getLogger(__name__ + '.' + 'TotalsUpdater')
+        # put_totals sets up its own engine and tables when imported, so
+        # it's only imported by runs that update totals.
+        import put_totals
+        self.put_totals = put_totals
+        self.queue = queue.Queue()
+        self.updates = 0
+        self.thread = threading.Thread(target=self.run, name='TotalsUpdater', daemon=True)
+        put_totals.parse_arguments([])
+        put_totals.process_arguments()
+        # put_totals logs alongside quote_query
+        put_totals_logger = logging.getLogger(put_totals.__name__)
+        put_totals_logger.setLevel(logging.DEBUG)
+        for handler in logging.getLogger(__name__).handlers:
+            put_totals_logger.addHandler(handler)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def put(self, symbols):
+        if symbols:
+            self.queue.put(set(symbols))
+
+    def run(self):
+        logger = logging.getLogger(__name__ + '.' + 'TotalsUpdater.run')
+        closing = False
+        while not closing:
+            symbols = set()
+            item = self.queue.get()
+            while True:
+                if item is None:
+                    closing = True
+                else:
+                    symbols.update(item)
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            if not symbols:
+                continue
+            update_start = _time.time()
+            try:
+                self.put_totals.update_totals(symbols)
+            except Exception as e:
+                logger.exception(f"Unable to update totals for {len(symbols)} changed quotes: {e}")
+                self.put_totals.session.rollback()
+                metrics.count('totals_update_failures')
+                continue
+            self.updates += 1
+            metrics.observe('totals_update_seconds', _time.time() - update_start)
+
+    def close(self):
+        """Finish the updates still queued and stop the thread."""
+        logger = logging.getLogger(__name__ + '.' + 'TotalsUpdater.close')
+        self.queue.put(None)
+        self.thread.join()
+        logger.info(f"Updated totals {self.updates} times")
+        metrics.count('totals_updates', self.updates)
 
 #############################################################################
 # Function definitions
@@ -236,32 +659,194 @@ def check_date_market_holidays():
     market_closed = False
     if today.isoweekday() >= 6:
         market_closed = True
-        data_datetime -= timedelta(days=today.isoweekday() - 5)
-
-    query = session.query(MarketHolidays).filter_by(date=data_datetime.date()).all()
-    while query or data_datetime.isoweekday() >= 6:
-        data_datetime -= timedelta(days=1)
-        query = session.query(MarketHolidays).filter_by(date=data_datetime.date()).all()
 
-    if data_datetime.date() != today.date():
-        data_datetime = datetime.combine(data_datetime.date(), time(16, 30))
+    trading_day = trading_calendar.previous_trading_day(today.date(), inclusive=True)
+    if trading_day != today.date():
+        data_datetime = datetime.combine(trading_day, time(16, 30))
     return data_datetime, market_closed
 
+def is_market_closed(day):
+    """True for weekends and days listed in market_holiday."""
+    return not trading_calendar.is_open(day)
+
 def delay_start():
     logger = logging.getLogger(__name__ + '.' + 'delay_start')
     if arguments.delay:
         logger.info(f"Delaying start for {arguments.delay} seconds...")
         _time.sleep(arguments.delay)
 
+def limit_timeout(timeout=None):
+    """timeout (None for no limit), cut down to what is left before --deadline."""
+    if run_deadline is None:
+        return timeout
+    remaining = max(0.0, run_deadline - _time.time())
+    return remaining if timeout is None else min(timeout, remaining)
+
+def deadline_passed():
+    return run_deadline is not None and _time.time() >= run_deadline
+
+def acquire_run_lock(lock_file):
+    """Take an exclusive lock on lock_file so that overlapping cron runs
+    exit instead of competing for the database. Returns False if another
+    quote_query holds it.
+    """
+    global run_lock
+    logger = logging.getLogger(__name__ + '.' + 'acquire_run_lock')
+    run_lock = open(lock_file, 'a+')
+    try:
+        fcntl.flock(run_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        run_lock.seek(0)
+        logger.warning(f"{lock_file} is held by pid {run_lock.read().strip() or '?'}, exiting")
+        run_lock.close()
+        run_lock = None
+        return False
+    run_lock.seek(0)
+    run_lock.truncate()
+    run_lock.write(f"{os.getpid()}\n")
+    run_lock.flush()
+    return True
+
+def release_run_lock():
+    global run_lock
+    if run_lock is not None:
+        fcntl.flock(run_lock, fcntl.LOCK_UN)
+        run_lock.close()
+        run_lock = None
+
+def exit_within_deadline():
+    """With --deadline, once everything fetched is committed, end the
+    process without joining worker threads still stuck in a request (a
+    Screener call or a provider lookup can't be interrupted). Idle pool
+    workers exit on their own, so only futures still running force the
+    exit. The lock is released first so the next run can start.
+    """
+    logger = logging.getLogger(__name__ + '.' + 'exit_within_deadline')
+    stuck = fetch_engine.running() + hedged_fetcher.running() + [future for future in screener_futures if not future.done()]
+    release_run_lock()
+    if stuck:
+        logger.warning(f"Exiting without waiting for {len(stuck)} requests still running")
+        logging.shutdown()
+        os._exit(0)
+
+def get_existing_quotes(symbols, db_session=None):
+    """Return {symbol: {column: value}} of the fingerprint_columns for
+    symbols already in finance_quote. Symbols are queried in chunks to stay
+    under the bound parameter limit.
+    """
+    db_session = db_session or session
+    symbols = list(symbols)
+    columns = [getattr(FinanceQuotes, column) for column in fingerprint_columns]
+    existing = {}
+    for index in range(0, len(symbols), 500):
+        query = db_session.query(*columns).filter(FinanceQuotes.symbol.in_(symbols[index:index + 500]))
+        existing.update({row.symbol: dict(zip(fingerprint_columns, row)) for row in query})
+    return existing
+
+def quote_fingerprint(row):
+    """Tuple of the fingerprint_columns of row (a dict), with numbers
+    rounded to the scale of their finance_quote column, so a value reads
+    the same before and after a round trip through the database.
+    """
+    values = []
+    for column in fingerprint_columns:
+        value = row.get(column)
+        if isinstance(value, (float, int, Decimal)):
+            scale = getattr(FinanceQuotes.__table__.c[column].type, 'scale', None)
+            value = round(float(value), 4 if scale is None else scale)
+        values.append(value)
+    return tuple(values)
+
+def quote_changed(existing, row):
+    """True if writing row over existing (dicts of finance_quote columns)
+    would change any of the fingerprint_columns.
+    """
+    return quote_fingerprint(dict(existing, **row)) != quote_fingerprint(existing)
+
+def create_staging_table(db_session):
+    """(Re)create an empty finance_quote_staging table and return it."""
+    logger = logging.getLogger(__name__ + '.' + 'create_staging_table')
+    staging_table = FinanceQuotes.__table__.tometadata(MetaData(), name=staging_table_name)
+    staging_table.drop(bind=db_session.connection(), checkfirst=True)
+    if engine.dialect.name == 'mysql':
+        db_session.execute(text(f"CREATE TABLE {staging_table_name} LIKE finance_quote"))
+    else:
+        staging_table.create(bind=db_session.connection())
+    db_session.commit()
+    logger.debug(f"created {staging_table_name}")
+    return staging_table
+
+def swap_staging_table(db_session, staging_table, keep_symbols):
+    """Replace the contents of finance_quote with staging_table.
+    Rows for keep_symbols are first copied over from finance_quote. On
+    MySQL the tables are exchanged with one atomic RENAME; elsewhere the
+    delete and copy happen in a single transaction. Either way readers see
+    the old table or the new one, never an empty or partial one.
+    """
+    logger = logging.getLogger(__name__ + '.' + 'swap_staging_table')
+    finance_quote_table = FinanceQuotes.__table__
+    columns = [column.name for column in finance_quote_table.columns]
+    keep_symbols = sorted(keep_symbols)
+    for index in range(0, len(keep_symbols), 500):
+        keep_rows = select([finance_quote_table.c[column] for column in columns]).where(finance_quote_table.c.symbol.in_(keep_symbols[index:index + 500]))
+        db_session.execute(staging_table.insert().from_select(columns, keep_rows))
+    db_session.commit()
+    logger.info(f"Swapping in {staging_table_name}, kept {len(keep_symbols)} unfetched symbols")
+
+    if engine.dialect.name == 'mysql':
+        db_session.execute(text(f"RENAME TABLE finance_quote TO finance_quote_old, {staging_table_name} TO finance_quote, finance_quote_old TO {staging_table_name}"))
+    else:
+        db_session.execute(finance_quote_table.delete())
+        db_session.execute(finance_quote_table.insert().from_select(columns, select([staging_table.c[column] for column in columns])))
+    db_session.commit()
+
+def get_quote_datetimes(symbols):
+    """Return {symbol: datetime} from finance_quote date/time for symbols
+    that already have a row.
+    """
+    symbols = list(symbols)
+    quote_datetimes = {}
+    for index in range(0, len(symbols), 500):
+        query = session.query(FinanceQuotes.symbol, FinanceQuotes.date, FinanceQuotes.time).filter(FinanceQuotes.symbol.in_(symbols[index:index + 500]))
+        quote_datetimes.update({row.symbol: datetime.combine(row.date, row.time) for row in query if row.date is not None and row.time is not None})
+    return quote_datetimes
+
+def get_stale_symbols(symbols, clean):
+    """Given the (stock, mf, index, option) symbol sets, return the same
+    sets limited to symbols whose finance_quote row is older than the
+    class TTL (--stock_ttl, --mf_ttl, --index_ttl, --option_ttl).
+    A TTL of 0 (or --clean) means every symbol of that class is fetched.
+    """
+    logger = logging.getLogger(__name__ + '.' + 'get_stale_symbols')
+    if clean:
+        return symbols
+
+    ttls = (arguments.stock_ttl, arguments.mf_ttl, arguments.index_ttl, arguments.option_ttl)
+    symbols_to_check = set()
+    for class_symbols, ttl in zip(symbols, ttls):
+        if ttl > 0:
+            symbols_to_check.update(class_symbols)
+    quote_datetimes = get_quote_datetimes(symbols_to_check)
+
+    now = datetime.now()
+    stale_symbols = []
+    for details_type, class_symbols, ttl in zip(('stock', 'mf', 'index', 'option'), symbols, ttls):
+        if ttl > 0:
+            class_stale_symbols = {symbol for symbol in class_symbols if symbol not in quote_datetimes or (now - quote_datetimes[symbol]).total_seconds() >= ttl}
+            logger.debug(f"{len(class_stale_symbols)} of {len(class_symbols)} {details_type} symbols are older than {ttl}s")
+        else:
+            class_stale_symbols = set(class_symbols)
+        stale_symbols.append(class_stale_symbols)
+    return tuple(stale_symbols)
+
+def get_option_symbol(row):
+    expiration_year_month_date = row.expiration.strftime("%y%m%d")
+    option_char = 'C' if row.descriptor == 'call' else 'P'
+    strike_formatted = f"{int(row.strike * 1000):08d}"
+    return f"{row.symbol}{expiration_year_month_date}{option_char}{strike_formatted}"
+
 def get_option_symbols(query):
-    symbol_set = set()
-    for row in query:
-        expiration_year_month_date = row.expiration.strftime("%y%m%d")
-        option_char = 'C' if row.descriptor == 'call' else 'P'
-        strike_formatted = f"{int(row.strike * 1000):08d}"
-        symbol = f"{row.symbol}{expiration_year_month_date}{option_char}{strike_formatted}"
-        symbol_set.add(symbol)
-    return symbol_set
+    return set([get_option_symbol(row) for row in query])
 
 def get_portnames():
     logger = logging.getLogger(__name__ + '.' + 'get_portnames')
@@ -269,6 +854,32 @@ def get_portnames():
     portname_set = set([file_port_names.id_fpn_map[row.fileportname_id] for row in query])
     return portname_set
 
+def get_symbols_fingerprint():
+    """Return a cheap summary of the open transaction_list positions and
+    the ticker_symbols. The database groups the open rows into one row per
+    port, symbol and option terms with their total shares, so it changes
+    when a position is opened, closed, reopened, renamed or resized, or
+    when the ticker symbols change, which is when get_symbols needs to run
+    again. Closed rows aren't read.
+    """
+    query = session.query(
+            TransactionLists.fileportname_id,
+            TransactionLists.symbol,
+            TransactionLists.descriptor,
+            TransactionLists.expiration,
+            TransactionLists.strike,
+            func.sum(TransactionLists.shares),
+            ).filter_by(closed=False).group_by(
+            TransactionLists.fileportname_id,
+            TransactionLists.symbol,
+            TransactionLists.descriptor,
+            TransactionLists.expiration,
+            TransactionLists.strike,
+            )
+    positions = sorted(repr(tuple(row)) for row in query)
+    ticker_symbols = sorted(row.symbol for row in session.query(TickerSymbols.symbol))
+    return tuple(positions), tuple(ticker_symbols)
+
 def get_symbols(fileportnames):
     logger = logging.getLogger(__name__ + '.' + 'get_symbols')
     fileportname_ids = set([file_port_names.fpn_id_map[fpn] for fpn in fileportnames])
@@ -292,194 +903,90 @@ def get_symbols(fileportnames):
     logger.debug(f"option_symbols({len(option_symbols)})={sorted(list(option_symbols))}")
     return stock_symbols, mf_symbols, index_symbols, option_symbols
 
-def lookup_index(symbol):
-    company_descriptor = { 'tag': 'h1', }
-    last_descriptor = { 'tag': 'span', 'attrs': {'class': "Trsdu(0.3s) Fw(b) Fz(36px) Mb(-4px) D(ib)"}, }
-    table_descriptor = { 'tag': 'td', 'attrs': {"class": "Ta(end) Fw(600) Lh(14px)"}, }
-    request = f"//in.finance.yahoo.com/quote/{symbol}?p={symbol}"
+def get_symbol_priorities(fileportnames):
+    """Return {symbol: market value at risk} over the open transaction_list
+    rows of fileportnames, valued at the finance_quote last price (or the
+    open price if there is no quote yet). priority_symbols come first.
+    Symbols only on the ticker bar aren't included, so they come last.
+    """
+    logger = logging.getLogger(__name__ + '.' + 'get_symbol_priorities')
+    fileportname_ids = set([file_port_names.fpn_id_map[fpn] for fpn in fileportnames])
+    query = session.query(TransactionLists).filter_by(closed=False).filter(TransactionLists.fileportname_id.in_(fileportname_ids)).filter(TransactionLists.descriptor.in_(('stock', 'call', 'put')))
+    positions = [(row.symbol if row.descriptor == 'stock' else get_option_symbol(row), row.shares, row.open_price) for row in query]
+
+    symbols = list(set([symbol for symbol, _, _ in positions]))
+    lasts = {}
+    for index in range(0, len(symbols), 500):
+        lasts.update({row.symbol: row.last for row in session.query(FinanceQuotes.symbol, FinanceQuotes.last).filter(FinanceQuotes.symbol.in_(symbols[index:index + 500]))})
+
+    priorities = {}
+    for symbol, shares, open_price in positions:
+        price = lasts.get(symbol) or open_price or 0
+        priorities[symbol] = priorities.get(symbol, 0.0) + abs(float(shares or 0) * float(price))
+    for symbol in priority_symbols:
+        priorities[symbol] = float('inf')
+    logger.debug(f"top priorities={sorted(priorities.items(), key=lambda item: -item[1])[:10]}")
+    return priorities
+
+def prioritize(items, priority=None):
+    """Sort items (symbols by default) by descending priority, ties by name."""
+    priority = priority or (lambda symbol: symbol_priorities.get(symbol, 0.0))
+    return sorted(items, key=lambda item: (-priority(item), str(item)))
+
+def lookup_kind(lookup):
+    """'stock' for lookup_stock, 'option_chain' for lookup_option_chain, ..."""
+    return lookup.__name__[len('lookup_'):] if lookup.__name__.startswith('lookup_') else lookup.__name__
+
+def get_quote_providers():
+    """Build the --providers list, in order of preference."""
+    providers = []
+    for name in arguments.providers or ['yahoo']:
+        if name == 'yahoo':
+            providers.append(quote_providers.YahooProvider(yahoo_host, arguments.parser, archive=quote_archive))
+        elif name == 'finviz':
+            providers.append(quote_providers.FinvizProvider())
+        elif name == 'local':
+            providers.append(quote_providers.LocalProvider(arguments.local_source, arguments.parser))
+    for provider in providers:
+        provider.rate_limiter = rate_limiter
+        provider.metrics = metrics
+    return providers
+
+def lookup_index(symbol, timeout=30):
+    return hedged_fetcher.fetch('index', symbol, timeout=timeout)
+
+def lookup_mf(symbol, timeout=30):
+    return hedged_fetcher.fetch('mf', symbol, timeout=timeout)
+
+def lookup_option(symbol, timeout=30):
+    return hedged_fetcher.fetch('option', symbol, timeout=timeout)
+
+def lookup_option_chain(chain, timeout=30):
+    """Fetch the options page for chain, an (underlying, expiration) tuple,
+    and return {contract symbol: details} for every contract on it.
+    """
+    underlying, expiration = chain
+    expiration_timestamp = calendar.timegm(expiration.timetuple())
+    request = f"//{yahoo_host}/quote/{underlying}/options?p={underlying}&date={expiration_timestamp}"
     url = urllib.parse.quote(request)
-    response = requests.get("https:" + url, timeout=30)
-    if response.status_code != 200:
+    try:
+        timeout -= rate_limiter.acquire('yahoo', timeout=timeout)
+    except RateLimitTimeout:
         return {}
-
-    page_content = BeautifulSoup(response.content, "html.parser")
-
-    elem = page_content.find(company_descriptor['tag'])
-    l_company = elem.text
-    elem = page_content.find(last_descriptor['tag'], attrs=last_descriptor['attrs'])
-    l_last = float(elem.text.replace(',', ''))
-    elem_list = page_content.find_all(table_descriptor['tag'], attrs=table_descriptor['attrs'])
-    elem = elem_list[0].find('span')
-    l_previous_close = float(elem.text.replace(',', ''))
-    elem = elem_list[1].find('span')
-    l_open = float(elem.text.replace(',', ''))
-    elem = elem_list[2].find('span')
-    l_volume = elem.text
-    elem = elem_list[3]
-    l_day_range = elem.text
-    elem = elem_list[4]
-    l_year_range = elem.text
-    elem = elem_list[5].find('span')
-    l_avg_volume = elem.text
-
-    l_change = l_last - l_previous_close
-
-    return_dict = {
-            'Ticker': symbol,
-            'Company': l_company,
-            'Price': l_last,
-            'Prev Close': l_previous_close,
-            'Change': f"{(l_change / l_previous_close) * 100.0:.2f}",
-            'Volume': l_volume,
-            'Avg Volume': l_avg_volume,
-            '52W Range': l_year_range,
-            'Day Range': l_day_range,
-            'EPS (ttm)': 0.0,
-            'P/E': 0.0,
-            'Dividend': 0.0,
-            'Dividend %': "0.0%",
-            'Market Cap': "0",
-            }
-
-    return return_dict
-
-def lookup_mf(symbol):
-    company_descriptor = { 'tag': 'h1', }
-    last_descriptor = { 'tag': 'span', 'attrs': {'class': "Trsdu(0.3s) Fw(b) Fz(36px) Mb(-4px) D(ib)"}, }
-    table_descriptor = { 'tag': 'td', 'attrs': {"class": "Ta(end) Fw(600) Lh(14px)"}, }
-    request = f"//in.finance.yahoo.com/quote/{symbol}?p={symbol}"
-    url = urllib.parse.quote(request)
-    response = requests.get("https:" + url, timeout=30)
-    page_content = BeautifulSoup(response.content, "html.parser")
-
-    elem = page_content.find(company_descriptor['tag'])
-    l_company = elem.text
-    elem = page_content.find(last_descriptor['tag'], attrs=last_descriptor['attrs'])
-    l_last = float(elem.text.replace(',', ''))
-    elem_list = page_content.find_all(table_descriptor['tag'], attrs=table_descriptor['attrs'])
-    elem = elem_list[0].find('span')
-    l_previous_close = float(elem.text.replace(',', ''))
-    l_change = l_last - l_previous_close
-    return_dict = {
-            'Ticker': symbol,
-            'Company': l_company,
-            'Price': l_last,
-            'Prev Close': l_previous_close,
-            'Change': f"{(l_change / l_previous_close) * 100.0:.2f}",
-            'Volume': "0",
-            'Avg Volume': "0",
-            '52W Range': "'0.00 - 0.00'",
-            'Day Range': "'0.00 - 0.00'",
-            'EPS (ttm)': 0.0,
-            'P/E': 0.0,
-            'Dividend': 0.0,
-            'Dividend %': "0.0%",
-            'Market Cap': "0",
-            }
-
-    return return_dict
-
-def lookup_option(symbol):
-    company_descriptor = { 'tag': 'h1', }
-    last_descriptor = { 'tag': 'span', 'attrs': {'class': "Trsdu(0.3s) Fw(b) Fz(36px) Mb(-4px) D(ib)"}, }
-    table_descriptor = { 'tag': 'td', 'attrs': {"class": "Ta(end) Fw(600) Lh(14px)"}, }
-    request = f"//in.finance.yahoo.com/quote/{symbol}?p={symbol}"
-    url = urllib.parse.quote(request)
-    response = requests.get("https:" + url, timeout=30)
-    page_content = BeautifulSoup(response.content, "html.parser")
-
-    elem = page_content.find(company_descriptor['tag'])
-    l_company = elem.text
-    elem = page_content.find(last_descriptor['tag'], attrs=last_descriptor['attrs'])
-    l_last = float(elem.text.replace(',', ''))
-    elem_list = page_content.find_all(table_descriptor['tag'], attrs=table_descriptor['attrs'])
-    elem = elem_list[0].find('span')
-    l_previous_close = float(elem.text.replace(',', ''))
-    elem = elem_list[2].find('span')
-    l_bid = float(elem.text.replace(',', ''))
-    elem = elem_list[3].find('span')
-    l_ask = float(elem.text.replace(',', ''))
-    elem = elem_list[6]
-    l_day_range = elem.text
-    elem = elem_list[8].find('span')
-    l_volume = elem.text
-    l_change = l_last - l_previous_close
-    return_dict = {
-            'Ticker': symbol,
-            'Company': l_company,
-            'Price': l_last,
-            'Prev Close': l_previous_close,
-            'Change': f"{(l_change / l_previous_close) * 100.0:.2f}",
-            'Volume': f"{l_volume}",
-            'Avg Volume': "0",
-            '52W Range': "'0.00 - 0.00'",
-            'Day Range': f"'{l_day_range}'",
-            'EPS (ttm)': 0.0,
-            'P/E': 0.0,
-            'Dividend': 0.0,
-            'Dividend %': "0.0%",
-            'Market Cap': "0",
-            'Bid': l_bid,
-            'Ask': l_ask,
-            }
-    return return_dict
-
-def lookup_stock(symbol):
-    logger = logging.getLogger(__name__ + '.' + 'lookup_stock')
-    company_descriptor = { 'tag': 'h1', }
-    last_descriptor = { 'tag': 'span', 'attrs': {'class': "Trsdu(0.3s) Fw(b) Fz(36px) Mb(-4px) D(ib)"}, }
-    table_descriptor = { 'tag': 'td', 'attrs': {"class": "Ta(end) Fw(600) Lh(14px)"}, }
-    request = f"//in.finance.yahoo.com/quote/{symbol}?p={symbol}"
-    url = urllib.parse.quote(request)
-    response = requests.get("https:" + url, timeout=30)
-    good_status = True
+    response = http_client.get_client().get("https:" + url, timeout=timeout)
     if response.status_code != 200:
-        logger.warning(f"yahoo fetch bad response for {symbol}")
-        return {}
-
-    page_content = BeautifulSoup(response.content, "html.parser")
-    try:
-        l_last = float(page_content.find(last_descriptor['tag'], attrs=last_descriptor['attrs']).text.replace(',', ''))
-        elem_list = page_content.find_all(table_descriptor['tag'], attrs=table_descriptor['attrs'])
-        l_previous_close = float(elem_list[0].find("span").text.replace(',', ''))
-    except:
-        logger.warning(f"Unable to get good yahoo fetch for {symbol}")
         return {}
+    if quote_archive is not None:
+        quote_archive.save('chain', f"{underlying}_{expiration}", response.content)
 
+    start = _time.time()
+    option_chain = quote_parsers.parse_option_chain(response.content, arguments.parser)
+    chain_details = {symbol: quote_parsers.parse_option_chain_row(symbol, row) for symbol, row in option_chain.items()}
+    metrics.observe('parse_seconds', _time.time() - start, kind='option_chain')
+    return chain_details
 
-    elem = page_content.find(company_descriptor['tag'])
-    l_company = elem.text
-    elem = elem_list[1].find('span')
-    l_open = float(elem.text.replace(',', ''))
-    elem = elem_list[4]
-    l_day_range = elem.text
-    elem = elem_list[5]
-    l_year_range = elem.text
-    elem = elem_list[6].find('span')
-    l_volume = elem.text
-    elem = elem_list[7].find('span')
-    l_avg_volume = elem.text
-
-    l_change = l_last - l_previous_close
-
-    return_dict = {
-            'Ticker': symbol,
-            'Company': l_company,
-            'Price': l_last,
-            'Prev Close': l_previous_close,
-            'Change': f"{(l_change / l_previous_close) * 100.0:.2f}",
-            'Volume': l_volume,
-            'Avg Volume': l_avg_volume,
-            '52W Range': l_year_range,
-            'Day Range': l_day_range,
-            'EPS (ttm)': 0.0,
-            'P/E': 0.0,
-            'Dividend': 0.0,
-            'Dividend %': "0.0%",
-            'Market Cap': "0",
-            }
-
-    return return_dict
+def lookup_stock(symbol, timeout=30):
+    return hedged_fetcher.fetch('stock', symbol, timeout=timeout)
 
 def try_float(s, method=None, except_value=None):
     if method == 'magnitude' and s.endswith(('K', 'M', 'B', 'T',)):
@@ -503,109 +1010,211 @@ def try_float(s, method=None, except_value=None):
         f = except_value
     return f
 
-def update_indexes(data_datetime, market_closed, index_symbols):
+def quarantine_exempt(symbol):
+    """Index symbols, ^GSPC first among them, are always fetched."""
+    return symbol in priority_symbols or symbol.startswith('^')
+
+def skip_quarantined_symbols(symbols):
+    """Given the (stock, mf, index, option) symbol sets, drop quarantined symbols."""
+    logger = logging.getLogger(__name__ + '.' + 'skip_quarantined_symbols')
+    allowed_symbols = []
+    for class_symbols in symbols:
+        exempt_symbols = {symbol for symbol in class_symbols if quarantine_exempt(symbol)}
+        class_allowed_symbols, class_quarantined_symbols = quarantine.split(set(class_symbols) - exempt_symbols)
+        if class_quarantined_symbols:
+            logger.info(f"Skipping {len(class_quarantined_symbols)} quarantined symbols: {sorted(class_quarantined_symbols)}")
+        allowed_symbols.append(class_allowed_symbols | exempt_symbols)
+    return tuple(allowed_symbols)
+
+def record_quote_results(requested_symbols, failed_symbols, source, cut_off=False):
+    """Clear the symbols that quoted, count a failure against the rest.
+
+    When (nearly) every symbol from one source fails the provider or the
+    network is down, not the symbols, so failures aren't counted.
+    """
+    logger = logging.getLogger(__name__ + '.' + 'record_quote_results')
+    failed_symbols = set(failed_symbols) & set(requested_symbols)
+    outage = len(failed_symbols) > 1 and len(failed_symbols) >= arguments.outage_fraction * len(requested_symbols)
+    if outage:
+        logger.warning(f"{len(failed_symbols)} of {len(requested_symbols)} {source} symbols failed, treating it as an outage")
+        metrics.count('outages', kind=source)
+    for symbol in requested_symbols:
+        if symbol not in failed_symbols:
+            quarantine.record_success(symbol)
+        elif not cut_off and not outage and not quarantine_exempt(symbol):
+            quarantine.record_failure(symbol)
+
+def update_indexes(data_datetime, market_closed, index_symbols, writer=None):
     logger = logging.getLogger(__name__ + '.' + 'update_indexes')
     logger.debug(f"fetching info for {len(index_symbols)} index symbols")
     finance_quote_table_list = []
-    index_details = []
-    for index_symbol in index_symbols:
-        index_details_item = lookup_index(index_symbol)
-        if index_details_item:
-            index_details.append(index_details_item)
-        else:
-            logger.warning(f"Unable to fetch details for {index_symbol}")
-    logger.debug(f"fetched info for {len(index_details)} index symbols")
-    finance_quote_table_list.append(FinanceQuoteTable(data_datetime, market_closed, index_details, 'index'))
+    index_details = fetch_engine.fetch(lookup_index, prioritize(index_symbols), writer=writer, details_type='index')
+    if writer is None:
+        logger.debug(f"fetched info for {len(index_details)} index symbols")
+        finance_quote_table_list.append(FinanceQuoteTable(data_datetime, market_closed, index_details, 'index'))
     return finance_quote_table_list
 
-def update_mfs(data_datetime, market_closed, mf_symbols):
+def update_mfs(data_datetime, market_closed, mf_symbols, writer=None):
     logger = logging.getLogger(__name__ + '.' + 'update_mfs')
     logger.debug(f"fetching info for {len(mf_symbols)} mf symbols")
     finance_quote_table_list = []
-    mf_details = []
-    for mf_symbol in mf_symbols:
-        mf_details_item = lookup_mf(mf_symbol)
-        if mf_details_item:
-            mf_details.append(mf_details_item)
-        else:
-            logger.warning(f"Unable to fetch details for {mf_symbol}")
-    logger.debug(f"fetched info for {len(mf_details)} mf symbols")
-    finance_quote_table_list.append(FinanceQuoteTable(data_datetime, market_closed, mf_details, 'mf'))
+    mf_details = fetch_engine.fetch(lookup_mf, prioritize(mf_symbols), writer=writer, details_type='mf')
+    if writer is None:
+        logger.debug(f"fetched info for {len(mf_details)} mf symbols")
+        finance_quote_table_list.append(FinanceQuoteTable(data_datetime, market_closed, mf_details, 'mf'))
     return finance_quote_table_list
 
-def update_options(data_datetime, market_closed, option_symbols):
+def group_option_symbols(option_symbols):
+    """Group contract symbols into {(underlying, expiration date): set(symbols)}."""
+    chains = {}
+    for option_symbol in option_symbols:
+        underlying, expiration, _, _ = quote_parsers.split_option_symbol(option_symbol)
+        chains.setdefault((underlying, expiration), set()).add(option_symbol)
+    return chains
+
+def update_options(data_datetime, market_closed, option_symbols, writer=None):
     logger = logging.getLogger(__name__ + '.' + 'update_options')
     logger.debug(f"fetching info for {len(option_symbols)} option symbols")
     finance_quote_table_list = []
     option_details = []
-    for option_symbol in option_symbols:
-        option_details_item = lookup_option(option_symbol)
-        if option_details_item:
-            option_details.append(option_details_item)
-        else:
-            logger.warning(f"Unable to fetch details for {option_symbol}")
-    logger.debug(f"fetched info for {len(option_details)} option symbols")
-    finance_quote_table_list.append(FinanceQuoteTable(data_datetime, market_closed, option_details, 'option'))
+    if arguments.option_chains:
+        # One options page per (underlying, expiration), fanned out to each contract
+        chains = group_option_symbols(option_symbols)
+        logger.debug(f"fetching {len(chains)} option chains")
+        unchained_symbols = set(option_symbols)
+
+        def on_chain(chain, chain_details):
+            found_details = [chain_details[option_symbol] for option_symbol in chains[chain] if option_symbol in chain_details]
+            unchained_symbols.difference_update(details['Ticker'] for details in found_details)
+            if writer is None:
+                option_details.extend(found_details)
+            else:
+                writer.put('option', found_details)
+
+        chain_priority = lambda chain: sum(symbol_priorities.get(option_symbol, 0.0) for option_symbol in chains[chain])
+        fetch_engine.fetch_results(lookup_option_chain, prioritize(chains.keys(), chain_priority), on_result=on_chain)
+        if unchained_symbols:
+            logger.info(f"{len(unchained_symbols)} option symbols not found in chains, fetching individually")
+            option_details.extend(fetch_engine.fetch(lookup_option, prioritize(unchained_symbols), writer=writer, details_type='option'))
+    else:
+        option_details = fetch_engine.fetch(lookup_option, prioritize(option_symbols), writer=writer, details_type='option')
+    if writer is None:
+        logger.debug(f"fetched info for {len(option_details)} option symbols")
+        finance_quote_table_list.append(FinanceQuoteTable(data_datetime, market_closed, option_details, 'option'))
     return finance_quote_table_list
 
-def update_stocks_last_ditch(data_datetime, market_closed, stock_symbols):
+def update_stocks_last_ditch(data_datetime, market_closed, stock_symbols, writer=None):
     logger = logging.getLogger(__name__ + '.' + 'update_stocks_last_ditch')
     logger.info(f"Last ditch, fetching info for {len(stock_symbols)} stock symbols, {stock_symbols}")
+    metrics.count('last_ditch_symbols', len(stock_symbols))
     finance_quote_table_list = []
-    stock_details = []
-    for stock_symbol in stock_symbols:
-        stock_details_item = lookup_stock(stock_symbol)
-        if stock_details_item:
-            stock_details.append(stock_details_item)
-        else:
-            logger.warning(f"Unable to fetch details for {stock_symbol}")
-    logger.debug(f"fetched info for {len(stock_details)} stock symbols")
-    finance_quote_table_list.append(FinanceQuoteTable(data_datetime, market_closed, stock_details, 'stock'))
+    stock_details = fetch_engine.fetch(lookup_stock, prioritize(stock_symbols), writer=writer, details_type='stock')
+    if writer is None:
+        logger.debug(f"fetched info for {len(stock_details)} stock symbols")
+        finance_quote_table_list.append(FinanceQuoteTable(data_datetime, market_closed, stock_details, 'stock'))
     return finance_quote_table_list
 
-def update_stocks(data_datetime, market_closed, stock_symbols):
+def screen_stock_chunk(stock_list, sizing=True):
+    """Run the finviz Screener once for one chunk of symbols. Returns the
+    list of details dicts, or None if the Screener failed. With sizing the
+    outcome is recorded by chunk_sizer.
+    """
+    logger = logging.getLogger(__name__ + '.' + 'screen_stock_chunk')
+    logger.debug(f"stock_list({len(stock_list)})={','.join(stock_list)}")
+    if deadline_passed():
+        return []
+    # One screener page plus a details page per ticker
+    try:
+        rate_limiter.acquire('finviz', tokens=1 + len(stock_list), timeout=limit_timeout())
+    except RateLimitTimeout:
+        return []
+    start = _time.time()
+    try:
+        stock_screener = Screener(tickers=stock_list)
+        stock_details = stock_screener.get_ticker_details()
+    except Exception as e:
+        logger.debug(f"Screener raised {type(e).__name__} for {len(stock_list)} symbols: {e}")
+        if sizing:
+            chunk_sizer.record(len(stock_list), _time.time() - start, False)
+        metrics.count('screener_failures')
+        return None
+    logger.debug(f"Screener successful")
+    if sizing:
+        chunk_sizer.record(len(stock_list), _time.time() - start, True)
+    metrics.observe('screener_chunk_seconds', _time.time() - start)
+    return stock_details
+
+def update_stocks(data_datetime, market_closed, stock_symbols, writer=None):
+    """Screen stock_symbols, --screener_workers chunks at a time. Chunks are
+    taken in priority order, so the largest positions are fetched first,
+    and each is as big as chunk_sizer allows when it is started. A chunk
+    that fails is split in two and both halves go back to the front of the
+    line, so a bad symbol ends up alone instead of failing its whole chunk.
+    A single symbol that fails is left for the next attempt (refresh_quotes
+    makes --retries of them). If more Screener calls fail in a row than
+    splitting down to one symbol would take, finviz is taken to be down and
+    the remaining symbols are left for the next attempt too. If writer is given, each chunk's details are put on
+    it as soon as the chunk finishes instead of being returned.
+    """
     logger = logging.getLogger(__name__ + '.' + 'update_stocks')
-    stock_symbols_to_fetch = set(stock_symbols)
-    max_chunk = arguments.chunk
     finance_quote_table_list = []
-    stocks = sorted(list(stock_symbols_to_fetch))
-    iterations = len(stock_symbols_to_fetch) // max_chunk
-    if (len(stock_symbols_to_fetch) % max_chunk) > 0:
-        iterations += 1
-    chunk_size = len(stock_symbols_to_fetch) // iterations
-    if (len(stock_symbols_to_fetch) % iterations) > 0:
-        chunk_size += 1
-    logger.debug(f"iterations={iterations},chunk_size={chunk_size}")
+    stocks = prioritize(set(stock_symbols))
+    unscreened = deque(stocks)
+    split_chunks = deque()
     screened_stock_symbols = set()
-    while len(stock_symbols_to_fetch) > 0:
-        if len(stock_symbols_to_fetch) >= chunk_size:
-            stock_list = list(stock_symbols_to_fetch)[:chunk_size]
-        else:
-            stock_list = list(stock_symbols_to_fetch)
-        logger.debug(f"stock_list({len(stock_list)})={','.join(stock_list)}")
-        for retry_attempt in range(arguments.retries):
-            logger.debug(f"Screener retry attempt {retry_attempt}")
-            try:
-                stock_screener = Screener(tickers=stock_list)
-                stock_details = stock_screener.get_ticker_details()
-                logger.debug(f"Screener successful")
-                break
-            except:
-                if retry_attempt == (arguments.retries - 1):
-                    stock_details = []
-                    logger.debug(f"Screener retry attempts exhausted, giving up")
-
-        screened_symbols = [detail['Ticker'] for detail in stock_details]
-        screened_stock_symbols = screened_stock_symbols.union(screened_symbols)
-        
-        finance_quote_table_list.append(FinanceQuoteTable(data_datetime, market_closed, stock_details, 'stock'))
-        stock_symbols_to_fetch.difference_update(stock_list)
+    # Splitting a chunk down to one bad symbol can fail this many times in a row
+    max_failures = chunk_sizer.max_size.bit_length() + 1
+    failures = 0
+    executor = ThreadPoolExecutor(max_workers=arguments.screener_workers)
+    running = {}
+    while (unscreened or split_chunks or running) and not deadline_passed():
+        while len(running) < arguments.screener_workers and (split_chunks or unscreened):
+            # Only fresh chunks size the next ones
+            sizing = not split_chunks
+            if split_chunks:
+                stock_list = split_chunks.popleft()
+            else:
+                stock_list = [unscreened.popleft() for _ in range(min(chunk_sizer.size, len(unscreened)))]
+            running[executor.submit(screen_stock_chunk, stock_list, sizing)] = stock_list
+        done, _ = wait(running, timeout=limit_timeout(), return_when=FIRST_COMPLETED)
+        for future in done:
+            stock_list = running.pop(future)
+            stock_details = future.result()
+            failures = 0 if stock_details is not None else failures + 1
+            if failures >= max_failures and (split_chunks or unscreened):
+                logger.info(f"Screener failed {failures} times in a row, leaving {len(unscreened) + sum(len(chunk) for chunk in split_chunks)} symbols for the next attempt")
+                metrics.count('screener_gave_up')
+                unscreened.clear()
+                split_chunks.clear()
+            if stock_details is None:
+                if failures >= max_failures:
+                    pass
+                elif len(stock_list) > 1:
+                    # Keep priority order, first half first
+                    middle = len(stock_list) // 2
+                    split_chunks.extendleft([stock_list[middle:], stock_list[:middle]])
+                    metrics.count('screener_splits')
+                else:
+                    logger.debug(f"Screener failed for {stock_list[0]}, leaving it for the next attempt")
+                continue
+            screened_symbols = [detail['Ticker'] for detail in stock_details]
+            screened_stock_symbols = screened_stock_symbols.union(screened_symbols)
+
+            if writer is None:
+                finance_quote_table_list.append(FinanceQuoteTable(data_datetime, market_closed, stock_details, 'stock'))
+            else:
+                writer.put('stock', stock_details)
+    if running:
+        logger.warning(f"Deadline reached with {len(running)} Screener chunks unfinished")
+        screener_futures.update(running)
+    # Don't wait on Screener chunks still running past the deadline.
+    executor.shutdown(wait=not deadline_passed(), cancel_futures=True)
 
-    screened_stocks = sorted(list(screened_stock_symbols))
     missing_symbols = set(stocks)
     missing_symbols.difference_update(screened_stock_symbols)
-    if stocks != screened_stocks:
+    if missing_symbols:
         logger.debug(f"missing symbols: {missing_symbols}")
+    logger.debug(f"chunk size {chunk_sizer.size}")
 
     return finance_quote_table_list, missing_symbols
 
@@ -621,47 +1230,95 @@ def parse_arguments():
             )
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help="Show verbose messages")
     parser.add_argument('-d', '--debug', action='store_true', default=False, help="Run in debug mode")
-    parser.add_argument('--fileportnames', action='append', default=[], help="Limit update to symbols from one (or more) file:port names. Default is all fpns")
+    parser.add_argument('--fileportnames', dest='fileportname_filter', action='append', default=[], help="Limit update to symbols from one (or more) file:port names. Default is all fpns")
     parser.add_argument('--filenames', action='append', default=[], help="Use file:ports where file is in this list")
     parser.add_argument('--stock_only', action='store_true', default=False, help="Only get stock quotes (no index, mf or option)")
     parser.add_argument('--index_skip', action='store_true', default=False, help="Skip quotes for indexes")
     parser.add_argument('--mf_skip', action='store_true', default=False, help="Skip quotes for mutual funds")
     parser.add_argument('--option_skip', action='store_true', default=False, help="Skip quotes for options")
-    parser.add_argument('--clean', action='store_true', default=False, help="Delete rows from finance_quote table before committing new updates. Ignores arguments that limit fileportnames.")
+    parser.add_argument('--clean', action='store_true', default=False, help="Rebuild finance_quote from scratch through a staging table, dropping rows for symbols no longer held. Ignores arguments that limit fileportnames.")
     parser.add_argument('--delay', type=int, default=0, help="Seconds to delay before starting")
-    parser.add_argument('--chunk', type=int, default=100, help="Limits the number of symbols passed to finviz in one chunk, default=100")
+    parser.add_argument('--chunk', '--maxper', type=int, default=100, help="Limits the number of symbols passed to finviz in one chunk, the chunk size adapts below this, default=100")
+    parser.add_argument('--min_chunk', type=int, default=5, help="Smallest chunk the adaptive chunk size shrinks to, default=5")
+    parser.add_argument('--chunk_step', type=int, default=10, help="Symbols added to the chunk size after each chunk that is screened in time, default=10")
+    parser.add_argument('--chunk_target', type=float, default=30.0, help="Seconds a chunk may take before the chunk size is halved, default=30.0")
     parser.add_argument('--retries', type=int, default=5, help="Specifies number of retry attempts for Screener data.")
+    parser.add_argument('--screener_workers', type=int, default=4, help="Number of finviz Screener chunks fetched concurrently, default=4")
+    parser.add_argument('--bulk', action='store_true', default=False, help="Write finance_quote rows with one read and bulk insert/update per batch")
+    parser.add_argument('--queue_size', type=int, default=1000, help="Max fetched quotes waiting to be written, fetchers block when it is full, default=1000")
+    parser.add_argument('--batch_size', type=int, default=50, help="Max finance_quote rows written per commit, default=50")
+    parser.add_argument('--batch_wait', type=float, default=2.0, help="Seconds a partial batch waits for more quotes before it is committed, default=2.0")
+    parser.add_argument('--workers', type=int, default=8, help="Number of threads used for per-symbol yahoo lookups, default=8")
+    parser.add_argument('--per_host', type=int, default=4, help="Max concurrent requests to any one host, default=4")
+    parser.add_argument('--http_retries', type=int, default=2, help="Retries (with jittered backoff) for a yahoo request that fails to connect or gets a 429/5xx, default=2")
+    parser.add_argument('--timeout', type=int, default=30, help="Seconds allowed for each per-symbol lookup, default=30")
+    parser.add_argument('--option_chains', action='store_true', default=False, help="Fetch one yahoo options page per underlying/expiration instead of one page per contract")
+    parser.add_argument('--parser', choices=sorted(quote_parsers.backends.keys()), default=quote_parsers.default_backend, help="HTML parser backend for yahoo quote pages, default=soup")
+    parser.add_argument('--providers', action='append', choices=('yahoo', 'finviz', 'local'), default=[], help="Per-symbol quote providers in order of preference, repeat for more. Default is yahoo")
+    parser.add_argument('--local_source', default=os.path.join(thisdir, '..', 'test', 'quote_pages'), help="Directory or URL of saved <kind>_<symbol>.html pages for the local provider")
+    parser.add_argument('--hedge_after', type=float, default=5.0, help="Seconds before a provider is hedged with the next one, until it has enough samples to use its p95, default=5.0")
+    add_rate_arguments(parser)
+    parser.add_argument('--stock_ttl', type=int, default=0, help="Seconds before a stock quote is refetched, default=0 (always)")
+    parser.add_argument('--index_ttl', type=int, default=0, help="Seconds before an index quote is refetched, default=0 (always)")
+    parser.add_argument('--option_ttl', type=int, default=300, help="Seconds before an option quote is refetched, default=300")
+    parser.add_argument('--mf_ttl', type=int, default=10800, help="Seconds before a mutual fund quote is refetched, default=10800")
+    parser.add_argument('--quarantine_file', default=default_quarantine_path, help="JSON file tracking symbols that repeatedly fail to quote")
+    parser.add_argument('--quarantine_report', action='store_true', default=False, help="List symbols with recorded failures and exit")
+    parser.add_argument('--outage_fraction', type=float, default=0.9, help="When at least this fraction of a class fails, treat it as a provider outage and count no symbol failures, default=0.9")
+    parser.add_argument('--quarantine_release', action='append', default=[], help="Clear a symbol from the quarantine (or 'all') and exit")
+    parser.add_argument('--deadline', type=int, default=0, help="Seconds the whole run may take. Unfinished fetches are abandoned, what was fetched is committed. Default=0 (no limit)")
+    parser.add_argument('--lock_file', default=os.path.join(thisdir, 'quote_query.lock'), help="File locked for the duration of the run, a second run exits while it is held")
+    parser.add_argument('--archive', action='store_true', default=False, help="Save every raw yahoo page fetched under --archive_dir/YYYY-MM-DD")
+    parser.add_argument('--archive_dir', default=default_archive_path, help="Directory of archived yahoo pages")
+    parser.add_argument('--archive_compression', choices=('gzip', 'zstd', 'none'), default='gzip', help="Compression for archived pages, default=gzip")
+    parser.add_argument('--reparse', action='store_true', default=False, help="Rebuild finance_quote from archived pages instead of fetching (no network access)")
+    parser.add_argument('--reparse_date', help="Day of the archive to reparse (YYYY-MM-DD), default is today")
+    parser.add_argument('--metrics_textfile', help="Write run metrics here in the Prometheus text format (ie. for node_exporter's textfile collector)")
+    parser.add_argument('--metrics_summary', default=os.path.join(thisdir, 'quote_query_metrics.jsonl'), help="File a JSON summary of each run's metrics is appended to, '' to disable")
+    parser.add_argument('--update_totals', action='store_true', default=False, help="Recompute port_param/port_history for the ports holding each committed batch of changed quotes, as put_totals does for every port")
+    parser.add_argument('--end', help="Keep refreshing quotes until this time (ie. 4:45pm). Default is to run once")
+    parser.add_argument('--wait', type=int, default=15, help="Seconds between the starts of refresh cycles when --end is used, default=15")
     arguments = parser.parse_args()
 
     logger.debug("Arguments:")
     for arg, val in arguments.__dict__.items():
         logger.debug(f"{arg}={val}")
 
-def process_arguments():
-    global arguments
-    global file_port_names
-    logger = logging.getLogger(__name__ + '.' + 'process_arguments')
-
-    # Get port_fileportname data
-    file_port_names = FilePortName()
-
+def get_enabled_fileportnames():
+    """Return the set of fileportnames selected by --filenames/--fileportnames."""
     available_fileportnames = get_portnames()
     enabled_fileportnames = set()
 
     if arguments.filenames:
         enabled_fileportnames = {fpn for fpn in available_fileportnames if fpn.startswith(*[f"{fn}:" for fn in arguments.filenames])}
 
-    if arguments.fileportnames:
-        fileport_based_set = available_fileportnames.intersection(arguments.fileportnames)
+    if arguments.fileportname_filter:
+        fileport_based_set = available_fileportnames.intersection(arguments.fileportname_filter)
         enabled_fileportnames = enabled_fileportnames.union(fileport_based_set)
 
-    if arguments.fileportnames or arguments.filenames:
-        arguments.fileportnames = enabled_fileportnames
-    else:
-        arguments.fileportnames = available_fileportnames
+    if arguments.fileportname_filter or arguments.filenames:
+        return enabled_fileportnames
+
+    return available_fileportnames
+
+def process_arguments():
+    global arguments
+    global file_port_names
+    logger = logging.getLogger(__name__ + '.' + 'process_arguments')
+
+    # Get port_fileportname data
+    file_port_names = FilePortName()
+
+    arguments.fileportnames = get_enabled_fileportnames()
 
     if arguments.clean:
-        arguments.fileportnames = available_fileportnames
+        arguments.fileportnames = get_portnames()
+
+    arguments.end_datetime = None
+    if arguments.end:
+        arguments.end_datetime = dateparser.parse(arguments.end)
+        if arguments.end_datetime is None:
+            logger.warning(f"Unable to parse --end {arguments.end}, running once")
 
     logger.debug("Arguments:")
     for arg, val in arguments.__dict__.items():
@@ -671,60 +1328,276 @@ def process_arguments():
 #############################################################################
 # Main
 #############################################################################
-def main():
-    logger = logging.getLogger(__name__)
-
-    # Delay
-    delay_start()
+def refresh_quotes(symbols, clean):
+    """Fetch quotes for one cycle and write them to finance_quote."""
+    logger = logging.getLogger(__name__ + '.' + 'refresh_quotes')
 
     # Check date, market holidays
     data_datetime, market_closed = check_date_market_holidays()
 
-    # Get sets of symbols that will need quotes (stock, mutual fund, index, call, put)
-    stock_symbols, mf_symbols, index_symbols, option_symbols = get_symbols(arguments.fileportnames)
+    with metrics.phase('stale_check'):
+        # Only fetch symbols whose quotes are older than their class TTL
+        stock_symbols, mf_symbols, index_symbols, option_symbols = get_stale_symbols(symbols, clean)
 
-    finance_quote_table_list = []
+        # Leave out symbols that keep failing until their backoff expires
+        stock_symbols, mf_symbols, index_symbols, option_symbols = skip_quarantined_symbols((stock_symbols, mf_symbols, index_symbols, option_symbols))
+    requested_symbols = set(stock_symbols)
+    if not arguments.stock_only:
+        requested_symbols.update(*[class_symbols for class_symbols, skip in ((index_symbols, arguments.index_skip), (mf_symbols, arguments.mf_skip), (option_symbols, arguments.option_skip)) if not skip])
+
+    # End the read transaction, the writer thread commits through its own session.
+    session.commit()
 
-    # Call for stock info
-    if stock_symbols:
-        logger.info(f"Fetching quotes for {len(stock_symbols)} stock symbols")
-        for retry_attempt in range(arguments.retries):
-            logger.debug(f"update_stocks() attempt {retry_attempt}")
-            finance_quote_table_sublist, missing_symbols = update_stocks(data_datetime, market_closed, stock_symbols)
-            finance_quote_table_list.extend(finance_quote_table_sublist)
-            logger.debug(f"Got info for {len(stock_symbols)-len(missing_symbols)} of {len(stock_symbols)} symbols")
-            stock_symbols = missing_symbols
-            if len(stock_symbols) == 0:
-                break
-            if retry_attempt == (arguments.retries - 1):
-                logger.info("update_stocks() retry attempts exhausted, giving up")
+    # Quotes are written behind the fetchers as they arrive. With --clean they
+    # are written to a staging table that replaces finance_quote at close().
+    writer = QuoteWriter(data_datetime, market_closed, arguments.queue_size, arguments.batch_size, arguments.batch_wait, staging=clean).start()
+    # (requested symbols, class, cut off by --deadline) for each class fetched
+    fetched_classes = []
+    try:
+        # Call for index info first, ^GSPC is what readers check before anything else
+        if not arguments.stock_only and not arguments.index_skip and index_symbols and not deadline_passed():
+            logger.info(f"Fetching quotes for {len(index_symbols)} index symbols")
+            with metrics.phase('fetch_index'):
+                update_indexes(data_datetime, market_closed, index_symbols, writer=writer)
+            fetched_classes.append((set(index_symbols), 'index', deadline_passed()))
 
+        # Call for stock info
         if stock_symbols:
-            finance_quote_table_list.extend(update_stocks_last_ditch(data_datetime, market_closed, stock_symbols))
+            logger.info(f"Fetching quotes for {len(stock_symbols)} stock symbols")
+            requested_stock_symbols = set(stock_symbols)
+            with metrics.phase('fetch_stock'):
+                for retry_attempt in range(arguments.retries):
+                    if deadline_passed():
+                        break
+                    logger.debug(f"update_stocks() attempt {retry_attempt}")
+                    _, missing_symbols = update_stocks(data_datetime, market_closed, stock_symbols, writer=writer)
+                    logger.debug(f"Got info for {len(stock_symbols)-len(missing_symbols)} of {len(stock_symbols)} symbols")
+                    stock_symbols = missing_symbols
+                    if len(stock_symbols) == 0:
+                        break
+                    if retry_attempt == (arguments.retries - 1):
+                        logger.info("update_stocks() retry attempts exhausted, giving up")
+
+            if stock_symbols and not deadline_passed():
+                with metrics.phase('fetch_stock_last_ditch'):
+                    update_stocks_last_ditch(data_datetime, market_closed, stock_symbols, writer=writer)
+            fetched_classes.append((requested_stock_symbols, 'stock', deadline_passed()))
+
+        if not arguments.stock_only:
+            # Call for mf info
+            if not arguments.mf_skip and mf_symbols and not deadline_passed():
+                logger.info(f"Fetching quotes for {len(mf_symbols)} mutual fund symbols")
+                with metrics.phase('fetch_mf'):
+                    update_mfs(data_datetime, market_closed, mf_symbols, writer=writer)
+                fetched_classes.append((set(mf_symbols), 'mutual fund', deadline_passed()))
+
+            # Call for option info
+            if not arguments.option_skip and option_symbols and not deadline_passed():
+                logger.info(f"Fetching quotes for {len(option_symbols)} option symbols")
+                with metrics.phase('fetch_option'):
+                    update_options(data_datetime, market_closed, option_symbols, writer=writer)
+                fetched_classes.append((set(option_symbols), 'option', deadline_passed()))
+    finally:
+        # Symbols we still track but couldn't fetch keep their old rows through a --clean swap.
+        with metrics.phase('write_flush'):
+            writer.close(tracked_symbols=set().union(*symbols))
+
+    # A symbol only counts as quoted once its row is committed. Symbols
+    # cut off by --deadline weren't necessarily tried, so they aren't failures.
+    for class_symbols, source, cut_off in fetched_classes:
+        record_quote_results(class_symbols, class_symbols - writer.written_symbols, source, cut_off)
+    quarantine.save()
+
+    metrics.count('cycles')
+    metrics.count('symbols_requested', len(requested_symbols))
+    metrics.count('symbols_refreshed', len(requested_symbols & writer.written_symbols))
+    if deadline_passed():
+        missing_symbols = requested_symbols - writer.written_symbols
+        metrics.count('symbols_missed_deadline', len(missing_symbols))
+        logger.warning(f"Deadline reached, {len(missing_symbols)} of {len(requested_symbols)} symbols not refreshed: {' '.join(sorted(missing_symbols))}")
+
+def reparse_quotes(symbols):
+    """Rebuild finance_quote from the pages archived on --reparse_date,
+    without any network access. Option chain pages only contribute the
+    contracts we hold.
+    """
+    logger = logging.getLogger(__name__ + '.' + 'reparse_quotes')
+    day = datetime.strptime(arguments.reparse_date, '%Y-%m-%d').date() if arguments.reparse_date else date.today()
+    pages = quote_archive.pages(day)
+    if not pages:
+        logger.warning(f"No archived pages for {day} in {quote_archive.root}")
+        return
+    option_symbols = symbols[3]
+
+    # Quotes are dated by when the newest page was fetched.
+    data_datetime = datetime.fromtimestamp(max(os.path.getmtime(path) for _, _, path in pages))
+    writer = QuoteWriter(data_datetime, is_market_closed(day), arguments.queue_size, arguments.batch_size, arguments.batch_wait, staging=arguments.clean).start()
+    try:
+        for kind, name, path in pages:
+            try:
+                content = read_page(path)
+                start = _time.time()
+                if kind == 'chain':
+                    option_chain = quote_parsers.parse_option_chain(content, arguments.parser)
+                    details_list = [quote_parsers.parse_option_chain_row(symbol, row) for symbol, row in option_chain.items() if symbol in option_symbols]
+                    metrics.observe('parse_seconds', _time.time() - start, key=name, kind='option_chain')
+                    writer.put('option', details_list)
+                else:
+                    details = quote_parsers.parsers[kind](name, quote_parsers.parse_quote_page(content, arguments.parser))
+                    metrics.observe('parse_seconds', _time.time() - start, key=name, kind=kind)
+                    writer.put(kind, [details] if details else [])
+            except Exception as e:
+                logger.warning(f"Unable to reparse {path}: {type(e).__name__} {e}")
+    finally:
+        writer.close(tracked_symbols=set().union(*symbols))
+    logger.info(f"Reparsed {len(writer.written_symbols)} symbols from {len(pages)} pages archived {day}")
+
+def export_metrics():
+    """Add the http, rate limiter and provider totals to metrics, log the
+    phase timings and write --metrics_textfile and --metrics_summary.
+    """
+    logger = logging.getLogger(__name__ + '.' + 'export_metrics')
+    for host, host_stats in sorted(http_client.get_client().stats.items()):
+        metrics.count('http_requests', host_stats.requests, host=host)
+        metrics.count('http_retries', host_stats.retries, host=host)
+        metrics.count('http_errors', host_stats.errors, host=host)
+        metrics.count('http_not_modified', host_stats.not_modified, host=host)
+        metrics.count('http_wire_bytes', host_stats.wire_bytes, host=host)
+    if chunk_sizer is not None:
+        metrics.count('screener_chunk_size', chunk_sizer.size)
+    if rate_limiter is not None:
+        for provider, (_, total, _) in sorted(rate_limiter.waits.items()):
+            metrics.count('rate_limit_wait_seconds', round(total, 3), provider=provider)
+    if hedged_fetcher is not None:
+        for provider in hedged_fetcher.providers:
+            metrics.count('provider_successes', provider.stats.successes, provider=provider.name)
+            metrics.count('provider_failures', provider.stats.failures, provider=provider.name)
+            metrics.count('provider_hedges', provider.stats.hedges, provider=provider.name)
+
+    summary = metrics.summary()
+    logger.info("Phases: " + ', '.join(f"{phase}={phase_summary['seconds']:.1f}s" for phase, phase_summary in summary['phases'].items()))
+    if arguments.metrics_textfile:
+        metrics.write_textfile(arguments.metrics_textfile)
+    if arguments.metrics_summary:
+        metrics.write_summary(arguments.metrics_summary)
+
+def report_quarantine():
+    """Handle --quarantine_report/--quarantine_release. Returns True if either was given."""
+    if arguments.quarantine_release:
+        released = quarantine.release(arguments.quarantine_release)
+        quarantine.save()
+        print(f"Released {len(released)} symbols: {' '.join(sorted(released))}")
+    if arguments.quarantine_report:
+        lines = quarantine.report()
+        for line in lines:
+            print(line)
+        print(f"{len([line for line in lines if ' quarantined ' in line])} quarantined, {len(lines)} with recorded failures")
+    return bool(arguments.quarantine_release or arguments.quarantine_report)
 
-    if not arguments.stock_only:
-        # Call for index info
-        if not arguments.index_skip and index_symbols:
-            logger.info(f"Fetching quotes for {len(index_symbols)} index symbols")
-            finance_quote_table_list.extend(update_indexes(data_datetime, market_closed, index_symbols))
-        
-        # Call for mf info
-        if not arguments.mf_skip and mf_symbols:
-            logger.info(f"Fetching quotes for {len(mf_symbols)} mutual fund symbols")
-            finance_quote_table_list.extend(update_mfs(data_datetime, market_closed, mf_symbols))
+def main():
+    global fetch_engine
+    global file_port_names
+    global trading_calendar
+    global quarantine
+    global hedged_fetcher
+    global run_deadline
+    global quote_archive
+    global symbol_priorities
+    global rate_limiter
+    global chunk_sizer
+    global totals_updater
+    logger = logging.getLogger(__name__)
+
+    # Symbols that keep failing to quote
+    quarantine = SymbolQuarantine(arguments.quarantine_file)
+    if report_quarantine():
+        return
 
-        # Call for option info
-        if not arguments.option_skip and option_symbols:
-            logger.info(f"Fetching quotes for {len(option_symbols)} option symbols")
-            finance_quote_table_list.extend(update_options(data_datetime, market_closed, option_symbols))
+    # Don't overlap with a previous run that is still going
+    if not acquire_run_lock(arguments.lock_file):
+        return
+    if arguments.deadline:
+        run_deadline = _time.time() + arguments.deadline
 
-    if arguments.clean and len(finance_quote_table_list) > 0:
-        finance_quote_table_list[0].delete_table_rows()
+    # Delay
+    delay_start()
 
-    for finance_quote_table in finance_quote_table_list:
-        finance_quote_table.update_finance_quote_table()
+    # Trading days from market_holiday
+    trading_calendar = TradingCalendar.from_session(session, MarketHolidays, cache_path=default_cache_path)
 
-    
+    # Get sets of symbols that will need quotes (stock, mutual fund, index, call, put)
+    with metrics.phase('symbols'):
+        fingerprint = get_symbols_fingerprint()
+        symbols = get_symbols(arguments.fileportnames)
+        symbol_priorities = get_symbol_priorities(arguments.fileportnames)
+
+    # Port totals recomputed as quotes change
+    if arguments.update_totals:
+        totals_updater = TotalsUpdater().start()
+
+    # Raw yahoo pages, saved with --archive and read back with --reparse
+    if arguments.archive or arguments.reparse:
+        quote_archive = QuoteArchive(arguments.archive_dir, arguments.archive_compression)
+    if arguments.reparse:
+        with metrics.phase('reparse'):
+            reparse_quotes(symbols)
+        if totals_updater is not None:
+            totals_updater.close()
+        export_metrics()
+        return
+
+    # Outbound request rates, shared with other processes
+    rate_limiter = RateLimiter.from_arguments(arguments)
+
+    # Keep-alive sessions and conditional requests for yahoo pages
+    http_client.client = http_client.HttpClient(retries=arguments.http_retries, pool_size=arguments.per_host)
+
+    # Screener chunk size, adapted to how finviz is responding
+    chunk_sizer = ChunkSizer(arguments.chunk, arguments.min_chunk, arguments.chunk_step, arguments.chunk_target)
+
+    # Thread pool used for per-symbol lookups
+    fetch_engine = FetchEngine(arguments.workers, arguments.per_host, arguments.timeout)
+    hedged_fetcher = quote_providers.HedgedFetcher(get_quote_providers(), hedge_after=arguments.hedge_after, max_workers=2 * arguments.workers)
+
+    # Without --end (or on a day the market is closed) this is a single pass.
+    end_datetime = arguments.end_datetime
+    if end_datetime is not None and is_market_closed(datetime.now().date()):
+        logger.info("Market is closed today, running once")
+        end_datetime = None
+
+    clean = arguments.clean
+    while True:
+        cycle_start = datetime.now()
+        refresh_quotes(symbols, clean)
+        clean = False
+
+        next_start = cycle_start + timedelta(seconds=arguments.wait)
+        if end_datetime is None or next_start > end_datetime or (run_deadline is not None and next_start.timestamp() >= run_deadline):
+            break
+        logger.info(f"Cycle took {(datetime.now() - cycle_start).total_seconds():.1f}s, next cycle at {next_start.time()}")
+        _time.sleep(max(0.0, (next_start - datetime.now()).total_seconds()))
+
+        # End the current transaction so changes from other processes are visible.
+        session.commit()
+        with metrics.phase('symbols'):
+            new_fingerprint = get_symbols_fingerprint()
+            if new_fingerprint != fingerprint:
+                logger.info("transaction_list or ticker_symbols changed, re-deriving symbols")
+                fingerprint = new_fingerprint
+                file_port_names = FilePortName()
+                arguments.fileportnames = get_enabled_fileportnames()
+                symbols = get_symbols(arguments.fileportnames)
+                symbol_priorities = get_symbol_priorities(arguments.fileportnames)
+
+    for line in hedged_fetcher.report() + rate_limiter.report() + http_client.get_client().report():
+        logger.info(line)
+    if totals_updater is not None:
+        totals_updater.close()
+    export_metrics()
+    hedged_fetcher.shutdown()
+    fetch_engine.shutdown()
+    if run_deadline is not None:
+        exit_within_deadline()
 
 if __name__ == '__main__':
     configure_logging()
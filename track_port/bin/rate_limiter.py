@@ -0,0 +1,128 @@
+"""Token bucket rate limits shared by every process on the host.
+
+The buckets live in a small JSON file, and each update takes an
+exclusive flock on it, so quote_query, get_a_quote and build_port_history
+all draw from the same buckets for a provider. A caller takes its tokens
+at once, and if that leaves the bucket negative it sleeps until the
+deficit refills. Callers are therefore served in the order they asked,
+without polling. The file also keeps running totals of requests and
+seconds waited per provider.
+
+    limiter = RateLimiter.from_arguments(arguments)  # see add_rate_arguments
+    limiter.acquire('yahoo')
+    requests.get(...)
+
+Providers without a configured rate aren't limited. Given a timeout,
+acquire() raises RateLimitTimeout rather than wait longer, and takes no
+tokens.
+"""
+
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+
+thisdir = os.path.dirname(__file__)
+default_rate_limit_path = os.path.abspath(os.path.join(thisdir, 'rate_limiter.json'))
+
+# provider: (tokens per second, bucket size)
+default_rates = {
+        'yahoo': (4.0, 8.0),
+        'finviz': (10.0, 100.0),
+        }
+
+
+def parse_rates(rate_args):
+    """Turn ['yahoo=2', 'finviz=5/50'] into {provider: (rate, burst)}.
+    The burst defaults to twice the rate.
+    """
+    rates = {}
+    for rate_arg in rate_args:
+        provider, rate = rate_arg.split('=', 1)
+        rate, _, burst = rate.partition('/')
+        rates[provider] = (float(rate), float(burst) if burst else 2.0 * float(rate))
+    return rates
+
+
+def add_rate_arguments(parser):
+    """Add the --rate and --rate_limit_file options, the same for every
+    script that draws from the buckets.
+    """
+    parser.add_argument('--rate', action='append', default=[], help="Requests per second for a provider shared by all processes, provider=rate[/burst] (ie. yahoo=2/4), repeat for more")
+    parser.add_argument('--rate_limit_file', default=default_rate_limit_path, help="File holding the shared rate limit buckets")
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+
+class RateLimiter(object):
+    def __init__(self, path=default_rate_limit_path, rates=None):
+        self.path = path
+        self.rates = dict(default_rates)
+        self.rates.update(rates or {})
+        self.waits = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_arguments(cls, arguments):
+        """The limiter for the options added by add_rate_arguments."""
+        return cls(arguments.rate_limit_file, parse_rates(arguments.rate))
+
+    def reserve(self, provider, tokens, timeout=None):
+        """Take tokens from the provider's bucket and return the seconds to
+        wait before using them. If that is longer than timeout, no tokens
+        are taken and None is returned.
+        """
+        logger = logging.getLogger(__name__ + '.' + 'RateLimiter.reserve')
+        rate, burst = self.rates[provider]
+        now = time.time()
+        try:
+            with open(self.path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or '{}')
+                except ValueError:
+                    state = {}
+                bucket = state.setdefault(provider, {'tokens': burst, 'updated': now, 'requests': 0, 'waited': 0.0})
+                available = min(burst, bucket['tokens'] + (now - bucket['updated']) * rate)
+                wait = max(0.0, (tokens - available) / rate)
+                if timeout is not None and wait > timeout:
+                    return None
+                bucket['tokens'] = available - tokens
+                bucket['updated'] = now
+                bucket['requests'] += 1
+                bucket['waited'] += wait
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state, sort_keys=True))
+                f.flush()
+        except OSError as e:
+            logger.warning(f"Unable to use {self.path}, not rate limiting: {e}")
+            return 0.0
+        return wait
+
+    def acquire(self, provider, tokens=1, timeout=None):
+        """Block until tokens are available for provider. Returns the seconds
+        waited, or raises RateLimitTimeout if that would be over timeout.
+        """
+        if provider not in self.rates:
+            return 0.0
+        wait = self.reserve(provider, tokens, timeout)
+        if wait is None:
+            raise RateLimitTimeout(f"{provider} has no {tokens} tokens within {timeout:.1f}s")
+        if wait > 0:
+            time.sleep(wait)
+        with self.lock:
+            count, total, longest = self.waits.get(provider, (0, 0.0, 0.0))
+            self.waits[provider] = (count + 1, total + wait, max(longest, wait))
+        return wait
+
+    def report(self):
+        """Lines with this process's time spent waiting on each provider."""
+        with self.lock:
+            waits = sorted(self.waits.items())
+        return [f"{provider}: {count} requests, waited {total:.1f}s total, {longest:.1f}s max" for provider, (count, total, longest) in waits]
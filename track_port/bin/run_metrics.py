@@ -0,0 +1,183 @@
+"""Timings and counters for one run of a script.
+
+phase() times a stage of the run, observe() adds a latency to a histogram
+and count() adds to a counter. Histograms and counters take labels, so one
+name covers every kind of symbol or every host. At the end of the run
+write_textfile() writes everything in the Prometheus text format (for
+node_exporter's textfile collector) and write_summary() appends one JSON
+line per run, so runs can be compared with each other.
+
+    metrics = RunMetrics('quote_query')
+    with metrics.phase('fetch_stock'):
+        ...
+    metrics.observe('fetch_seconds', 0.42, kind='stock')
+    metrics.count('screener_failures')
+    metrics.write_textfile('/var/lib/node_exporter/quote_query.prom')
+"""
+
+import os
+import json
+import time
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the histogram buckets
+default_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def label_text(labels):
+    """{'kind': 'stock'} -> '{kind="stock"}'."""
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class Histogram(object):
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.samples = []
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[index] += 1
+
+    def percentile(self, fraction):
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))]
+
+
+class RunMetrics(object):
+    def __init__(self, name, buckets=default_buckets):
+        self.name = name
+        self.buckets = buckets
+        self.start_time = time.time()
+        self.phases = {}      # phase: [times entered, seconds]
+        self.histograms = {}  # (name, labels): Histogram
+        self.slowest = {}     # (name, labels): [(seconds, key)] of the slowest observations
+        self.counters = {}    # (name, labels): value
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, phase):
+        """Time the body of a with statement as phase. A phase entered more
+        than once (one per cycle) adds up.
+        """
+        logger = logging.getLogger(__name__ + '.' + 'RunMetrics.phase')
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                entered, seconds = self.phases.get(phase, (0, 0.0))
+                self.phases[phase] = [entered + 1, seconds + elapsed]
+            logger.debug(f"{phase} took {elapsed:.2f}s")
+
+    def observe(self, name, seconds, key=None, **labels):
+        """Add seconds to the name histogram. key (ie. the symbol) is kept
+        for the ten slowest observations of each histogram.
+        """
+        series = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if series not in self.histograms:
+                self.histograms[series] = Histogram(self.buckets)
+            self.histograms[series].observe(seconds)
+            if key is not None:
+                slowest = self.slowest.setdefault(series, [])
+                slowest.append((seconds, key))
+                slowest.sort(reverse=True)
+                del slowest[10:]
+
+    def count(self, name, value=1, **labels):
+        series = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[series] = self.counters.get(series, 0) + value
+
+    def textfile(self):
+        """The metrics in the Prometheus text exposition format. Phases and
+        counters are gauges, they hold the values of this run only.
+        """
+        prefix = self.name
+        lines = []
+        with self.lock:
+            lines.append(f"# HELP {prefix}_last_run_timestamp_seconds When the last run started")
+            lines.append(f"# TYPE {prefix}_last_run_timestamp_seconds gauge")
+            lines.append(f"{prefix}_last_run_timestamp_seconds {self.start_time:.3f}")
+            lines.append(f"# HELP {prefix}_run_seconds Length of the last run")
+            lines.append(f"# TYPE {prefix}_run_seconds gauge")
+            lines.append(f"{prefix}_run_seconds {time.time() - self.start_time:.3f}")
+
+            lines.append(f"# HELP {prefix}_phase_seconds Seconds spent in each phase of the last run")
+            lines.append(f"# TYPE {prefix}_phase_seconds gauge")
+            for phase, (_, seconds) in sorted(self.phases.items()):
+                lines.append(f'{prefix}_phase_seconds{{phase="{phase}"}} {seconds:.3f}')
+
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {prefix}_{name} histogram")
+                for (series_name, labels), histogram in sorted(self.histograms.items()):
+                    if series_name != name:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{prefix}_{name}_bucket{label_text(labels + (('le', bound),))} {count}")
+                    lines.append(f"{prefix}_{name}_bucket{label_text(labels + (('le', '+Inf'),))} {len(histogram.samples)}")
+                    lines.append(f"{prefix}_{name}_sum{label_text(labels)} {sum(histogram.samples):.3f}")
+                    lines.append(f"{prefix}_{name}_count{label_text(labels)} {len(histogram.samples)}")
+
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {prefix}_{name} gauge")
+                for (series_name, labels), value in sorted(self.counters.items()):
+                    if series_name == name:
+                        lines.append(f"{prefix}_{name}{label_text(labels)} {value:g}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """The metrics as a dict, with p50/p95/max for each histogram."""
+        def series_name(name, labels):
+            return name + label_text(labels)
+
+        with self.lock:
+            return {
+                    'name': self.name,
+                    'host': socket.gethostname(),
+                    'start': self.start_time,
+                    'seconds': round(time.time() - self.start_time, 3),
+                    'phases': {phase: {'entered': entered, 'seconds': round(seconds, 3)} for phase, (entered, seconds) in sorted(self.phases.items())},
+                    'histograms': {
+                        series_name(*series): {
+                            'count': len(histogram.samples),
+                            'sum': round(sum(histogram.samples), 3),
+                            'p50': round(histogram.percentile(0.50), 3),
+                            'p95': round(histogram.percentile(0.95), 3),
+                            'max': round(max(histogram.samples), 3),
+                            'slowest': [[key, round(seconds, 3)] for seconds, key in self.slowest.get(series, [])],
+                            }
+                        for series, histogram in sorted(self.histograms.items())
+                        },
+                    'counters': {series_name(*series): value for series, value in sorted(self.counters.items())},
+                    }
+
+    def write_textfile(self, path):
+        """Replace path with textfile(), atomically so the collector never
+        reads half a file.
+        """
+        logger = logging.getLogger(__name__ + '.' + 'RunMetrics.write_textfile')
+        try:
+            with open(f"{path}.{os.getpid()}.tmp", 'w') as f:
+                f.write(self.textfile())
+            os.replace(f"{path}.{os.getpid()}.tmp", path)
+        except OSError as e:
+            logger.warning(f"Unable to write {path}: {e}")
+
+    def write_summary(self, path):
+        """Append summary() to path as one JSON line."""
+        logger = logging.getLogger(__name__ + '.' + 'RunMetrics.write_summary')
+        try:
+            with open(path, 'a') as f:
+                f.write(json.dumps(self.summary(), sort_keys=True) + '\n')
+        except OSError as e:
+            logger.warning(f"Unable to write {path}: {e}")
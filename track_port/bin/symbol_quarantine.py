@@ -0,0 +1,97 @@
+"""Persistent record of symbols that keep failing to quote.
+
+Each failed run for a symbol doubles the time before it is tried again,
+from base_delay up to max_delay. The first failures_allowed failures in a
+row are not held back, so one bad run doesn't quarantine anything. A
+successful quote clears the symbol. State lives in a small JSON file:
+
+    {"XYZ": {"failures": 3, "last_failure": "2023-06-14T09:35:12", "retry_after": "2023-06-14T13:35:12"}}
+"""
+
+import os
+import json
+import logging
+from datetime import datetime, timedelta
+
+thisdir = os.path.dirname(__file__)
+default_quarantine_path = os.path.abspath(os.path.join(thisdir, 'quote_quarantine.json'))
+
+
+class SymbolQuarantine(object):
+    def __init__(self, path=default_quarantine_path, failures_allowed=1, base_delay=timedelta(hours=1), max_delay=timedelta(days=7)):
+        self.path = path
+        self.failures_allowed = failures_allowed
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        logger = logging.getLogger(__name__ + '.' + 'SymbolQuarantine.load')
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Unable to read {self.path}, starting empty: {e}")
+            self.entries = {}
+
+    def save(self):
+        logger = logging.getLogger(__name__ + '.' + 'SymbolQuarantine.save')
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            logger.warning(f"Unable to write {self.path}: {e}")
+
+    def retry_after(self, symbol):
+        entry = self.entries.get(symbol)
+        if entry is None or entry['retry_after'] is None:
+            return None
+        return datetime.fromisoformat(entry['retry_after'])
+
+    def is_quarantined(self, symbol, now=None):
+        retry_after = self.retry_after(symbol)
+        return retry_after is not None and (now or datetime.now()) < retry_after
+
+    def split(self, symbols, now=None):
+        """Return (symbols to fetch, quarantined symbols)."""
+        now = now or datetime.now()
+        quarantined = {symbol for symbol in symbols if self.is_quarantined(symbol, now)}
+        return set(symbols) - quarantined, quarantined
+
+    def record_failure(self, symbol, now=None):
+        logger = logging.getLogger(__name__ + '.' + 'SymbolQuarantine.record_failure')
+        now = now or datetime.now()
+        entry = self.entries.setdefault(symbol, {'failures': 0, 'last_failure': None, 'retry_after': None})
+        entry['failures'] += 1
+        entry['last_failure'] = now.isoformat(timespec='seconds')
+        held_failures = entry['failures'] - self.failures_allowed
+        if held_failures > 0:
+            delay = min(self.base_delay * 2 ** (held_failures - 1), self.max_delay)
+            entry['retry_after'] = (now + delay).isoformat(timespec='seconds')
+            logger.info(f"Quarantining {symbol} after {entry['failures']} failures until {entry['retry_after']}")
+
+    def record_success(self, symbol):
+        self.entries.pop(symbol, None)
+
+    def release(self, symbols):
+        """Forget symbols (all of them if symbols contains 'all'). Returns released symbols."""
+        if 'all' in symbols:
+            symbols = list(self.entries.keys())
+        released = [symbol for symbol in symbols if symbol in self.entries]
+        for symbol in released:
+            del self.entries[symbol]
+        return released
+
+    def report(self, now=None):
+        """Lines describing every symbol with recorded failures, quarantined first."""
+        now = now or datetime.now()
+        lines = []
+        for symbol, entry in sorted(self.entries.items(), key=lambda item: (not self.is_quarantined(item[0], now), item[0])):
+            state = 'quarantined' if self.is_quarantined(symbol, now) else 'watching'
+            lines.append(f"{symbol:24s} {state:12s} failures={entry['failures']:<4d} last_failure={entry['last_failure']} retry_after={entry['retry_after']}")
+        return lines
+
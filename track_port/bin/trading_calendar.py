@@ -0,0 +1,169 @@
+"""Trading days built from the market_holiday table.
+
+The market is open on weekdays that are not in market_holiday. The table
+is read once into a sorted list of trading day ordinals, so lookups are a
+bisect instead of a query per day. The list can be cached on disk; the
+cache is keyed on a digest of every market_holiday date, so it is
+rebuilt whenever any holiday is added, removed or moved.
+
+    calendar = TradingCalendar.from_session(session, MarketHolidays)
+    calendar.is_open(day)
+    calendar.previous_trading_day(day)
+    calendar.trading_days_between(start, end)
+"""
+
+import os
+import json
+import hashlib
+import logging
+from bisect import bisect_left, bisect_right
+from datetime import date, timedelta
+
+thisdir = os.path.dirname(__file__)
+default_cache_path = os.path.abspath(os.path.join(thisdir, 'trading_calendar.json'))
+
+# Trading days are generated from first_year through this many days past
+# the later of today and the last holiday in the table.
+first_year = 1990
+days_ahead = 2 * 366
+
+
+class TradingCalendar(object):
+    def __init__(self, holidays, start=None, end=None):
+        logger = logging.getLogger(__name__ + '.' + 'TradingCalendar')
+        self.holidays = set(holidays)
+        self.start = start or date(first_year, 1, 1)
+        self.end = end or (max(self.holidays | {date.today()}) + timedelta(days=days_ahead))
+        self.ordinals = [
+                ordinal for ordinal in range(self.start.toordinal(), self.end.toordinal() + 1)
+                if self.weekday_open(date.fromordinal(ordinal))
+                ]
+        logger.debug(f"{len(self.ordinals)} trading days from {self.start} to {self.end}, {len(self.holidays)} holidays")
+
+    @classmethod
+    def from_session(cls, session, market_holidays, cache_path=None):
+        """Build a calendar from the market_holiday table.
+        market_holidays is the caller's declarative class for the table.
+        """
+        logger = logging.getLogger(__name__ + '.' + 'TradingCalendar.from_session')
+        # The table is a few hundred dates, reading them all is cheap
+        holidays = sorted(row.date for row in session.query(market_holidays.date))
+        fingerprint = hashlib.sha1(' '.join(str(holiday) for holiday in holidays).encode()).hexdigest()
+
+        if cache_path:
+            calendar = cls.load_cache(cache_path, fingerprint)
+            if calendar is not None:
+                return calendar
+
+        calendar = cls(holidays)
+        if cache_path:
+            calendar.save_cache(cache_path, fingerprint)
+        return calendar
+
+    @classmethod
+    def load_cache(cls, cache_path, fingerprint):
+        logger = logging.getLogger(__name__ + '.' + 'TradingCalendar.load_cache')
+        try:
+            with open(cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return None
+        end = date.fromordinal(cache['end'])
+        if cache['fingerprint'] != fingerprint or end < date.today() + timedelta(days=366):
+            logger.debug(f"cache {cache_path} is stale")
+            return None
+        calendar = cls.__new__(cls)
+        calendar.holidays = {date.fromordinal(ordinal) for ordinal in cache['holidays']}
+        calendar.start = date.fromordinal(cache['start'])
+        calendar.end = end
+        calendar.ordinals = cache['ordinals']
+        logger.debug(f"loaded {len(calendar.ordinals)} trading days from {cache_path}")
+        return calendar
+
+    def save_cache(self, cache_path, fingerprint):
+        logger = logging.getLogger(__name__ + '.' + 'TradingCalendar.save_cache')
+        cache = {
+                'fingerprint': fingerprint,
+                'start': self.start.toordinal(),
+                'end': self.end.toordinal(),
+                'holidays': sorted(holiday.toordinal() for holiday in self.holidays),
+                'ordinals': self.ordinals,
+                }
+        try:
+            with open(cache_path + '.tmp', 'w') as f:
+                json.dump(cache, f)
+            os.replace(cache_path + '.tmp', cache_path)
+        except OSError as e:
+            logger.warning(f"Unable to write {cache_path}: {e}")
+
+    def weekday_open(self, day):
+        return day.isoweekday() < 6 and day not in self.holidays
+
+    def in_range(self, day):
+        return self.start <= day <= self.end
+
+    def is_open(self, day):
+        """True if the market trades on day."""
+        if not self.in_range(day):
+            return self.weekday_open(day)
+        ordinal = day.toordinal()
+        index = bisect_left(self.ordinals, ordinal)
+        return index < len(self.ordinals) and self.ordinals[index] == ordinal
+
+    def previous_trading_day(self, day, inclusive=False):
+        """Latest trading day before day (on or before day if inclusive)."""
+        if not self.in_range(day):
+            if not (inclusive and self.weekday_open(day)):
+                day -= timedelta(days=1)
+                while not self.weekday_open(day):
+                    day -= timedelta(days=1)
+            return day
+        ordinal = day.toordinal()
+        index = (bisect_right if inclusive else bisect_left)(self.ordinals, ordinal)
+        if index == 0:
+            raise ValueError(f"No trading day before {day}")
+        return date.fromordinal(self.ordinals[index - 1])
+
+    def next_trading_day(self, day, inclusive=False):
+        """Earliest trading day after day (on or after day if inclusive)."""
+        ordinal = day.toordinal()
+        index = (bisect_left if inclusive else bisect_right)(self.ordinals, ordinal)
+        if self.in_range(day) and index < len(self.ordinals):
+            return date.fromordinal(self.ordinals[index])
+        if not (inclusive and self.weekday_open(day)):
+            day += timedelta(days=1)
+            while not self.weekday_open(day):
+                day += timedelta(days=1)
+        return day
+
+    def trading_days_between(self, start, end):
+        """List of trading days from start through end, both inclusive."""
+        if not (self.in_range(start) and self.in_range(end)):
+            return [start + timedelta(days=offset) for offset in range((end - start).days + 1) if self.weekday_open(start + timedelta(days=offset))]
+        first = bisect_left(self.ordinals, start.toordinal())
+        last = bisect_right(self.ordinals, end.toordinal())
+        return [date.fromordinal(ordinal) for ordinal in self.ordinals[first:last]]
+
+    def count_trading_days(self, start, end):
+        """Number of trading days from start through end, both inclusive."""
+        if not (self.in_range(start) and self.in_range(end)):
+            return len(self.trading_days_between(start, end))
+        return max(0, bisect_right(self.ordinals, end.toordinal()) - bisect_left(self.ordinals, start.toordinal()))
+
+    def trading_day_offset(self, day, days):
+        """The trading day days trading days before day (after day when
+        days is negative). day itself is only returned when days is 0.
+        """
+        if days == 0:
+            return day
+        ordinal = day.toordinal()
+        if days > 0:
+            index = bisect_left(self.ordinals, ordinal) - days
+        else:
+            index = bisect_right(self.ordinals, ordinal) - days - 1
+        if self.in_range(day) and 0 <= index < len(self.ordinals):
+            return date.fromordinal(self.ordinals[index])
+        for _ in range(abs(days)):
+            day = self.previous_trading_day(day) if days > 0 else self.next_trading_day(day)
+        return day
+
@@ -0,0 +1,95 @@
+import sys
+import os
+import gzip
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+from http_client import HttpClient
+
+page = b'<html><body>' + b'quote ' * 1000 + b'</body></html>'
+
+class QuoteHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = set()
+    failures = {}
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, body=b'', headers=()):
+        self.send_response(status)
+        for header, value in headers:
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        QuoteHandler.connections.add(self.client_address)
+        if self.path.startswith('/flaky'):
+            count = QuoteHandler.failures.get(self.path, 0)
+            QuoteHandler.failures[self.path] = count + 1
+            if count < 2:
+                return self.send_body(503, headers=[('Retry-After', '0')])
+        if self.headers.get('If-None-Match') == '"v1"':
+            return self.send_body(304, headers=[('ETag', '"v1"')])
+        body = page
+        headers = [('ETag', '"v1"')]
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(page)
+            headers.append(('Content-Encoding', 'gzip'))
+        self.send_body(200, body, headers)
+
+#############################################################################
+# Test HttpClient against a local server
+#############################################################################
+class TestHttpClient(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), QuoteHandler)
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def test_gzip_and_not_modified(self):
+        client = HttpClient()
+        response = client.get(f"{self.url}/quote/AAPL")
+        self.assertEqual((response.status_code, response.content, response.not_modified), (200, page, False))
+        response = client.get(f"{self.url}/quote/AAPL")
+        self.assertEqual((response.status_code, response.content, response.not_modified), (200, page, True))
+        stats = client.stats[f"127.0.0.1:{self.server.server_address[1]}"]
+        self.assertEqual((stats.requests, stats.not_modified), (2, 1))
+        self.assertLess(stats.wire_bytes, len(page))
+        self.assertEqual(len(client.report()), 1)
+
+    def test_cache_bytes(self):
+        client = HttpClient(cache_bytes=2 * len(page))
+        for symbol in ('AAPL', 'MSFT', 'IBM'):
+            client.get(f"{self.url}/quote/{symbol}")
+        self.assertEqual(list(client.cache), [f"{self.url}/quote/MSFT", f"{self.url}/quote/IBM"])
+        self.assertEqual(client.cached_bytes, 2 * len(page))
+        client.get(f"{self.url}/quote/MSFT")
+        self.assertEqual(client.cached_bytes, 2 * len(page))
+        self.assertFalse(client.get(f"{self.url}/quote/AAPL").not_modified)
+
+    def test_keep_alive(self):
+        QuoteHandler.connections.clear()
+        client = HttpClient()
+        for symbol in ('AAPL', 'MSFT', 'IBM'):
+            client.get(f"{self.url}/quote/{symbol}", conditional=False)
+        self.assertEqual(len(QuoteHandler.connections), 1)
+
+    def test_retry(self):
+        client = HttpClient(retries=2, backoff=0.01)
+        response = client.get(f"{self.url}/flaky/AAPL")
+        self.assertEqual(response.status_code, 200)
+        response = HttpClient(retries=0).get(f"{self.url}/flaky/MSFT")
+        self.assertEqual(response.status_code, 503)
+
+if __name__ == '__main__':
+    unittest.main()
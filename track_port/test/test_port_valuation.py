@@ -0,0 +1,145 @@
+import sys
+import os
+import random
+import tempfile
+import unittest
+from types import SimpleNamespace
+from decimal import Decimal
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+import port_valuation
+import decimal_valuation
+
+cent = Decimal('0.01')
+
+def transaction(id, position='long', descriptor='stock', symbol='AAPL', shares=None, open_price=None, closed=False, close_price=None, expiration=None, strike=None):
+    return SimpleNamespace(id=id, position=position, descriptor=descriptor, symbol=symbol, shares=shares, open_price=open_price,
+            closed=closed, close_price=close_price, expiration=expiration, strike=strike)
+
+def price(low, high):
+    return Decimal(random.randint(low * 10000, high * 10000)) / 10000
+
+#############################################################################
+# Test numpy valuation against the Decimal arithmetic put_totals uses
+#############################################################################
+class TestPortValuation(unittest.TestCase):
+    def test_quote_symbol(self):
+        call = transaction(1, descriptor='call', symbol='AAPL', expiration=date(2023, 6, 16), strike=Decimal('150.0'))
+        self.assertEqual(port_valuation.quote_symbol(call), 'AAPL230616C00150000')
+        self.assertEqual(port_valuation.quote_symbol(transaction(2)), 'AAPL')
+
+    def test_small_port(self):
+        finance_quotes = {
+                'AAPL': SimpleNamespace(last=Decimal('165.23'), net=Decimal('-1.10')),
+                'AAPL230616C00150000': SimpleNamespace(last=Decimal('3.25'), net=Decimal('0.15')),
+                }
+        transactions_by_port = {7: [
+                transaction(1, position='cash', descriptor='cash', symbol='CASH', open_price=Decimal('10000')),
+                transaction(2, shares=Decimal('10'), open_price=Decimal('150.00')),
+                transaction(3, descriptor='call', shares=Decimal('100'), open_price=Decimal('2.50'), expiration=date(2023, 6, 16), strike=Decimal('150')),
+                transaction(4, symbol='GONE', shares=Decimal('5'), open_price=Decimal('20'), closed=True, close_price=Decimal('25')),
+                transaction(5, symbol='NOQUOTE', shares=Decimal('2'), open_price=Decimal('10')),
+                transaction(6, position='short', shares=Decimal('1'), open_price=Decimal('1')),
+                ]}
+        valuation = port_valuation.Positions.from_transactions(transactions_by_port).value(finance_quotes)[7]
+        self.assertEqual(valuation['cash'], Decimal('8255.0000'))
+        self.assertEqual(valuation['basis'], Decimal('1770.0000'))
+        self.assertEqual(valuation['gain'], Decimal('227.3000'))
+        self.assertEqual(valuation['daygain'], Decimal('4.0000'))
+        self.assertEqual(valuation['invested_total'], Decimal('1977.3000'))
+        self.assertEqual(decimal_valuation.value_transactions(transactions_by_port[7], finance_quotes), valuation)
+
+    def test_parity_to_the_cent(self):
+        random.seed(11)
+        symbols = [f"S{index:03d}" for index in range(200)]
+        finance_quotes = {symbol: SimpleNamespace(last=price(1, 2000), net=price(0, 40) - 20) for symbol in symbols[:190]}
+        transactions_by_port = {}
+        next_id = 1
+        for port_id in range(1, 301):
+            transactions = [transaction(next_id, position='cash', descriptor='cash', symbol='CASH', open_price=price(0, 100000))]
+            next_id += 1
+            for _ in range(random.randint(0, 60)):
+                closed = random.random() < 0.2
+                transactions.append(transaction(next_id, symbol=random.choice(symbols), shares=Decimal(random.randint(1, 5000)), open_price=price(1, 2000),
+                        closed=closed, close_price=price(1, 2000) if closed else None))
+                next_id += 1
+            transactions_by_port[port_id] = transactions
+        valuations = port_valuation.Positions.from_transactions(transactions_by_port).value(finance_quotes)
+        for port_id, transactions in transactions_by_port.items():
+            expected = decimal_valuation.value_transactions(transactions, finance_quotes)
+            for field in port_valuation.valuation_fields:
+                self.assertEqual(valuations[port_id][field].quantize(cent), expected[field].quantize(cent), f"port {port_id} {field}")
+
+#############################################################################
+# Test saved lots and transaction versions
+#############################################################################
+class TestPositionSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'port_positions.json')
+        self.finance_quotes = {'AAPL': SimpleNamespace(last=Decimal('165.23'), net=Decimal('-1.10'))}
+        self.transactions_by_port = {
+                1: [transaction(1, position='cash', descriptor='cash', symbol='CASH', open_price=Decimal('5000')),
+                    transaction(2, shares=Decimal('10'), open_price=Decimal('150.00'))],
+                2: [transaction(3, shares=Decimal('3'), open_price=Decimal('100.00'), closed=True, close_price=Decimal('110.00'))],
+                }
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_round_trip(self):
+        versions = {1: ['2', '2'], 2: ['1', '3']}
+        snapshot = port_valuation.PositionSnapshot(self.path)
+        self.assertEqual(snapshot.stale_ports(versions), {1, 2})
+        snapshot.update(versions, self.transactions_by_port)
+        snapshot.save()
+
+        snapshot = port_valuation.PositionSnapshot(self.path)
+        self.assertEqual(snapshot.stale_ports(versions), set())
+        self.assertEqual(snapshot.stale_ports({1: ['3', '4'], 2: ['1', '3'], 3: ['1', '5']}), {1, 3})
+        expected = port_valuation.Positions.from_transactions(self.transactions_by_port).value(self.finance_quotes)
+        self.assertEqual(port_valuation.Positions(snapshot.lots_by_port()).value(self.finance_quotes), expected)
+        self.assertEqual(expected[2]['cash'], Decimal('30.0000'))
+
+    def test_update_only_stale_ports(self):
+        snapshot = port_valuation.PositionSnapshot(self.path)
+        snapshot.update({1: ['2', '2'], 2: ['1', '3']}, self.transactions_by_port)
+        snapshot.update({1: ['3', '4']}, {1: self.transactions_by_port[1] + [transaction(4, position='cash', descriptor='cash', symbol='CASH', open_price=Decimal('100'))]})
+        self.assertEqual(sorted(snapshot.ports), [1])
+        self.assertEqual(snapshot.ports[1]['cash'], Decimal('5100'))
+
+    def test_ports_holding(self):
+        snapshot = port_valuation.PositionSnapshot(self.path)
+        snapshot.update({1: ['2', '2'], 2: ['1', '3']}, self.transactions_by_port)
+        self.assertEqual(snapshot.ports_holding({'AAPL', 'MSFT'}), {1})
+        self.assertEqual(snapshot.ports_holding({'MSFT'}), set())
+        self.assertEqual(snapshot.symbols({1, 2, 3}), {'AAPL'})
+        snapshot.update({1: ['2', '2'], 2: ['2', '4']}, {2: [transaction(4, shares=Decimal('1'), open_price=Decimal('100.00'))]})
+        self.assertEqual(snapshot.ports_holding({'AAPL'}), {1, 2})
+
+    def test_digest_check(self):
+        snapshot = port_valuation.PositionSnapshot(self.path)
+        self.assertFalse(snapshot.check_due(timedelta(hours=1)))
+        snapshot.update({1: ['2', '2'], 2: ['1', '3']}, self.transactions_by_port)
+        snapshot.save()
+        snapshot = port_valuation.PositionSnapshot(self.path)
+        rows = [tuple(getattr(t, column) for column in port_valuation.digest_columns) for t in self.transactions_by_port[1]]
+        digests = {1: port_valuation.transactions_digest(rows), 2: snapshot.ports[2]['digest']}
+        self.assertEqual(snapshot.stale_ports(digests, key='digest'), set())
+        rows[1] = rows[1][:1] + ('MSFT',) + rows[1][2:]
+        self.assertEqual(snapshot.stale_ports({1: port_valuation.transactions_digest(rows)}, key='digest'), {1})
+        self.assertFalse(snapshot.check_due(timedelta(hours=1)))
+        snapshot.checked -= timedelta(hours=2)
+        self.assertTrue(snapshot.check_due(timedelta(hours=1)))
+
+    def test_max_age(self):
+        snapshot = port_valuation.PositionSnapshot(self.path)
+        snapshot.update({1: ['2', '2']}, {1: self.transactions_by_port[1]})
+        snapshot.built = datetime.now() - timedelta(days=2)
+        snapshot.save()
+        self.assertEqual(port_valuation.PositionSnapshot(self.path).ports, {})
+        self.assertEqual(len(port_valuation.PositionSnapshot(self.path, max_age=timedelta(days=3)).ports), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import sys
+import os
+import tempfile
+import unittest
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+import quote_archive
+import bench_quote_parsers
+
+pages_dir = os.path.join(os.path.dirname(__file__), 'quote_pages')
+day = date(2023, 6, 14)
+
+#############################################################################
+# Test saving and reading back archived pages
+#############################################################################
+class TestQuoteArchive(unittest.TestCase):
+    def setUp(self):
+        self.archive = quote_archive.QuoteArchive(tempfile.mkdtemp())
+
+    def test_round_trip(self):
+        content = b'<html><body><h1>Apple Inc. (AAPL)</h1></body></html>'
+        self.archive.save('stock', 'AAPL', content, day=day)
+        self.archive.save('chain', 'AAPL_2023-06-16', content, day=day)
+        pages = self.archive.pages(day)
+        self.assertEqual([(kind, name) for kind, name, _ in pages], [('chain', 'AAPL_2023-06-16'), ('stock', 'AAPL')])
+        self.assertTrue(pages[1][2].endswith('stock_AAPL.html.gz'))
+        self.assertEqual(quote_archive.read_page(pages[1][2]), content)
+        self.assertEqual(self.archive.pages(date(2023, 6, 15)), [])
+
+    def test_bench_reads_archive(self):
+        for page in bench_quote_parsers.load_pages(pages_dir):
+            kind, symbol, content = page
+            self.archive.save(kind, symbol, content, day=day)
+        self.archive.save('chain', 'AAPL_2023-06-16', b'', day=day)
+        archived = bench_quote_parsers.load_pages(self.archive.day_path(day))
+        self.assertEqual(archived, bench_quote_parsers.load_pages(pages_dir))
+        self.assertEqual(bench_quote_parsers.check_backends(archived, ['lxml']), [])
+
+    def test_no_zstandard_falls_back(self):
+        if quote_archive.zstandard is not None:
+            self.skipTest("zstandard is installed")
+        self.assertEqual(quote_archive.QuoteArchive(self.archive.root, 'zstd').compression, 'gzip')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+import quote_parsers
+import bench_quote_parsers
+
+pages_dir = os.path.join(os.path.dirname(__file__), 'quote_pages')
+
+def read_page(name):
+    with open(os.path.join(pages_dir, name), 'rb') as f:
+        return f.read()
+
+#############################################################################
+# Test the backends against the saved pages
+#############################################################################
+class TestBackends(unittest.TestCase):
+    def test_backends_match_soup(self):
+        pages = bench_quote_parsers.load_pages(pages_dir)
+        self.assertEqual(len(pages), 4)
+        mismatches = bench_quote_parsers.check_backends(pages, list(quote_parsers.backends.keys()))
+        self.assertEqual(mismatches, [])
+
+    def test_stock_details(self):
+        page = quote_parsers.parse_quote_page(read_page('stock_AAPL.html'), 'lxml')
+        details = quote_parsers.parse_stock('AAPL', page)
+        self.assertEqual(details['Company'], 'Apple Inc. (AAPL)')
+        self.assertEqual(details['Price'], 165.23)
+        self.assertEqual(details['Prev Close'], 163.76)
+        self.assertEqual(details['Day Range'], '163.51 - 165.80')
+        self.assertEqual(details['Volume'], '58,337,341')
+
+    def test_option_details(self):
+        page = quote_parsers.parse_quote_page(read_page('option_AAPL230616C00150000.html'), 'strainer')
+        details = quote_parsers.parse_option('AAPL230616C00150000', page)
+        self.assertEqual(details['Bid'], 17.35)
+        self.assertEqual(details['Ask'], 17.55)
+        self.assertEqual(details['Day Range'], "'16.80 - 17.60'")
+
+    def test_fallback_to_soup(self):
+        content = read_page('index_^GSPC.html')
+        page = quote_parsers.parse_quote_page(content, 'lxml')
+        self.assertEqual(page, quote_parsers.parse_soup(content))
+        # A page the fast backend can't read at all still goes through soup
+        page = quote_parsers.parse_quote_page(b'', 'lxml')
+        self.assertIsNone(page.last)
+
+    def test_missing_last(self):
+        page = quote_parsers.parse_quote_page(b'<html><body><h1>Nothing here</h1></body></html>', 'lxml')
+        self.assertEqual(quote_parsers.parse_stock('XXXX', page), {})
+        with self.assertRaises(ValueError):
+            quote_parsers.parse_index('^XXXX', page)
+
+#############################################################################
+# Test option chain parsing
+#############################################################################
+option_chain_page = b'''<html><body><h1>Apple Inc. (AAPL)</h1>
+<table class="calls W(100%) Pos(r) Bd(0) Pt(0) list-options"><thead><tr><th>Contract name</th></tr></thead><tbody>
+<tr class="data-row0"><td><a href="/quote/AAPL230616C00150000">AAPL230616C00150000</a></td><td>2023-06-14 3:59PM EDT</td><td><a>150.00</a></td>
+<td>17.45</td><td>17.35</td><td>17.55</td><td><span>+0.85</span></td><td><span>+5.12%</span></td><td>1,204</td><td>35,117</td><td>28.52%</td></tr>
+<tr class="data-row1"><td><a href="/quote/AAPL230616C00155000">AAPL230616C00155000</a></td><td>2023-06-14 3:58PM EDT</td><td><a>155.00</a></td>
+<td>13.10</td><td>-</td><td>-</td><td><span>-</span></td><td><span>-</span></td><td>-</td><td>2,001</td><td>27.10%</td></tr>
+</tbody></table>
+<table class="puts W(100%) Pos(r) list-options"><tbody>
+<tr class="data-row0"><td><a href="/quote/AAPL230616P00150000">AAPL230616P00150000</a></td><td>2023-06-14 3:59PM EDT</td><td><a>150.00</a></td>
+<td>0.42</td><td>0.41</td><td>0.43</td><td><span>-0.08</span></td><td><span>-16.00%</span></td><td>9,310</td><td>41,500</td><td>30.01%</td></tr>
+</tbody></table></body></html>'''
+
+class TestOptionChain(unittest.TestCase):
+    def test_backends_match(self):
+        chain = quote_parsers.parse_option_chain(option_chain_page, 'soup')
+        self.assertEqual(sorted(chain.keys()), ['AAPL230616C00150000', 'AAPL230616C00155000', 'AAPL230616P00150000'])
+        self.assertEqual(chain, quote_parsers.parse_option_chain(option_chain_page, 'lxml'))
+
+    def test_chain_row_details(self):
+        chain = quote_parsers.parse_option_chain(option_chain_page)
+        details = quote_parsers.parse_option_chain_row('AAPL230616C00150000', chain['AAPL230616C00150000'])
+        self.assertEqual(details['Company'][:32], 'AAPL Jun 2023 150.000 call (AAPL')
+        self.assertEqual(details['Price'], 17.45)
+        self.assertAlmostEqual(details['Prev Close'], 16.60)
+        self.assertEqual(details['Bid'], 17.35)
+        self.assertEqual(details['Volume'], '1,204')
+        self.assertNotIn('Day Range', details)
+        details = quote_parsers.parse_option_chain_row('AAPL230616C00155000', chain['AAPL230616C00155000'])
+        self.assertEqual(details['Prev Close'], 13.10)
+        self.assertEqual(details['Volume'], '0')
+        self.assertEqual(details['Ask'], 0.0)
+
+    def test_split_option_symbol(self):
+        underlying, expiration, descriptor, strike = quote_parsers.split_option_symbol('BRKB230120P00287500')
+        self.assertEqual((underlying, str(expiration), descriptor, strike), ('BRKB', '2023-01-20', 'put', 287.5))
+        with self.assertRaises(ValueError):
+            quote_parsers.split_option_symbol('AAPL')
+
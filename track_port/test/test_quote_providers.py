@@ -0,0 +1,128 @@
+import sys
+import os
+import time
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+import quote_providers
+from rate_limiter import RateLimiter
+
+pages_dir = os.path.join(os.path.dirname(__file__), 'quote_pages')
+
+class FakeProvider(quote_providers.Provider):
+    kinds = ('stock',)
+
+    def __init__(self, name, delay, price=None):
+        super().__init__()
+        self.name = name
+        self.delay = delay
+        self.price = price
+        self.calls = 0
+        self.timeouts = []
+
+    def get_details(self, kind, symbol, timeout):
+        self.calls += 1
+        self.timeouts.append(timeout)
+        time.sleep(self.delay)
+        if self.price is None:
+            raise ValueError("no quote")
+        return {'Ticker': symbol, 'Price': self.price}
+
+#############################################################################
+# Test latency bookkeeping
+#############################################################################
+class TestLatencyStats(unittest.TestCase):
+    def test_percentiles(self):
+        stats = quote_providers.LatencyStats()
+        self.assertIsNone(stats.p95)
+        for seconds in range(1, 101):
+            stats.record(seconds / 100.0, True)
+        stats.record(5.0, False)
+        self.assertAlmostEqual(stats.p50, 0.51)
+        self.assertAlmostEqual(stats.p95, 0.95)
+        self.assertAlmostEqual(stats.success_rate, 100 / 101)
+
+#############################################################################
+# Test providers and hedging
+#############################################################################
+class TestHedgedFetcher(unittest.TestCase):
+    def test_local_provider(self):
+        provider = quote_providers.LocalProvider(pages_dir)
+        fetcher = quote_providers.HedgedFetcher([provider])
+        self.assertEqual(fetcher.fetch('stock', 'AAPL')['Price'], 165.23)
+        self.assertEqual(fetcher.fetch('stock', 'MSFT'), {})
+        self.assertEqual((provider.stats.successes, provider.stats.failures), (1, 1))
+        fetcher.shutdown()
+
+    def test_hedge_slow_provider(self):
+        slow = FakeProvider('slow', 1.0, price=1.0)
+        fast = FakeProvider('fast', 0.0, price=2.0)
+        fetcher = quote_providers.HedgedFetcher([slow, fast], hedge_after=0.05)
+        start = time.time()
+        self.assertEqual(fetcher.fetch('stock', 'AAPL')['Price'], 2.0)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(slow.stats.hedges, 1)
+        fetcher.shutdown()
+
+    def test_no_hedge_when_fast(self):
+        primary = FakeProvider('primary', 0.0, price=1.0)
+        backup = FakeProvider('backup', 0.0, price=2.0)
+        fetcher = quote_providers.HedgedFetcher([primary, backup], hedge_after=0.5)
+        self.assertEqual(fetcher.fetch('stock', 'AAPL')['Price'], 1.0)
+        self.assertEqual(backup.calls, 0)
+        fetcher.shutdown()
+
+    def test_lookup_hangs_past_deadline(self):
+        hung = FakeProvider('hung', 5.0, price=1.0)
+        hedge = FakeProvider('hedge', 5.0, price=2.0)
+        fetcher = quote_providers.HedgedFetcher([hung, hedge], hedge_after=0.1)
+        start = time.time()
+        self.assertEqual(fetcher.fetch('stock', 'AAPL', timeout=0.4), {})
+        self.assertLess(time.time() - start, 0.6)
+        # The hedge only gets what was left of the deadline
+        self.assertLessEqual(hung.timeouts[0], 0.4)
+        self.assertLess(hedge.timeouts[0], 0.35)
+        fetcher.shutdown()
+
+    def test_running(self):
+        fetcher = quote_providers.HedgedFetcher([FakeProvider('slow', 0.5, price=1.0)], hedge_after=5.0)
+        self.assertEqual(fetcher.fetch('stock', 'AAPL', timeout=0.1), {})
+        self.assertEqual(len(fetcher.running()), 1)
+        fetcher.shutdown()
+        time.sleep(0.6)
+        self.assertEqual(fetcher.running(), [])
+
+    def test_rate_limit_wait_past_deadline(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            provider = FakeProvider('limited', 0.0, price=1.0)
+            provider.rate_limiter = RateLimiter(os.path.join(tmpdir, 'rate_limiter.json'), {'limited': (1.0, 1.0)})
+            self.assertEqual(provider.lookup('stock', 'AAPL', timeout=0.5)['Price'], 1.0)
+            start = time.time()
+            self.assertEqual(provider.lookup('stock', 'AAPL', timeout=0.5), {})
+            self.assertLess(time.time() - start, 0.1)
+            self.assertEqual(provider.calls, 1)
+
+    def test_failover(self):
+        broken = FakeProvider('broken', 0.0)
+        backup = FakeProvider('backup', 0.0, price=2.0)
+        fetcher = quote_providers.HedgedFetcher([broken, backup], hedge_after=5.0)
+        start = time.time()
+        self.assertEqual(fetcher.fetch('stock', 'AAPL')['Price'], 2.0)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(broken.stats.failures, 1)
+        with self.assertRaises(ValueError):
+            fetcher.fetch('index', '^GSPC')
+        fetcher.shutdown()
+
+    def test_p95_replaces_hedge_after(self):
+        primary = FakeProvider('primary', 0.0, price=1.0)
+        fetcher = quote_providers.HedgedFetcher([primary], hedge_after=5.0, min_samples=3)
+        self.assertEqual(fetcher.hedge_delay(primary), 5.0)
+        for _ in range(3):
+            primary.stats.record(0.2, True)
+        self.assertEqual(fetcher.hedge_delay(primary), 0.2)
+        fetcher.shutdown()
+
+if __name__ == '__main__':
+    unittest.main()
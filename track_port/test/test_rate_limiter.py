@@ -0,0 +1,64 @@
+import sys
+import os
+import json
+import time
+import tempfile
+import unittest
+from multiprocessing import Process
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+from rate_limiter import RateLimiter, RateLimitTimeout, parse_rates
+
+def acquire_tokens(path, count):
+    limiter = RateLimiter(path, {'test': (20.0, 1.0)})
+    for _ in range(count):
+        limiter.acquire('test')
+
+#############################################################################
+# Test the shared token buckets
+#############################################################################
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'rate_limiter.json')
+
+    def test_parse_rates(self):
+        self.assertEqual(parse_rates(['yahoo=2', 'finviz=5/50']), {'yahoo': (2.0, 4.0), 'finviz': (5.0, 50.0)})
+
+    def test_burst_then_rate(self):
+        limiter = RateLimiter(self.path, {'test': (20.0, 5.0)})
+        start = time.time()
+        for _ in range(5):
+            self.assertEqual(limiter.acquire('test'), 0.0)
+        self.assertLess(time.time() - start, 0.05)
+        for _ in range(4):
+            limiter.acquire('test')
+        self.assertGreater(time.time() - start, 0.15)
+        count, waited, longest = limiter.waits['test']
+        self.assertEqual(count, 9)
+        self.assertGreater(waited, 0.15)
+        self.assertEqual(limiter.acquire('unlimited'), 0.0)
+
+    def test_timeout(self):
+        limiter = RateLimiter(self.path, {'test': (2.0, 1.0)})
+        limiter.acquire('test')
+        start = time.time()
+        with self.assertRaises(RateLimitTimeout):
+            limiter.acquire('test', timeout=0.1)
+        self.assertLess(time.time() - start, 0.05)
+        # No tokens were taken, so the next caller waits no longer
+        self.assertLess(limiter.acquire('test', timeout=1.0), 0.55)
+
+    def test_shared_between_processes(self):
+        start = time.time()
+        processes = [Process(target=acquire_tokens, args=(self.path, 5)) for _ in range(2)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        # 10 tokens at 20/s with a bucket of 1 takes at least 9/20s
+        self.assertGreater(time.time() - start, 0.4)
+        with open(self.path) as f:
+            self.assertEqual(json.load(f)['test']['requests'], 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import sys
+import os
+import json
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+import run_metrics
+
+#############################################################################
+# Test collecting and exporting run metrics
+#############################################################################
+class TestRunMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = run_metrics.RunMetrics('test_run', buckets=(0.1, 1.0))
+        for seconds, symbol in ((0.05, 'AAPL'), (0.5, 'MSFT'), (2.0, 'IBM')):
+            self.metrics.observe('fetch_seconds', seconds, key=symbol, kind='stock')
+        self.metrics.count('screener_failures')
+        self.metrics.count('screener_failures')
+        self.metrics.count('http_retries', 3, host='finviz.com')
+        with self.metrics.phase('fetch_stock'):
+            pass
+        with self.metrics.phase('fetch_stock'):
+            pass
+
+    def test_textfile(self):
+        lines = self.metrics.textfile().splitlines()
+        self.assertIn('test_run_fetch_seconds_bucket{kind="stock",le="0.1"} 1', lines)
+        self.assertIn('test_run_fetch_seconds_bucket{kind="stock",le="1.0"} 2', lines)
+        self.assertIn('test_run_fetch_seconds_bucket{kind="stock",le="+Inf"} 3', lines)
+        self.assertIn('test_run_fetch_seconds_count{kind="stock"} 3', lines)
+        self.assertIn('test_run_screener_failures 2', lines)
+        self.assertIn('test_run_http_retries{host="finviz.com"} 3', lines)
+        self.assertTrue(any(line.startswith('test_run_phase_seconds{phase="fetch_stock"} ') for line in lines))
+
+    def test_summary(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'runs.jsonl')
+            self.metrics.write_summary(path)
+            self.metrics.write_summary(path)
+            with open(path) as f:
+                runs = [json.loads(line) for line in f]
+        self.assertEqual(len(runs), 2)
+        histogram = runs[0]['histograms']['fetch_seconds{kind="stock"}']
+        self.assertEqual((histogram['count'], histogram['p50'], histogram['max']), (3, 0.5, 2.0))
+        self.assertEqual(histogram['slowest'][0], ['IBM', 2.0])
+        self.assertEqual(runs[0]['phases']['fetch_stock']['entered'], 2)
+        self.assertEqual(runs[0]['counters']['screener_failures'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
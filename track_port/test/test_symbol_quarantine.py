@@ -0,0 +1,60 @@
+import sys
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+from symbol_quarantine import SymbolQuarantine
+
+now = datetime(2023, 6, 14, 9, 35)
+
+#############################################################################
+# Test SymbolQuarantine backoff and persistence
+#############################################################################
+class TestSymbolQuarantine(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'quote_quarantine.json')
+        self.quarantine = SymbolQuarantine(self.path)
+
+    def test_backoff(self):
+        self.quarantine.record_failure('XYZ', now)
+        self.assertFalse(self.quarantine.is_quarantined('XYZ', now))
+        self.quarantine.record_failure('XYZ', now)
+        self.assertEqual(self.quarantine.retry_after('XYZ'), now + timedelta(hours=1))
+        self.quarantine.record_failure('XYZ', now)
+        self.assertEqual(self.quarantine.retry_after('XYZ'), now + timedelta(hours=2))
+        for _ in range(20):
+            self.quarantine.record_failure('XYZ', now)
+        self.assertEqual(self.quarantine.retry_after('XYZ'), now + timedelta(days=7))
+
+    def test_split(self):
+        self.quarantine.record_failure('XYZ', now)
+        self.quarantine.record_failure('XYZ', now)
+        to_fetch, quarantined = self.quarantine.split({'AAPL', 'XYZ'}, now)
+        self.assertEqual((to_fetch, quarantined), ({'AAPL'}, {'XYZ'}))
+        to_fetch, quarantined = self.quarantine.split({'AAPL', 'XYZ'}, now + timedelta(hours=2))
+        self.assertEqual((to_fetch, quarantined), ({'AAPL', 'XYZ'}, set()))
+
+    def test_success_and_release(self):
+        for symbol in ('XYZ', 'ABC', 'DEF'):
+            self.quarantine.record_failure(symbol, now)
+        self.quarantine.record_success('XYZ')
+        self.assertEqual(self.quarantine.release(['ABC', 'NOPE']), ['ABC'])
+        self.assertEqual(list(self.quarantine.entries.keys()), ['DEF'])
+        self.assertEqual(self.quarantine.release(['all']), ['DEF'])
+
+    def test_persistence(self):
+        self.quarantine.record_failure('XYZ', now)
+        self.quarantine.record_failure('XYZ', now)
+        self.quarantine.record_failure('ABC', now)
+        self.quarantine.save()
+        quarantine = SymbolQuarantine(self.path)
+        self.assertEqual(quarantine.entries, self.quarantine.entries)
+        lines = quarantine.report(now)
+        self.assertTrue(lines[0].startswith('XYZ '))
+        self.assertIn(' quarantined ', lines[0])
+        self.assertIn(' watching ', lines[1])
+
+if __name__ == '__main__':
+    unittest.main()
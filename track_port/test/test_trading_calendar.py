@@ -0,0 +1,93 @@
+import sys
+import os
+import tempfile
+import unittest
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+from trading_calendar import TradingCalendar
+from sqlalchemy import create_engine, Column, Date
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+Base = declarative_base()
+
+class MarketHolidays(Base):
+    __tablename__ = 'market_holiday'
+    date = Column(Date, primary_key=True)
+
+holidays = [date(2023, 1, 2), date(2023, 1, 16), date(2023, 7, 4), date(2023, 12, 25)]
+
+#############################################################################
+# Test TradingCalendar lookups
+#############################################################################
+class TestTradingCalendar(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.calendar = TradingCalendar(holidays)
+
+    def test_is_open(self):
+        self.assertFalse(self.calendar.is_open(date(2023, 7, 4)))
+        self.assertFalse(self.calendar.is_open(date(2023, 7, 8)))
+        self.assertTrue(self.calendar.is_open(date(2023, 7, 5)))
+
+    def test_previous_trading_day(self):
+        self.assertEqual(self.calendar.previous_trading_day(date(2023, 7, 5)), date(2023, 7, 3))
+        self.assertEqual(self.calendar.previous_trading_day(date(2023, 7, 5), inclusive=True), date(2023, 7, 5))
+        self.assertEqual(self.calendar.previous_trading_day(date(2023, 7, 9), inclusive=True), date(2023, 7, 7))
+        self.assertEqual(self.calendar.previous_trading_day(date(2023, 1, 3)), date(2022, 12, 30))
+
+    def test_next_trading_day(self):
+        self.assertEqual(self.calendar.next_trading_day(date(2023, 7, 3)), date(2023, 7, 5))
+        self.assertEqual(self.calendar.next_trading_day(date(2023, 7, 4), inclusive=True), date(2023, 7, 5))
+
+    def test_trading_days_between(self):
+        days = self.calendar.trading_days_between(date(2023, 7, 1), date(2023, 7, 9))
+        self.assertEqual(days, [date(2023, 7, 3), date(2023, 7, 5), date(2023, 7, 6), date(2023, 7, 7)])
+        self.assertEqual(self.calendar.count_trading_days(date(2023, 7, 1), date(2023, 7, 9)), 4)
+        self.assertEqual(self.calendar.trading_days_between(date(2023, 7, 9), date(2023, 7, 1)), [])
+
+    def test_trading_day_offset(self):
+        self.assertEqual(self.calendar.trading_day_offset(date(2023, 7, 5), 1), date(2023, 7, 3))
+        self.assertEqual(self.calendar.trading_day_offset(date(2023, 7, 5), 2), date(2023, 6, 30))
+        self.assertEqual(self.calendar.trading_day_offset(date(2023, 7, 8), 1), date(2023, 7, 7))
+        self.assertEqual(self.calendar.trading_day_offset(date(2023, 7, 4), -1), date(2023, 7, 5))
+
+    def test_outside_range(self):
+        self.assertEqual(self.calendar.previous_trading_day(date(1980, 1, 7)), date(1980, 1, 4))
+        self.assertEqual(self.calendar.count_trading_days(date(1980, 1, 1), date(1980, 1, 7)), 5)
+
+    def test_matches_day_by_day(self):
+        day = date(2022, 12, 1)
+        while day < date(2024, 2, 1):
+            expected = day - timedelta(days=1)
+            while expected.isoweekday() >= 6 or expected in holidays:
+                expected -= timedelta(days=1)
+            self.assertEqual(self.calendar.previous_trading_day(day), expected)
+            day += timedelta(days=1)
+
+    def test_cache(self):
+        cache_path = os.path.join(tempfile.mkdtemp(), 'trading_calendar.json')
+        self.calendar.save_cache(cache_path, [4, '2023-01-02', '2023-12-25'])
+        calendar = TradingCalendar.load_cache(cache_path, [4, '2023-01-02', '2023-12-25'])
+        self.assertEqual(calendar.ordinals, self.calendar.ordinals)
+        self.assertEqual(calendar.holidays, self.calendar.holidays)
+        self.assertIsNone(TradingCalendar.load_cache(cache_path, [5, '2023-01-02', '2024-01-01']))
+
+    def test_cache_follows_moved_holiday(self):
+        cache_path = os.path.join(tempfile.mkdtemp(), 'trading_calendar.json')
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        session.add_all([MarketHolidays(date=holiday) for holiday in holidays])
+        session.commit()
+        self.assertFalse(TradingCalendar.from_session(session, MarketHolidays, cache_path).is_open(date(2023, 7, 4)))
+        # Same count and range, one date moved
+        session.query(MarketHolidays).filter_by(date=date(2023, 7, 4)).update({'date': date(2023, 7, 5)})
+        session.commit()
+        calendar = TradingCalendar.from_session(session, MarketHolidays, cache_path)
+        self.assertTrue(calendar.is_open(date(2023, 7, 4)))
+        self.assertFalse(calendar.is_open(date(2023, 7, 5)))
+
+if __name__ == '__main__':
+    unittest.main()